@@ -0,0 +1,189 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Nightly batch over a roster of profiles.
+
+A profile is a data directory with its own db files and credentials
+(a credentials.txt in it, or given in the roster). run_batch syncs
+every profile and computes its summary (weight summary with the BMI
+goal projections, binned calorie/weight/run series and the projected
+weight) in a process pool. Each profile is one task with its own
+FitnessData in a worker process: a profile that fails is reported
+with its error, traceback and output, the others carry on. Modules are
+imported once, before the workers are forked.
+
+    python batch.py ROSTER [-j PROCESSES] [--no-sync] [-o report.json]
+
+ROSTER is a directory holding one directory per profile, or a JSON
+list of {"name", "datadir", "credentials", "height", "start"}.
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import StringIO
+import sys
+import timeit
+import traceback
+
+import numpy as np
+
+import fitnessd
+import fitnessdata
+
+#Binned series of the summaries and the projection horizon (days)
+BINSIZE = 'week'
+HORIZON = 30
+
+#Worker processes are replaced after this many profiles
+TASKS_PER_CHILD = 50
+
+#Characters of a failed profile's output kept in its result
+LOG_TAIL = 2000
+
+class BatchError(Exception):
+    pass
+
+class Profile(object):
+    """One athlete: data directory, credentials (dict, file or None for
+    the credentials file in datadir), height and the first day to fetch
+    if the db has to be initialized"""
+    def __init__(self,name,datadir,credentials = None,height = 66.,start = None):
+        self.name = name
+        self.datadir = datadir
+        self.credentials = credentials
+        self.height = height
+        self.start = start
+
+    def __repr__(self):
+        return 'Profile(%r, %r)'%(self.name,self.datadir)
+
+def load_roster(path):
+    """Profiles of a roster directory or JSON file"""
+    if os.path.isdir(path):
+        profiles = []
+        for name in sorted(os.listdir(path)):
+            datadir = os.path.join(path,name)
+            if (os.path.isdir(os.path.join(datadir,os.path.dirname(fitnessdata.DB_CAL))) or
+                    os.path.isfile(os.path.join(datadir,fitnessdata.CREDENTIALS))):
+                profiles.append(Profile(name,datadir))
+        return profiles
+    with open(path) as f:
+        entries = json.load(f)
+    root = os.path.dirname(os.path.abspath(path))
+    profiles = []
+    for entry in entries:
+        datadir = os.path.join(root,entry['datadir'])
+        profiles.append(Profile(entry.get('name',os.path.basename(datadir)),datadir,
+                                entry.get('credentials'),entry.get('height',66.),entry.get('start')))
+    return profiles
+
+def summarize(fitness,binsize = BINSIZE,horizon = HORIZON):
+    """Weight summary, binned series (calories and runs summed, weights
+    averaged per bin) and the weight projected 'horizon' days ahead"""
+    series = {}
+    for name,get,how in (('calorie',fitness.get_calorie_data,'sum'),('weight',fitness.get_weight_data,'mean'),
+                         ('run',fitness.get_run_data,'sum')):
+        binned = get(binsize = binsize,how = how)
+        series[name] = binned if binned[0] is not None else None
+    projected = fitness.projected_weight(datetime.date.today() + datetime.timedelta(days = horizon))
+    return {'weight_summary':fitness.weight_summary(),'series':series,'projected_weight':projected}
+
+def run_profile(profile,sync = True,binsize = BINSIZE,horizon = HORIZON,cls = fitnessdata.FitnessData):
+    """Sync and summarize one profile. Never raises: returns a result
+    dict with 'ok' and either 'summary' or 'error', 'traceback' and the
+    tail of the profile's output."""
+    result = {'name':profile.name,'datadir':profile.datadir,'ok':False,'rows':0,'pid':os.getpid()}
+    start = timeit.default_timer()
+    stdout,stdin = sys.stdout,sys.stdin
+    log = StringIO.StringIO()
+    #Output is kept per profile and nothing can wait for input
+    sys.stdout,sys.stdin = log,StringIO.StringIO()
+    try:
+        fitness = cls(lazy = True,datadir = profile.datadir,credentials = profile.credentials,
+                      height = profile.height)
+        if sync:
+            if profile.start == None and fitness.get_last_entry()[0] == None:
+                raise BatchError("No db in %s and no start date to initialize it from."%profile.datadir)
+            fitness.sync(start = profile.start)
+        if fitness.get_last_entry()[0] == None:
+            raise BatchError("No db in %s."%profile.datadir)
+        result['summary'] = summarize(fitness,binsize,horizon)
+        result['rows'] = sum(len(getattr(fitness,attrs[0])) for attrs in fitnessdata.DB_ATTRS.values())
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = '%s: %s'%(type(e).__name__,e)
+        result['traceback'] = traceback.format_exc()
+        result['log'] = log.getvalue()[-LOG_TAIL:]
+    finally:
+        sys.stdout,sys.stdin = stdout,stdin
+    result['seconds'] = timeit.default_timer() - start
+    return result
+
+def _run_task(task):
+    profile,options = task
+    return run_profile(profile,**options)
+
+def aggregate(results,wall,processes):
+    """Throughput and per-profile time statistics of a batch"""
+    seconds = np.array([r['seconds'] for r in results]) if results else np.zeros(1)
+    rows = sum(r['rows'] for r in results)
+    ok = sum(1 for r in results if r['ok'])
+    return {'profiles':len(results),'ok':ok,'failed':len(results) - ok,'processes':processes,
+            'wall':wall,'profiles_per_s':len(results) / wall if wall else None,
+            'rows':rows,'rows_per_s':rows / wall if wall else None,
+            'profile_p50':float(np.percentile(seconds,50)),'profile_p95':float(np.percentile(seconds,95)),
+            'profile_max':float(seconds.max()),
+            #Busy time over wall time, how much the pool overlapped profiles
+            'parallelism':float(seconds.sum()) / wall if wall else None}
+
+def run_batch(profiles,processes = None,sync = True,binsize = BINSIZE,horizon = HORIZON,
+              cls = fitnessdata.FitnessData):
+    """Run every profile (see run_profile) in a pool of 'processes'
+    workers (default the CPU count; 1 runs them in this process).
+    Returns {'stats': aggregate, 'results': one per profile in roster
+    order}."""
+    options = {'sync':sync,'binsize':binsize,'horizon':horizon,'cls':cls}
+    tasks = [(profile,options) for profile in profiles]
+    if processes == None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1,min(processes,len(tasks)))
+    start = timeit.default_timer()
+    if processes == 1:
+        results = [_run_task(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes,maxtasksperchild = TASKS_PER_CHILD)
+        try:
+            #One profile per task, a slow profile does not hold up others
+            results = list(pool.imap(_run_task,tasks))
+        finally:
+            pool.close()
+            pool.join()
+    wall = timeit.default_timer() - start
+    return {'stats':aggregate(results,wall,processes),'results':results}
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Sync and summarize a roster of profiles')
+    parser.add_argument('roster',help = 'directory of profiles or JSON roster')
+    parser.add_argument('-j','--processes',type = int,help = 'worker processes (default CPU count)')
+    parser.add_argument('--no-sync',action = 'store_true',help = 'summarize the db files as they are')
+    parser.add_argument('-o','--output',help = 'write the report here (JSON)')
+    args = parser.parse_args(argv)
+
+    report = run_batch(load_roster(args.roster),args.processes,not args.no_sync)
+    for result in report['results']:
+        if not result['ok']:
+            print "%s: %s"%(result['name'],result['error'])
+    stats = report['stats']
+    print "%d profiles (%d failed) in %.2f s on %d processes: %.1f profiles/s, %.0f rows/s"%(
+        stats['profiles'],stats['failed'],stats['wall'],stats['processes'],
+        stats['profiles_per_s'] or 0,stats['rows_per_s'] or 0)
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(report,f,default = fitnessd._default,indent = 1)
+    return 1 if stats['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
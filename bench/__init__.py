@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for FitnessData.
+
+generate  - synthetic DB_CAL/DB_WGT/DB_RUN files of any length
+fakes     - local stand-ins for the myfitnesspal and stravalib clients
+scenarios - the timed scenarios and the JSON runner/comparer
+load      - load generator for the query daemon (fitnessd)
+
+Usage: python -m bench run -y 1 10 30 -o new.json
+       python -m bench compare old.json new.json
+       python -m bench load -c 8 -n 4000
+"""
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Command line for the benchmarks (python -m bench -h)"""
+
+import argparse
+import sys
+
+from bench import fixtures,load,scenarios
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m bench')
+    sub = parser.add_subparsers(dest = 'command')
+
+    run = sub.add_parser('run',help = 'run the scenarios')
+    run.add_argument('-y','--years',type = float,nargs = '+',default = [1,10,30],
+                     help = 'history lengths to generate')
+    run.add_argument('-r','--repeat',type = int,default = 5)
+    run.add_argument('-l','--latency',type = float,default = 0.,
+                     help = 'seconds per fake API request')
+    run.add_argument('-k','--select',nargs = '+',help = 'scenario name globs')
+    run.add_argument('-o','--output',help = 'write the results here (JSON)')
+    responses = run.add_mutually_exclusive_group()
+    responses.add_argument('--record',metavar = 'DIR',help = 'record the sync responses here')
+    responses.add_argument('--replay',metavar = 'DIR',help = 'sync from responses recorded here')
+
+    cmp = sub.add_parser('compare',help = 'compare two result files')
+    cmp.add_argument('old')
+    cmp.add_argument('new')
+    cmp.add_argument('-t','--threshold',type = float,default = 1.25,
+                     help = 'slowdown ratio counted as a regression')
+
+    daemon = sub.add_parser('load',help = 'load test the query daemon')
+    daemon.add_argument('-y','--years',type = float,default = 10)
+    daemon.add_argument('-c','--clients',type = int,default = 8,
+                        help = 'concurrent client threads')
+    daemon.add_argument('-n','--requests',type = int,default = 4000)
+    daemon.add_argument('-s','--sync-every',type = float,
+                        help = 'seconds between syncs while the load runs')
+    daemon.add_argument('-o','--output',help = 'write the results here (JSON)')
+
+    fix = sub.add_parser('fixtures',help = 'check the analysis of the recorded strava streams')
+    fix.add_argument('--record',action = 'store_true',help = 'record the fixture again')
+
+    args = parser.parse_args(argv)
+    if args.command == 'fixtures':
+        if args.record:
+            fixtures.record_streams()
+        problems = fixtures.check_streams()
+        for problem in problems:
+            print problem
+        print "%s: %s"%(fixtures.STREAM_FIXTURE,'FAILED' if problems else 'ok')
+        return 1 if problems else 0
+    if args.command == 'load':
+        result = load.run_load(args.years,args.clients,args.requests,args.sync_every)
+        if args.output:
+            scenarios.save(result,args.output)
+        return 1 if result['failures'] else 0
+    if args.command == 'run':
+        mode = 'replay' if args.replay else 'record'
+        result = scenarios.run_all(args.years,args.repeat,args.latency,args.select,
+                                   responses = args.replay or args.record,response_mode = mode)
+        if args.output:
+            scenarios.save(result,args.output)
+        return 0
+    regressions = scenarios.compare(scenarios.load(args.old),scenarios.load(args.new),args.threshold)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
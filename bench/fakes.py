@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the myfitnesspal and stravalib clients.
+
+They answer the calls FitnessData makes with deterministic synthetic
+data (the same date always gives the same answer), sleep 'latency'
+seconds per request and raise IOError on a fraction 'error_rate' of the
+requests, so the sync code can be timed and tested without a network.
+"""
+
+import datetime
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+class FakeClientBase(object):
+    """Latency, error injection and call counting"""
+    def __init__(self,latency = 0.,error_rate = 0.,seed = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._errors = random.Random(seed)
+
+    def _request(self):
+        """Account for one round trip"""
+        with self._lock:
+            self.calls += 1
+            fail = self._errors.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise IOError("Injected transient error")
+
+    def _rng(self,date,salt = 0):
+        """Random generator that only depends on the date"""
+        return random.Random(self.seed * 1000003 + date.toordinal() * 7 + salt)
+
+class FakeDay(object):
+    """What FitnessData uses of a myfitnesspal Day"""
+    def __init__(self,date,totals,goals):
+        self.date = date
+        self.totals = totals
+        self.goals = goals
+
+class FakeMFPClient(FakeClientBase):
+    """myfitnesspal.Client: get_date and get_measurements"""
+    def __init__(self,latency = 0.,error_rate = 0.,seed = 0,unlogged_rate = 0.05,weigh_rate = 0.6):
+        FakeClientBase.__init__(self,latency,error_rate,seed)
+        self.unlogged_rate = unlogged_rate
+        self.weigh_rate = weigh_rate
+
+    def get_date(self,date):
+        self._request()
+        rng = self._rng(date)
+        if rng.random() < self.unlogged_rate:
+            return FakeDay(date,{},{})
+        return FakeDay(date,{'calories':int(rng.gauss(2100,350))},{'calories':2000})
+
+    def get_measurements(self,measurement = 'Weight',lower_bound = None,upper_bound = None):
+        self._request()
+        today = datetime.date.today()
+        upper_bound = upper_bound or today
+        lower_bound = lower_bound or upper_bound - datetime.timedelta(days = 30)
+        wts = OrderedDict()
+        date = upper_bound
+        while date >= lower_bound:
+            rng = self._rng(date,1)
+            if rng.random() < self.weigh_rate:
+                days = date.toordinal() - 730000
+                wts[date] = round(230. - 0.02 * days + rng.gauss(0,1.2),1)
+            date = date - datetime.timedelta(days = 1)
+        return wts
+
+class FakeQuantity(object):
+    """units quantity (stravalib distances)"""
+    def __init__(self,num):
+        self.num = num
+
+class FakeActivity(object):
+    """What FitnessData uses of a stravalib Activity"""
+    def __init__(self,id,type,start_date,distance,elapsed_time):
+        self.id = id
+        self.type = type
+        self.start_date = start_date
+        self.start_date_local = start_date
+        self.distance = FakeQuantity(distance)
+        self.elapsed_time = datetime.timedelta(seconds = elapsed_time)
+
+class FakeAthlete(object):
+    def __init__(self,created_at):
+        self.created_at = created_at
+
+class FakeStream(object):
+    """stravalib Stream"""
+    def __init__(self,data):
+        self.data = data
+
+class FakeStravaClient(FakeClientBase):
+    """stravalib.Client: get_athlete, get_activities and
+    get_activity_streams. Activities come back oldest first in pages of
+    'page_size', one request per page."""
+    def __init__(self,latency = 0.,error_rate = 0.,seed = 0,created_at = None,
+                 run_rate = 0.4,ride_rate = 0.1,page_size = 30):
+        FakeClientBase.__init__(self,latency,error_rate,seed)
+        if created_at == None:
+            created_at = datetime.datetime.now() - datetime.timedelta(days = 365)
+        self.created_at = created_at
+        self.run_rate = run_rate
+        self.ride_rate = ride_rate
+        self.page_size = page_size
+
+    def get_athlete(self):
+        self._request()
+        return FakeAthlete(self.created_at)
+
+    def activities_on(self,date):
+        """The activities of one day"""
+        rng = self._rng(date,2)
+        acts = []
+        for n in range(2):
+            if rng.random() < self.run_rate / (n + 1.):
+                kind = 'Run'
+            elif rng.random() < self.ride_rate:
+                kind = 'Ride'
+            else:
+                continue
+            start = datetime.datetime.combine(date,datetime.time(6 + 10 * n,rng.randint(0,59)))
+            dist = rng.uniform(3000.,21000.)
+            acts.append(FakeActivity(date.toordinal() * 10 + n,kind,start,dist,int(dist * rng.uniform(0.28,0.4))))
+        return acts
+
+    def get_activities(self,before = None,after = None,limit = None):
+        if after == None:
+            after = self.created_at
+        if isinstance(after,datetime.date) and not isinstance(after,datetime.datetime):
+            after = datetime.datetime.combine(after,datetime.time(0,0,0))
+        now = datetime.datetime.now()
+        date = after.date()
+        count = 0
+        while date <= now.date():
+            for act in self.activities_on(date):
+                if act.start_date <= after or act.start_date > now:
+                    continue
+                if count % self.page_size == 0:
+                    self._request()
+                yield act
+                count += 1
+                if limit and count >= limit:
+                    return
+            date = date + datetime.timedelta(days = 1)
+
+    def get_activity_streams(self,activity_id,types = None,resolution = None,series_type = None):
+        """A sample a second over the activity: pace, heart rate and
+        altitude wander, with a pause now and then"""
+        self._request()
+        date = datetime.date.fromordinal(activity_id // 10)
+        acts = [act for act in self.activities_on(date) if act.id == activity_id]
+        if not acts:
+            raise IOError("No activity %s"%activity_id)
+        act = acts[0]
+        rng = np.random.RandomState((self.seed * 1000003 + activity_id) % (1 << 32))
+        n = int(act.elapsed_time.total_seconds())
+        speed = np.maximum(0.5,1 + np.cumsum(rng.normal(0,0.01,n)) + rng.normal(0,0.05,n))
+        time = np.arange(n)
+        for start in rng.randint(0,n,n // 1800):
+            time[start:] += rng.randint(10,120)
+        dist = np.cumsum(speed) * (act.distance.num / speed.sum())
+        hr = np.clip(145 + np.cumsum(rng.normal(0,0.3,n)) + 20 * (speed - 1),60,210).astype(int)
+        alt = 100 + np.cumsum(rng.normal(0,0.1,n))
+        streams = {'time':time.tolist(),'distance':dist.tolist(),'heartrate':hr.tolist(),'altitude':alt.tolist()}
+        return dict((kind,FakeStream(streams[kind])) for kind in (types or streams) if kind in streams)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Recorded strava streams and what streams.analyze() makes of them.
+
+bench/data/streams holds the get_activity_streams responses of a few
+runs, recorded through the response cache, and expected.json the
+activities with their splits, best efforts and time in zone as
+analyzed when they were recorded. check_streams replays the responses
+offline into a fresh archive and compares.
+
+    python -m bench fixtures            check
+    python -m bench fixtures --record   record again (fake client)
+"""
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import respcache
+import streams
+from bench import fakes
+
+STREAM_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data','streams')
+
+#Recorded runs: the first RUNS of the fake athlete from CREATED on
+CREATED = datetime.datetime(2020,1,1)
+RUNS = 2
+
+def _expected(result,acts):
+    splits = result['splits']
+    return {'activities':[[id,str(date)] for id,date in acts],
+            'samples':result['samples'],
+            'splits':{'id':splits['id'].tolist(),'seconds':splits['seconds'].tolist(),
+                      'heartrate':splits['heartrate'].tolist()},
+            'best_efforts':dict((name,value and value[0]) for name,value in result['best_efforts'].items()),
+            'zones':result['zones'].tolist()}
+
+def _analyze(client,acts):
+    """analyze() of the activities ingested with 'client' into a fresh archive"""
+    path = tempfile.mkdtemp(prefix = 'fitstreams')
+    try:
+        archive = streams.StreamArchive(path)
+        if streams.ingest(client,acts,archive) != len(acts):
+            raise ValueError("Not every recorded activity could be ingested.")
+        return streams.analyze(archive.iter_streams())
+    finally:
+        shutil.rmtree(path,ignore_errors = True)
+
+def record_streams(path = STREAM_FIXTURE):
+    """Record the streams of the fake runs and their analysis"""
+    shutil.rmtree(path,ignore_errors = True)
+    client = fakes.FakeStravaClient(created_at = CREATED)
+    acts = []
+    for act in client.get_activities():
+        if act.type == 'Run':
+            acts.append((act.id,act.start_date_local.date()))
+            if len(acts) == RUNS:
+                break
+    store = respcache.ResponseStore(os.path.join(path,'responses'))
+    result = _analyze(respcache.CachingClient(client,store,'strava','record'),acts)
+    with open(os.path.join(path,'expected.json'),'w') as f:
+        json.dump(_expected(result,acts),f,indent = 1,sort_keys = True)
+    return result
+
+def check_streams(path = STREAM_FIXTURE):
+    """Replay the recorded streams and compare the analysis with the
+    recorded one. Returns the list of mismatches (empty if it matches)."""
+    with open(os.path.join(path,'expected.json')) as f:
+        expected = json.load(f)
+    acts = [(id,datetime.datetime.strptime(date,'%Y-%m-%d').date()) for id,date in expected['activities']]
+    store = respcache.ResponseStore(os.path.join(path,'responses'))
+    got = _expected(_analyze(respcache.CachingClient(None,store,'strava','replay'),acts),acts)
+    problems = []
+    if got['samples'] != expected['samples']:
+        problems.append('samples %s != %s'%(got['samples'],expected['samples']))
+    if got['splits']['id'] != expected['splits']['id']:
+        problems.append('split count or order differs')
+    else:
+        for name in ('seconds','heartrate'):
+            if not np.allclose(got['splits'][name],expected['splits'][name],rtol = 1e-6,equal_nan = True):
+                problems.append('split %s differ'%name)
+    for name,value in expected['best_efforts'].items():
+        other = got['best_efforts'].get(name)
+        if (value == None) != (other == None) or (value != None and not np.isclose(value,other,rtol = 1e-6)):
+            problems.append('best %s %s != %s'%(name,other,value))
+    if not np.allclose(got['zones'],expected['zones']):
+        problems.append('zones %s != %s'%(got['zones'],expected['zones']))
+    return problems
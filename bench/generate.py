@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic db files for benchmarks.
+
+write_db writes files in the same format _init_db/update_db produce:
+daily calorie rows with whole missing days (gaps) and -1,-1 unlogged
+days, a noisy weight trend weighed in on most days, and runs on some
+days, a few of them with two runs.
+"""
+
+import datetime
+import os
+import numpy as np
+
+import binning
+import fitnessdata
+
+def write_db(root,years = 1,seed = 0,end = None,gap_rate = 0.01,unlogged_rate = 0.05,
+             weigh_rate = 0.6,run_rate = 0.4,double_run_rate = 0.1):
+    """Write db files covering 'years' years up to 'end' (default today)
+    under the directory 'root'. Returns the number of rows written."""
+    rng = np.random.RandomState(seed)
+    if end == None:
+        end = datetime.date.today()
+    ndays = max(1,int(round(365.25 * years)))
+    days = end.toordinal() - ndays + 1 + np.arange(ndays)
+    dates = [str(d) for d in binning.to_dates(days)]
+
+    dbdir = os.path.join(root,os.path.dirname(fitnessdata.DB_CAL))
+    if not os.path.isdir(dbdir):
+        os.makedirs(dbdir)
+    nrows = 0
+
+    #Calories, the last day is not final yet
+    cals = rng.normal(2100,350,ndays).astype(int)
+    goal = np.full(ndays,2000)
+    unlogged = rng.rand(ndays) < unlogged_rate
+    cals[unlogged] = -1
+    goal[unlogged] = -1
+    final = np.ones(ndays,dtype = int)
+    final[-1] = 0
+    keep = rng.rand(ndays) >= gap_rate
+    keep[-1] = True
+    with open(os.path.join(root,fitnessdata.DB_CAL),'w') as f:
+        for i in np.flatnonzero(keep):
+            f.write("%s,%s,%s,%s\n"%(dates[i],cals[i],goal[i],final[i]))
+            nrows += 1
+
+    #Weight, a slow trend plus daily noise
+    trend = 210. - 0.02 * np.arange(ndays) + 5 * np.sin(np.arange(ndays) / 90.)
+    wt = np.round(trend + rng.normal(0,1.2,ndays),1)
+    weighed = rng.rand(ndays) < weigh_rate
+    with open(os.path.join(root,fitnessdata.DB_WGT),'w') as f:
+        for i in np.flatnonzero(weighed):
+            f.write("%s,%s\n"%(dates[i],wt[i]))
+            nrows += 1
+
+    #Runs, some days twice
+    ran = rng.rand(ndays) < run_rate
+    twice = ran & (rng.rand(ndays) < double_run_rate)
+    with open(os.path.join(root,fitnessdata.DB_RUN),'w') as f:
+        for i in np.flatnonzero(ran):
+            for n in range(2 if twice[i] else 1):
+                dist = rng.uniform(3000.,21000.)
+                time = int(dist * rng.uniform(0.28,0.4))
+                f.write("%s,%s,%s\n"%(dates[i],dist,time))
+                nrows += 1
+    return nrows
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Load generator for the query daemon (fitnessd).
+
+Serves a synthetic db from a FitnessServer in this process and hits it
+from 'clients' threads, each with its own FitnessClient, with a mix of
+point, range, binned and trend queries. A writer can sync against the
+fake clients every 'sync_every' seconds while the readers run. Reports
+throughput and latency percentiles, next to the per-query cost of a
+fresh process building its own FitnessData (the cost the daemon
+removes).
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import timeit
+
+import numpy as np
+
+import fitnessd
+import fitnessdata
+from bench import generate,scenarios
+
+def query_mix(today):
+    """(name, function of a client) pairs issued round robin"""
+    week = today - datetime.timedelta(days = 7)
+    half_year = today - datetime.timedelta(days = 182)
+    return [('weight.point',lambda c: c.get_weight_data(week)),
+            ('calorie.point',lambda c: c.get_calorie_data(week)),
+            ('weight.range',lambda c: c.get_weight_data(start_date = half_year)),
+            ('calorie.week',lambda c: c.get_calorie_data(binsize = 'week')),
+            ('run.month',lambda c: c.get_run_data(binsize = 'month')),
+            ('weight_slope',lambda c: c.weight_slope()),
+            ('projected_date',lambda c: c.projected_date(c.weight_from_BMI(25.))),
+            ('bmi',lambda c: c.BMI())]
+
+def baseline(workdir,repeat = 3):
+    """Seconds for a fresh process to import, build a FitnessData and
+    answer one query"""
+    run,reset = scenarios.cold_start(scenarios.Context(workdir,0))
+    return float(np.median(scenarios.time_scenario(run,reset,repeat)))
+
+def run_load(years = 10,clients = 8,requests = 4000,sync_every = None,verbose = True):
+    """Run the load and return the JSON-ready result dict"""
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    fetch_rate = fitnessdata.FETCH_RATE
+    response_mode = fitnessdata.RESPONSE_MODE
+    devnull = open(os.devnull,'w')
+    workdir = tempfile.mkdtemp(prefix = 'fitload')
+    fitnessdata.FETCH_RATE = 0
+    fitnessdata.RESPONSE_MODE = 'off'
+    try:
+        generate.write_db(workdir,years)
+        os.chdir(workdir)
+        today = datetime.date.today()
+        sys.stdout = devnull
+        cold = baseline(workdir)
+        server = fitnessd.serve(scenarios.BenchFitnessData(lazy = True),port = 0)
+        if sync_every:
+            server.sync_every(sync_every)
+        host,port = server.server_address
+        mix = query_mix(today)
+        latencies = [[] for i in range(clients)]
+        failures = []
+
+        def client_loop(n):
+            client = fitnessd.FitnessClient(host,port)
+            mine = latencies[n]
+            try:
+                for i in range(n,requests,clients):
+                    name,call = mix[i % len(mix)]
+                    start = timeit.default_timer()
+                    call(client)
+                    mine.append(timeit.default_timer() - start)
+            except Exception as e:
+                failures.append('%s: %s'%(type(e).__name__,e))
+            finally:
+                client.close()
+
+        threads = [threading.Thread(target = client_loop,args = (n,)) for n in range(clients)]
+        start = timeit.default_timer()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = timeit.default_timer() - start
+        stats = server.stats()
+        server.shutdown()
+        server.server_close()
+    finally:
+        sys.stdout = stdout
+        fitnessdata.FETCH_RATE = fetch_rate
+        fitnessdata.RESPONSE_MODE = response_mode
+        devnull.close()
+        os.chdir(cwd)
+        shutil.rmtree(workdir,ignore_errors = True)
+
+    times = np.concatenate([np.asarray(t) for t in latencies]) * 1e3
+    result = {'years':years,'clients':clients,'requests':len(times),'wall':wall,
+              'throughput':len(times) / wall,'failures':failures,
+              'generation':stats['generation'],'baseline_ms':cold * 1e3}
+    for q in (50,95,99):
+        result['p%d_ms'%q] = float(np.percentile(times,q)) if len(times) else None
+    result['max_ms'] = float(times.max()) if len(times) else None
+    if verbose:
+        print "%d requests from %d clients over %gy of data in %.2f s"%(len(times),clients,years,wall)
+        print "throughput     %10.1f req/s"%result['throughput']
+        for key in ('p50_ms','p95_ms','p99_ms','max_ms'):
+            print "%-14s %10.3f"%(key,result[key])
+        print "fresh process  %10.3f ms per query (no daemon)"%result['baseline_ms']
+        print "snapshots      %10d"%result['generation']
+        for failure in failures:
+            print "FAILED: %s"%failure
+    return result
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+"""
+Timed benchmark scenarios and the JSON runner/comparer.
+
+Every scenario gets a context (a directory holding a synthetic db of
+ctx.years years, made current by chdir) and returns a run function,
+plus optionally a reset function that is called untimed before every
+repeat. Results are written as JSON so two runs can be compared.
+"""
+
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import numpy as np
+
+import batch
+import binning
+import colstore
+import fitnessdata
+import instrument
+import runs
+import sqlstore
+import streams
+import trend
+from bench import fakes,generate
+
+#Repository root, for the cold start subprocess
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_FILES = (fitnessdata.DB_CAL,fitnessdata.DB_WGT,fitnessdata.DB_RUN)
+
+SCENARIOS = []
+
+def scenario(name,repeat = None):
+    """Register a scenario. repeat caps the number of repeats."""
+    def register(func):
+        SCENARIOS.append((name,func,repeat))
+        return func
+    return register
+
+class BenchFitnessData(fitnessdata.FitnessData):
+    """FitnessData syncing against the fake clients"""
+    latency = 0.
+    login_latency = 0.
+    init_start = None
+
+    def _read_creds(self):
+        pass
+
+    def _make_client(self,mode):
+        if self.login_latency:
+            time.sleep(self.login_latency)
+        if fitnessdata.RESPONSE_MODE == 'replay':
+            return self._wrap_client(None,mode)
+        if mode == 'mfp':
+            client = fakes.FakeMFPClient(latency = self.latency)
+        else:
+            created = datetime.datetime.combine(self.init_start or datetime.date.today(),datetime.time(0,0,0))
+            client = fakes.FakeStravaClient(latency = self.latency,created_at = created)
+        return self._wrap_client(instrument.CountingClient(client,mode),mode)
+
+    def _init_db(self,start = None):
+        return fitnessdata.FitnessData._init_db(self,start or self.init_start)
+
+class Context(object):
+    """Where a scenario runs"""
+    def __init__(self,workdir,years,latency = 0.):
+        self.workdir = workdir
+        self.years = years
+        self.latency = latency
+        self.today = datetime.date.today()
+
+    def fitness(self,**kwargs):
+        kwargs.setdefault('lazy',True)
+        return fitnessdata.FitnessData(**kwargs)
+
+def clear_stores():
+    for fname in DB_FILES:
+        shutil.rmtree(colstore.store_path(fname),ignore_errors = True)
+
+@scenario('readfile.convert')
+def readfile_convert(ctx):
+    fd = ctx.fitness()
+    def run():
+        for fname in DB_FILES:
+            fd.readfile(fname)
+    return run,clear_stores
+
+@scenario('readfile.mapped')
+def readfile_mapped(ctx):
+    fd = ctx.fitness()
+    for fname in DB_FILES:
+        fd.readfile(fname)
+    def run():
+        for fname in DB_FILES:
+            fd.readfile(fname)
+    return run,None
+
+@scenario('init.eager')
+def init_eager(ctx):
+    def run():
+        fitnessdata.FitnessData()
+    return run,None
+
+@scenario('init.lazy')
+def init_lazy(ctx):
+    def run():
+        fitnessdata.FitnessData(lazy = True)
+    return run,None
+
+@scenario('init.cold_start',repeat = 3)
+def cold_start(ctx):
+    """Fresh interpreter: import + lazy construct + one weight query"""
+    code = ("import datetime,fitnessdata;"
+            "fitnessdata.FitnessData(lazy=True).get_weight_data(datetime.date.today())")
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT,env.get('PYTHONPATH','')])
+    def run():
+        subprocess.check_call([sys.executable,'-c',code],env = env)
+    return run,None
+
+def binned_scenario(binsize):
+    def make(ctx):
+        fd = ctx.fitness()
+        fd.get_calorie_data()
+        def run():
+            fd.get_calorie_data(binsize = binsize)
+            fd.get_weight_data(binsize = binsize,how = 'mean')
+            fd.get_run_data(binsize = binsize)
+        return run,None
+    return make
+
+for binsize in (1,7,30,'week','month'):
+    scenario('binned.%s'%binsize)(binned_scenario(binsize))
+
+def point_scenario(getter):
+    def make(ctx):
+        fd = ctx.fitness()
+        dates = [ctx.today - datetime.timedelta(days = 3 * i) for i in range(100)]
+        def run():
+            method = getattr(fd,getter)
+            for date in dates:
+                method(date)
+        return run,None
+    return make
+
+for getter in ('get_calorie_data','get_weight_data','get_run_data'):
+    scenario('query.%s.point100'%getter)(point_scenario(getter))
+
+@scenario('query.lookup.batch1000')
+def lookup_batch(ctx):
+    fd = ctx.fitness()
+    dates = ctx.today.toordinal() - np.arange(1000)
+    def run():
+        for dataset in ('calorie','weight','run'):
+            fd.lookup(dataset,dates)
+    return run,None
+
+@scenario('query.range.window')
+def range_window(ctx):
+    fd = ctx.fitness(start_date = ctx.today - datetime.timedelta(days = 180))
+    def run():
+        fd.get_calorie_data()
+        fd.get_weight_data()
+        fd.get_run_data()
+    return run,None
+
+@scenario('trend.weight_slope')
+def weight_slope(ctx):
+    fd = ctx.fitness()
+    def run():
+        fd.weight_slope()
+    return run,None
+
+@scenario('trend.models')
+def trend_models(ctx):
+    fd = ctx.fitness()
+    fd.weight_trend()
+    def run():
+        for model in trend.MODELS:
+            fd._weight_trend(model,28)
+    return run,None
+
+@scenario('trend.projected_date')
+def projected_date(ctx):
+    fd = ctx.fitness()
+    def run():
+        fd.projected_date(fd.weight_from_BMI(25.))
+        fd.projected_weight(ctx.today + datetime.timedelta(days = 90))
+    return run,None
+
+@scenario('frame.build')
+def frame_build(ctx):
+    fd = ctx.fitness()
+    fd.daily_frame()
+    def run():
+        fd._daily_frame('interpolate')
+    return run,None
+
+@scenario('frame.energy_balance')
+def energy_balance(ctx):
+    frame = ctx.fitness().daily_frame()
+    def run():
+        frame.calorie_deficit(7)
+        frame.implied_tdee(28)
+        frame.run_weight_correlation('week')
+    return run,None
+
+@scenario('trend.bootstrap')
+def trend_bootstrap(ctx):
+    fd = ctx.fitness()
+    fd.weight_trend()
+    def run():
+        #No seed, so nothing is cached
+        fd.projected_date_interval([fd.weight_from_BMI(25.),fd.weight_from_BMI(30.)])
+    return run,None
+
+@scenario('runs.analytics')
+def run_analytics(ctx):
+    fd = ctx.fitness()
+    fd.get_run_data()
+    def run():
+        analytics = runs.RunAnalytics(fd._rundate,fd._rundist,fd._runtime)
+        analytics.totals('week')
+        analytics.pace_percentiles('month')
+        analytics.load()
+        analytics.personal_records()
+    return run,None
+
+@scenario('charts.dashboard',repeat = 3)
+def charts_dashboard(ctx):
+    fd = ctx.fitness()
+    out = os.path.join(ctx.workdir,'charts')
+    def run():
+        fd.plot_dashboard(out)
+    return run,None
+
+@scenario('batch.roster',repeat = 3)
+def batch_roster(ctx):
+    roster = os.path.join(ctx.workdir,'roster')
+    dbdir = os.path.dirname(fitnessdata.DB_CAL)
+    profiles = []
+    for i in range(8):
+        datadir = os.path.join(roster,'p%d'%i)
+        shutil.copytree(os.path.join(ctx.workdir,dbdir),os.path.join(datadir,dbdir))
+        profiles.append(batch.Profile('p%d'%i,datadir))
+    def run():
+        batch.run_batch(profiles,cls = BenchFitnessData)
+    return run,None
+
+def migrated(ctx):
+    """The synthetic db copied into SQLite (once per context)"""
+    if not os.path.isfile(os.path.join(ctx.workdir,sqlstore.SQLITE_DB)):
+        sqlstore.migrate(ctx.workdir,fitnessdata.DB_COLUMNS,{fitnessdata.DB_RUN:fitnessdata.RUN_IDS})
+    return ctx.workdir
+
+@scenario('storage.migrate',repeat = 3)
+def storage_migrate(ctx):
+    def run():
+        sqlstore.migrate(ctx.workdir,fitnessdata.DB_COLUMNS,{fitnessdata.DB_RUN:fitnessdata.RUN_IDS})
+    return run,None
+
+def storage_scenarios(kind):
+    def full_load(ctx):
+        """Every table loaded (column stores already converted)"""
+        datadir = migrated(ctx)
+        ctx.fitness(storage = kind,datadir = datadir).get_calorie_data()
+        def run():
+            fd = ctx.fitness(storage = kind,datadir = datadir)
+            fd.get_calorie_data()
+            fd.get_weight_data()
+            fd.get_run_data()
+        return run,None
+    def window(ctx):
+        """Cold 30-day window of every table by a fresh object"""
+        datadir = migrated(ctx)
+        start = ctx.today - datetime.timedelta(days = 30)
+        def run():
+            fd = ctx.fitness(storage = kind,datadir = datadir,start_date = start)
+            fd.get_calorie_data()
+            fd.get_weight_data()
+            fd.get_run_data()
+        return run,None
+    def upsert(ctx):
+        """Rewrite the last 30 calorie days one line at a time, in a
+        copy of the db (text appends duplicate days, sqlite replaces)"""
+        dbdir = os.path.dirname(fitnessdata.DB_CAL)
+        source = os.path.join(migrated(ctx),dbdir)
+        datadir = os.path.join(ctx.workdir,'upsert')
+        fd = ctx.fitness(storage = kind,datadir = ctx.workdir)
+        dates,cals,goal = fd.get_calorie_data()
+        tail = [(datetime.date.fromordinal(int(d)),int(c),int(g)) for d,c,g in
+                zip(binning.to_ordinals(dates[-30:]),np.ma.filled(cals[-30:],-1),np.ma.filled(goal[-30:],-1))]
+        def reset():
+            shutil.rmtree(datadir,ignore_errors = True)
+            shutil.copytree(source,os.path.join(datadir,dbdir))
+        def run():
+            store = ctx.fitness(storage = kind,datadir = datadir).storage
+            with store.writer(fitnessdata.DB_CAL) as writer:
+                for day,c,g in tail:
+                    writer.write("%s,%d,%d,1\n"%(day,c,g))
+                    writer.flush()
+        return run,reset
+    scenario('storage.%s.full_load'%kind,repeat = 3)(full_load)
+    scenario('storage.%s.window_30d'%kind)(window)
+    scenario('storage.%s.upsert_30d'%kind,repeat = 3)(upsert)
+
+for kind in ('text','sqlite'):
+    storage_scenarios(kind)
+
+def recent_runs(ctx,days):
+    """(id, date) of the fake strava runs of the last 'days' days"""
+    client = fakes.FakeStravaClient(created_at = datetime.datetime.combine(
+        ctx.today - datetime.timedelta(days = days),datetime.time(0,0,0)))
+    return client,[(act.id,act.start_date_local.date()) for act in client.get_activities() if act.type == 'Run']
+
+@scenario('streams.ingest',repeat = 3)
+def streams_ingest(ctx):
+    """Fetch and archive 30 days of run streams"""
+    client,acts = recent_runs(ctx,30)
+    path = os.path.join(ctx.workdir,'streams.ingest')
+    def reset():
+        shutil.rmtree(path,ignore_errors = True)
+    def run():
+        streams.ingest(client,acts,streams.StreamArchive(path))
+    return run,reset
+
+@scenario('streams.analyze',repeat = 3)
+def streams_analyze(ctx):
+    """Splits, best efforts and zones over a year of archived runs"""
+    client,acts = recent_runs(ctx,365)
+    archive = streams.StreamArchive(os.path.join(ctx.workdir,'streams.analyze'))
+    streams.ingest(client,acts,archive)
+    def run():
+        streams.analyze(archive.iter_streams())
+    return run,None
+
+def sync_dir(ctx):
+    return os.path.join(ctx.workdir,'sync')
+
+@scenario('sync.update_db',repeat = 3)
+def update_db(ctx):
+    """Update a db that is 30 days stale"""
+    stale = os.path.join(ctx.workdir,'stale')
+    generate.write_db(stale,ctx.years,end = ctx.today - datetime.timedelta(days = 30))
+    def reset():
+        shutil.rmtree(sync_dir(ctx),ignore_errors = True)
+        shutil.copytree(stale,sync_dir(ctx))
+    def run():
+        os.chdir(sync_dir(ctx))
+        try:
+            BenchFitnessData.latency = ctx.latency
+            BenchFitnessData(lazy = True).sync()
+        finally:
+            os.chdir(ctx.workdir)
+    return run,reset
+
+def pipeline_scenario(concurrent):
+    def make(ctx):
+        """Update a db that is 30 days stale with 20 ms per request and
+        200 ms per login"""
+        stale = os.path.join(ctx.workdir,'stale.pipeline')
+        if not os.path.isdir(stale):
+            generate.write_db(stale,ctx.years,end = ctx.today - datetime.timedelta(days = 30))
+        def reset():
+            shutil.rmtree(sync_dir(ctx),ignore_errors = True)
+            shutil.copytree(stale,sync_dir(ctx))
+        def run():
+            settings = fitnessdata.SYNC_CONCURRENT,BenchFitnessData.latency,BenchFitnessData.login_latency
+            fitnessdata.SYNC_CONCURRENT = concurrent
+            BenchFitnessData.latency,BenchFitnessData.login_latency = 0.02,0.2
+            try:
+                BenchFitnessData(lazy = True,datadir = sync_dir(ctx)).sync()
+            finally:
+                fitnessdata.SYNC_CONCURRENT,BenchFitnessData.latency,BenchFitnessData.login_latency = settings
+        return run,reset
+    return make
+
+scenario('sync.latency.serial',repeat = 3)(pipeline_scenario(False))
+scenario('sync.latency.pipelined',repeat = 3)(pipeline_scenario(True))
+
+@scenario('sync.backfill',repeat = 3)
+def backfill(ctx):
+    """Backfill a db with 2% missing and 5% unlogged days"""
+    gappy = os.path.join(ctx.workdir,'gappy')
+    generate.write_db(gappy,ctx.years,gap_rate = 0.02,unlogged_rate = 0.05)
+    def reset():
+        shutil.rmtree(sync_dir(ctx),ignore_errors = True)
+        shutil.copytree(gappy,sync_dir(ctx))
+    def run():
+        os.chdir(sync_dir(ctx))
+        try:
+            BenchFitnessData.latency = ctx.latency
+            BenchFitnessData(lazy = True).backfill()
+        finally:
+            os.chdir(ctx.workdir)
+    return run,reset
+
+@scenario('sync.init_db',repeat = 1)
+def init_db(ctx):
+    """Initialize a db of ctx.years years from scratch"""
+    def reset():
+        shutil.rmtree(sync_dir(ctx),ignore_errors = True)
+        os.makedirs(os.path.join(sync_dir(ctx),os.path.dirname(fitnessdata.DB_CAL)))
+    def run():
+        os.chdir(sync_dir(ctx))
+        try:
+            BenchFitnessData.latency = ctx.latency
+            BenchFitnessData.init_start = ctx.today - datetime.timedelta(days = int(365.25 * ctx.years))
+            BenchFitnessData(lazy = True).sync()
+        finally:
+            os.chdir(ctx.workdir)
+    return run,reset
+
+def time_scenario(run,reset = None,repeat = 5):
+    """Seconds taken by each repeat"""
+    times = []
+    for i in range(repeat):
+        if reset:
+            reset()
+        start = timeit.default_timer()
+        run()
+        times.append(timeit.default_timer() - start)
+    return times
+
+def metadata():
+    return {'python':platform.python_version(),'numpy':np.__version__,
+            'platform':platform.platform(),'date':datetime.datetime.now().isoformat()}
+
+def run_all(years = (1,10,30),repeat = 5,latency = 0.,select = None,verbose = True,
+            responses = None,response_mode = 'off'):
+    """Run every scenario (matching the glob patterns in 'select') for
+    each history length. Returns the JSON-ready result dict. The sync
+    scenarios go through the response cache in 'responses' if given
+    (response_mode 'replay' runs them on recorded responses)."""
+    results = {}
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    fetch_rate = fitnessdata.FETCH_RATE,fitnessdata.STREAM_RATE
+    response_settings = fitnessdata.RESPONSE_MODE,fitnessdata.RESPONSE_CACHE
+    devnull = open(os.devnull,'w')
+    #The fakes do not need throttling
+    fitnessdata.FETCH_RATE = fitnessdata.STREAM_RATE = 0
+    fitnessdata.RESPONSE_MODE = response_mode if responses else 'off'
+    if responses:
+        fitnessdata.RESPONSE_CACHE = os.path.abspath(responses)
+    try:
+        for nyears in years:
+            workdir = tempfile.mkdtemp(prefix = 'fitbench')
+            try:
+                generate.write_db(workdir,nyears)
+                os.chdir(workdir)
+                ctx = Context(workdir,nyears,latency)
+                for name,make,max_repeat in SCENARIOS:
+                    if select and not any(fnmatch.fnmatch(name,pat) for pat in select):
+                        continue
+                    key = '%s[%gy]'%(name,nyears)
+                    sys.stdout = devnull
+                    try:
+                        run,reset = make(ctx)
+                        times = time_scenario(run,reset,min(repeat,max_repeat or repeat))
+                    finally:
+                        sys.stdout = stdout
+                    results[key] = {'min':min(times),'median':float(np.median(times)),
+                                    'repeat':len(times),'years':nyears}
+                    if verbose:
+                        print "%-45s %10.6f s"%(key,results[key]['median'])
+            finally:
+                os.chdir(cwd)
+                shutil.rmtree(workdir,ignore_errors = True)
+    finally:
+        fitnessdata.FETCH_RATE,fitnessdata.STREAM_RATE = fetch_rate
+        fitnessdata.RESPONSE_MODE,fitnessdata.RESPONSE_CACHE = response_settings
+        devnull.close()
+    return {'meta':metadata(),'results':results}
+
+def compare(old,new,threshold = 1.25):
+    """Print median times side by side. Returns the keys that got slower
+    by more than 'threshold' times."""
+    regressions = []
+    print "%-45s %12s %12s %7s"%('scenario','old (s)','new (s)','ratio')
+    for key in sorted(set(old['results']) & set(new['results'])):
+        a = old['results'][key]['median']
+        b = new['results'][key]['median']
+        ratio = b / a if a else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions.append(key)
+            flag = '  SLOWER'
+        print "%-45s %12.6f %12.6f %7.2f%s"%(key,a,b,ratio,flag)
+    return regressions
+
+def save(result,fname):
+    with open(fname,'w') as f:
+        json.dump(result,f,indent = 1,sort_keys = True)
+
+def load(fname):
+    with open(fname) as f:
+        return json.load(f)
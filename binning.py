@@ -0,0 +1,133 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Vectorized binning engine for dated data.
+
+Dates are turned into integer day ordinals (datetime.date.toordinal)
+once, every point is assigned a bin index with integer arithmetic (a
+floor for fractional bin widths) and the bins are reduced with bincount/reduceat. The cost is O(n + bins)
+instead of one boolean scan over the dates per bin.
+"""
+
+import datetime
+import numpy as np
+
+#Day ordinal of the numpy datetime64 epoch
+EPOCH_ORD = datetime.date(1970,1,1).toordinal()
+
+#Bins that follow the calendar instead of a fixed width
+CALENDAR_BINS = ('week','month')
+
+#Reductions that can be applied to each bin
+AGGREGATIONS = ('sum','mean','min','max','count')
+
+def to_ordinals(dates):
+    """Turn dates (date objects, datetime64 or ordinals) into int64 ordinals"""
+    dates = np.asarray(dates)
+    if dates.dtype.kind in 'iu':
+        return dates.astype(np.int64)
+    if dates.dtype.kind == 'M':
+        return dates.astype('M8[D]').astype(np.int64) + EPOCH_ORD
+    return np.fromiter((d.toordinal() for d in dates.ravel()),
+                       dtype = np.int64,count = dates.size).reshape(dates.shape)
+
+def to_dates(ordinals):
+    """Turn day ordinals back into an object array of datetime.date"""
+    ords = np.asarray(ordinals,dtype = np.int64)
+    return (ords - EPOCH_ORD).astype('M8[D]').astype(object)
+
+def valid_binsize(binsize):
+    """True if binsize is a calendar bin name or a number >= 1"""
+    if binsize in CALENDAR_BINS:
+        return True
+    try:
+        return float(binsize) >= 1
+    except (TypeError,ValueError):
+        return False
+
+def bin_index(ords,binsize):
+    """Assign each ordinal to a bin.
+
+    Fixed width bins are centered on min(ords) + k * binsize (the same
+    centers binned has always used), fractional widths on the day that
+    center falls in. 'week' bins start on Mondays and
+    'month' bins on the first of the month. Returns (index, labels)
+    where labels are the ordinals of the bin centers/starts."""
+    ords = np.asarray(ords,dtype = np.int64)
+    if binsize == 'week':
+        #Ordinal 1 (0001-01-01) is a Monday
+        period = (ords - 1) // 7
+        first = period.min()
+        idx = period - first
+        labels = (first + np.arange(idx.max() + 1)) * 7 + 1
+        return idx,labels
+    if binsize == 'month':
+        period = (ords - EPOCH_ORD).astype('M8[D]').astype('M8[M]').astype(np.int64)
+        first = period.min()
+        idx = period - first
+        months = (first + np.arange(idx.max() + 1)).astype('M8[M]')
+        labels = months.astype('M8[D]').astype(np.int64) + EPOCH_ORD
+        return idx,labels
+
+    width = float(binsize)
+    if width < 1:
+        raise ValueError("Binsize must be >= 1.")
+    origin = ords.min()
+    span = ords.max() - origin
+    if width == int(width):
+        width = int(width)
+        idx = (ords - origin + width // 2) // width
+    else:
+        #Fractional widths: centers fall on the day they are in
+        idx = np.floor((ords - origin) / width + 0.5).astype(np.int64)
+    nbins = max(int(np.ceil((span + width) / float(width))),idx.max() + 1)
+    labels = origin + np.floor(width * np.arange(nbins)).astype(np.int64)
+    return idx,labels
+
+def reduce_bins(idx,values,nbins,how = 'sum'):
+    """Reduce values into nbins bins given each value's bin index.
+
+    Masked values are ignored. 'sum' and 'count' of an unmasked input
+    are plain arrays (empty bins are 0); everything else comes back as
+    a masked array with the empty bins masked."""
+    if how not in AGGREGATIONS:
+        raise ValueError("Unknown aggregation '%s'."%how)
+    idx = np.asarray(idx,dtype = np.int64)
+    was_masked = np.ma.isMaskedArray(values)
+    valid = ~np.ma.getmaskarray(values)
+    data = np.ma.getdata(values).astype(np.float64)
+    if not valid.all():
+        idx = idx[valid]
+        data = data[valid]
+
+    count = np.bincount(idx,minlength = nbins)
+    empty = count == 0
+    if how == 'count':
+        return count
+    if how in ('sum','mean'):
+        out = np.bincount(idx,weights = data,minlength = nbins)
+        if how == 'mean':
+            out[~empty] /= count[~empty]
+    else:
+        out = np.zeros(nbins)
+        if idx.size:
+            #reduceat wants the bins in contiguous runs
+            if np.any(idx[1:] < idx[:-1]):
+                order = np.argsort(idx,kind = 'mergesort')
+                idx = idx[order]
+                data = data[order]
+            starts = np.flatnonzero(np.r_[True,idx[1:] != idx[:-1]])
+            ufunc = np.minimum if how == 'min' else np.maximum
+            out[idx[starts]] = ufunc.reduceat(data,starts)
+
+    if how == 'sum' and not was_masked:
+        return out
+    return np.ma.masked_array(out,mask = empty)
+
+def bin_ordinals(ords,values,binsize,how = 'sum'):
+    """Bin values by their day ordinals. Returns (label ordinals, values)"""
+    ords = np.asarray(ords,dtype = np.int64)
+    if not ords.size:
+        return np.zeros(0,dtype = np.int64),np.zeros(0)
+    idx,labels = bin_index(ords,binsize)
+    return labels,reduce_bins(idx,values,labels.size,how)
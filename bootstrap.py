@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo uncertainty of the least-squares weight trend.
+
+The trend line through the weigh-ins is refit for thousands of
+resampled residual sets at once, giving a sample of (level, slope)
+pairs from which percentile bands of projected weights and dates are
+read off. Every refit is linear in the resampled residuals, so a whole
+batch is one array operation:
+
+    wild      each residual (or block of 'block' consecutive ones) is
+              kept or flipped in sign at random. Eight signs are one
+              random byte, and a table of the 256 possible sums per
+              eight residuals turns a refit into n / 8 lookups.
+    residual  classic bootstrap, residuals (or blocks of them) drawn
+              with replacement. Costs n draws per resample, done in
+              chunks of at most CHUNK values.
+
+All randomness comes from np.random.RandomState(seed).
+"""
+
+import numpy as np
+
+METHODS = ('wild','residual')
+
+#Number of resamples unless told otherwise
+RESAMPLES = 10000
+
+#Largest number of values drawn at once by the residual method
+CHUNK = 1 << 21
+
+#Sign (+1/-1) of each of the 8 bits of every byte value
+_SIGNS = 2 * ((np.arange(256)[:,None] >> np.arange(8)) & 1) - 1.
+
+def lsq(x,y):
+    """Least-squares line through (x, y). Returns (level at x = 0, slope,
+    residuals, weights) where the weights turn resampled residuals into
+    changes of the level and the slope (rows 0 and 1)."""
+    x = np.asarray(x,dtype = np.float64)
+    y = np.asarray(y,dtype = np.float64)
+    n = x.size
+    xm = x.mean()
+    xc = x - xm
+    sxx = np.dot(xc,xc)
+    slope = np.dot(xc,y - y.mean()) / sxx
+    level = y.mean() - slope * xm
+    resid = y - level - slope * x
+    weights = np.vstack((1. / n - xm * xc / sxx,xc / sxx))
+    return level,slope,resid,weights
+
+def _chunks(total,size):
+    for start in range(0,total,size):
+        yield start,min(total,start + size)
+
+def wild(x,y,resamples = RESAMPLES,rng = None,block = 1):
+    """Wild (Rademacher) bootstrap of lsq. Returns (levels, slopes)."""
+    rng = rng or np.random.RandomState()
+    level,slope,resid,weights = lsq(x,y)
+    n = resid.size
+    #Residual i takes the sign of bit i // block
+    bit = np.arange(n) // max(int(block),1)
+    groups = bit[-1] // 8 + 1
+    out = []
+    for row in weights:
+        per_bit = np.bincount(bit,weights = row * resid,minlength = groups * 8)
+        out.append(np.dot(per_bit.reshape(groups,8),_SIGNS.T).ravel())
+    levels = np.empty(resamples)
+    slopes = np.empty(resamples)
+    offset = 256 * np.arange(groups)
+    for start,stop in _chunks(resamples,max(1,CHUNK // groups)):
+        draws = np.frombuffer(rng.bytes((stop - start) * groups),dtype = np.uint8)
+        flat = draws.reshape(stop - start,groups) + offset
+        levels[start:stop] = level + out[0].take(flat).sum(axis = 1)
+        slopes[start:stop] = slope + out[1].take(flat).sum(axis = 1)
+    return levels,slopes
+
+def residual(x,y,resamples = RESAMPLES,rng = None,block = 1):
+    """Moving-block residual bootstrap of lsq. Returns (levels, slopes)."""
+    rng = rng or np.random.RandomState()
+    level,slope,resid,weights = lsq(x,y)
+    n = resid.size
+    block = min(max(int(block),1),n)
+    nblocks = -(-n // block)
+    levels = np.empty(resamples)
+    slopes = np.empty(resamples)
+    for start,stop in _chunks(resamples,max(1,CHUNK // n)):
+        starts = rng.randint(0,n - block + 1,size = (stop - start,nblocks))
+        idx = (starts[:,:,None] + np.arange(block)).reshape(stop - start,-1)[:,:n]
+        change = np.dot(resid[idx],weights.T)
+        levels[start:stop] = level + change[:,0]
+        slopes[start:stop] = slope + change[:,1]
+    return levels,slopes
+
+def resample_fits(x,y,resamples = RESAMPLES,method = 'wild',block = 1,seed = None):
+    """Sample of (levels, slopes) of the trend line, x = 0 being the
+    point the level refers to"""
+    if method not in METHODS:
+        raise ValueError("Unknown bootstrap method '%s'."%method)
+    if np.size(x) < 3:
+        raise ValueError("Need at least 3 weigh-ins.")
+    rng = np.random.RandomState(seed)
+    if method == 'wild':
+        return wild(x,y,resamples,rng,block)
+    return residual(x,y,resamples,rng,block)
+
+def _ranked(samples,percentiles):
+    """Nearest-rank percentiles down axis 0 (copes with inf)"""
+    ranked = np.sort(samples,axis = 0)
+    rank = np.round(np.asarray(percentiles,dtype = np.float64) / 100. * (len(ranked) - 1))
+    return ranked[rank.astype(np.int64)]
+
+def weight_bands(levels,slopes,days,percentiles = (5,50,95)):
+    """Percentiles of the weight 'days' after x = 0, one row per percentile"""
+    days = np.atleast_1d(np.asarray(days,dtype = np.float64))
+    return np.percentile(levels[:,None] + slopes[:,None] * days,percentiles,axis = 0)
+
+def date_bands(levels,slopes,weights,percentiles = (5,50,95)):
+    """Percentiles of the days after x = 0 until each of 'weights' is
+    reached (inf where it is not), and the fraction of resamples that
+    reach each weight"""
+    weights = np.atleast_1d(np.asarray(weights,dtype = np.float64))
+    with np.errstate(divide = 'ignore',invalid = 'ignore'):
+        days = (weights - levels[:,None]) / slopes[:,None]
+    days[~(days >= 0)] = np.inf
+    return _ranked(days,percentiles),np.isfinite(days).mean(axis = 0)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Bounded LRU cache for derived results (binned series, slopes,
+projections). Callers build keys that include everything the result
+depends on, so stale entries are simply never asked for again and age
+out of the cache.
+"""
+
+import threading
+from collections import OrderedDict
+
+import instrument
+
+#Returned by get() on a miss
+MISSING = object()
+
+class LRUCache(object):
+    """Least recently used cache holding at most 'maxsize' entries"""
+    def __init__(self,maxsize = 128,name = 'cache'):
+        self.maxsize = maxsize
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self,key):
+        """Value stored under key, or MISSING"""
+        with self._lock:
+            value = self._data.pop(key,MISSING)
+            if value is MISSING:
+                self.misses += 1
+                instrument.count('%s.miss'%self.name)
+            else:
+                #Reinsert as the most recently used
+                self._data[key] = value
+                self.hits += 1
+                instrument.count('%s.hit'%self.name)
+            return value
+
+    def put(self,key,value):
+        with self._lock:
+            self._data.pop(key,None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        """Hit/miss counters and size"""
+        with self._lock:
+            return {'hits':self.hits,'misses':self.misses,
+                    'size':len(self._data),'maxsize':self.maxsize}
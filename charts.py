@@ -0,0 +1,246 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Charts of the fitness data, drawn at screen resolution.
+
+Years of daily rows are many more points than a figure has pixel
+columns, so every series is downsampled to the pixel width before
+matplotlib sees it:
+
+    lttb    Largest-Triangle-Three-Buckets, keeps the shape of smooth or
+            sparse series (weigh-ins, the trend, rolling means)
+    minmax  lowest and highest point of each pixel column, keeps the
+            spikes of dense noisy series (daily calories, mileage)
+
+Drawing then costs the same for one year of data as for thirty. Charts
+are plain Chart objects holding the downsampled arrays, drawn with the
+Agg canvas (no pyplot, no display); a dashboard renders them in a
+process pool, one figure per task.
+
+matplotlib is imported where the charts are drawn.
+"""
+
+import datetime
+import multiprocessing
+import os
+
+import numpy as np
+
+import binning
+import dailyframe
+import instrument
+import runs
+
+#Figure size (inches) and resolution
+WIDTH = 10.
+HEIGHT = 4.
+DPI = 100
+
+#Charts of the dashboard
+CHARTS = ('weight','calories','mileage')
+
+def lttb(x,y,n):
+    """Indices of the n points Largest-Triangle-Three-Buckets keeps
+    (all of them if there are no more than n). x must be sorted."""
+    x = np.asarray(x,dtype = np.float64)
+    y = np.asarray(y,dtype = np.float64)
+    size = x.size
+    if n >= size or n < 3:
+        return np.arange(size)
+    #n - 2 buckets between the first and the last point
+    edges = (np.arange(n - 1) * ((size - 2) / float(n - 2))).astype(np.int64) + 1
+    edges[-1] = size - 1
+    counts = np.diff(edges)
+    #Mean point of every bucket, the last point after the last bucket
+    cx = np.r_[np.add.reduceat(x[:-1],edges[:-1]) / counts,x[-1]][1:]
+    cy = np.r_[np.add.reduceat(y[:-1],edges[:-1]) / counts,y[-1]][1:]
+    #Bucket members as rows, short buckets padded with their last point
+    idx = np.minimum(edges[:-1,None] + np.arange(counts.max()),edges[1:,None] - 1)
+    bx = x[idx]
+    by = y[idx]
+    #Twice the triangle area is |c0 + ax * c1 + ay * c2| for the point
+    #(ax, ay) kept from the previous bucket
+    c0 = bx * cy[:,None] - cx[:,None] * by
+    c1 = by - cy[:,None]
+    c2 = cx[:,None] - bx
+    keep = np.empty(n,dtype = np.int64)
+    keep[0] = 0
+    keep[-1] = size - 1
+    ax,ay = x[0],y[0]
+    for i in range(n - 2):
+        k = idx[i,np.abs(c0[i] + ax * c1[i] + ay * c2[i]).argmax()]
+        keep[i + 1] = k
+        ax,ay = x[k],y[k]
+    return keep
+
+def minmax(x,y,n):
+    """Indices of the lowest and highest point in each of n equal width
+    x buckets, in x order (all of them if there are no more than 2n).
+    x must be sorted."""
+    x = np.asarray(x,dtype = np.float64)
+    y = np.asarray(y,dtype = np.float64)
+    size = x.size
+    if 2 * n >= size:
+        return np.arange(size)
+    span = x[-1] - x[0]
+    if span > 0:
+        bucket = np.minimum(((x - x[0]) * (n / span)).astype(np.int64),n - 1)
+    else:
+        bucket = np.zeros(size,dtype = np.int64)
+    order = np.lexsort((y,bucket))
+    sorted_bucket = bucket[order]
+    first = np.flatnonzero(np.r_[True,sorted_bucket[1:] != sorted_bucket[:-1]])
+    last = np.r_[first[1:] - 1,size - 1]
+    return np.unique(np.r_[0,order[first],order[last],size - 1])
+
+class Chart(object):
+    """A figure to draw: series of (kind, day ordinals, values, label,
+    matplotlib style), kind being 'line', 'points' or 'step' (filled)"""
+    def __init__(self,name,title,ylabel,width = WIDTH,height = HEIGHT,dpi = DPI):
+        self.name = name
+        self.title = title
+        self.ylabel = ylabel
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.series = []
+
+    @property
+    def pixels(self):
+        """Width of the figure in pixels"""
+        return int(self.width * self.dpi)
+
+    def add(self,kind,x,y,label = None,**style):
+        if kind not in ('line','points','step'):
+            raise ValueError("Unknown series kind '%s'."%kind)
+        self.series.append((kind,np.asarray(x),np.asarray(y),label,style))
+
+    def __len__(self):
+        """Number of points to draw"""
+        return sum(series[1].size for series in self.series)
+
+def _valid(ords,values):
+    """Ordinals and float values without the masked and NaN ones"""
+    values = np.ma.masked_invalid(np.ma.asarray(values,dtype = np.float64))
+    keep = ~np.ma.getmaskarray(values)
+    return np.asarray(ords)[keep],np.ma.getdata(values)[keep]
+
+def weight_chart(fitness,model = None,window = None,**size):
+    """Weigh-ins and the weight trend"""
+    chart = Chart('weight','Weight','lbs',**size)
+    #Several weigh-ins on a day are averaged, days without one are masked
+    dates,wt = fitness.get_weight_data(how = 'mean')
+    if dates is not None:
+        ords,wt = _valid(binning.to_ordinals(dates),wt)
+        keep = lttb(ords,wt,chart.pixels)
+        chart.add('points',ords[keep],wt[keep],'weigh-ins',markersize = 3,color = '0.6')
+    dates,level,slope = fitness.weight_trend(model,window)
+    if dates is not None:
+        ords,level = _valid(binning.to_ordinals(dates),level)
+        keep = lttb(ords,level,chart.pixels)
+        chart.add('line',ords[keep],level[keep],'trend',color = 'C0')
+    return chart
+
+def calorie_chart(fitness,smooth = 7,**size):
+    """Daily calories against the goal, and their 'smooth'-day mean"""
+    chart = Chart('calories','Calories','kcal',**size)
+    dates,cals,goal = fitness.get_calorie_data()
+    if dates is not None:
+        ords = binning.to_ordinals(dates)
+        x,y = _valid(ords,cals)
+        keep = minmax(x,y,chart.pixels)
+        chart.add('line',x[keep],y[keep],'eaten',color = '0.6',linewidth = 0.5)
+        x,y = _valid(ords,goal)
+        keep = minmax(x,y,chart.pixels)
+        chart.add('line',x[keep],y[keep],'goal',color = 'C3',drawstyle = 'steps-post')
+        x,y = _valid(ords,dailyframe.rolling_mean(np.ma.filled(np.ma.asarray(cals,dtype = np.float64),np.nan),smooth))
+        keep = lttb(x,y,chart.pixels)
+        chart.add('line',x[keep],y[keep],'%d-day mean'%smooth,color = 'C0')
+    return chart
+
+def mileage_chart(fitness,**size):
+    """Miles run per ISO week, the weeks overlapping the start/stop window"""
+    chart = Chart('mileage','Weekly mileage','miles',**size)
+    weeks,dist,time,count = fitness.run_analytics().totals('week')
+    keep = np.ones(weeks.size,dtype = bool)
+    if fitness.start_date != None:
+        keep &= weeks + 6 >= fitness.start_date.toordinal()
+    if fitness.stop_date != None:
+        keep &= weeks <= fitness.stop_date.toordinal()
+    weeks,dist = weeks[keep],dist[keep]
+    if weeks.size:
+        miles = dist / runs.METERS_PER_MILE
+        keep = minmax(weeks,miles,chart.pixels)
+        chart.add('step',weeks[keep],miles[keep],color = 'C2')
+    return chart
+
+BUILDERS = {'weight':weight_chart,'calories':calorie_chart,'mileage':mileage_chart}
+
+def _import_backend():
+    """Agg canvas, Figure and matplotlib.dates"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    import matplotlib.dates as mdates
+    return FigureCanvasAgg,Figure,mdates
+
+def render(chart,path):
+    """Draw a chart into an image file (format from the extension)"""
+    FigureCanvasAgg,Figure,mdates = _import_backend()
+    fig = Figure(figsize = (chart.width,chart.height),dpi = chart.dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    #Day ordinals to matplotlib date numbers
+    offset = mdates.date2num(datetime.date(1970,1,1)) - binning.EPOCH_ORD
+    for kind,x,y,label,style in chart.series:
+        x = x + offset
+        if kind == 'points':
+            ax.plot(x,y,'.',label = label,**style)
+        elif kind == 'step':
+            ax.fill_between(x,y,step = 'post',label = label,**style)
+        else:
+            ax.plot(x,y,label = label,**style)
+    ax.xaxis_date()
+    ax.set_title(chart.title)
+    ax.set_ylabel(chart.ylabel)
+    if any(series[3] for series in chart.series):
+        #A fixed corner, 'best' searches every point
+        ax.legend(loc = 'upper right')
+    fig.autofmt_xdate()
+    fig.savefig(path)
+    return path
+
+def _render_task(task):
+    return render(*task)
+
+@instrument.timed('charts.render')
+def render_all(charts,directory = 'charts',fmt = 'png',processes = None):
+    """Render charts into 'directory' as <name>.<fmt>, in a pool of
+    'processes' worker processes (default one per chart up to the CPU
+    count; 1 draws in this process). Returns {name: path}."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tasks = [(chart,os.path.join(directory,'%s.%s'%(chart.name,fmt))) for chart in charts]
+    if processes == None:
+        processes = min(len(tasks),multiprocessing.cpu_count())
+    #Import matplotlib before forking so the workers start with it
+    _import_backend()
+    if processes <= 1 or len(tasks) <= 1:
+        paths = [render(*task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            paths = pool.map(_render_task,tasks)
+        finally:
+            pool.close()
+            pool.join()
+    instrument.count('charts.rendered',len(tasks))
+    return dict((chart.name,path) for chart,path in zip(charts,paths))
+
+def dashboard(fitness,directory = 'charts',charts = CHARTS,fmt = 'png',processes = None,**size):
+    """Build the named charts from 'fitness' and render them (see
+    render_all). Returns {name: path}."""
+    for name in charts:
+        if name not in BUILDERS:
+            raise ValueError("Unknown chart '%s'."%name)
+    built = [BUILDERS[name](fitness,**size) for name in charts]
+    return render_all(built,directory,fmt,processes)
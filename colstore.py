@@ -0,0 +1,301 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Binary columnar store for the db/*.dat files.
+
+Each text db file gets a sibling directory (db/mfpcl.dat -> db/mfpcl.col)
+holding one raw little-endian file per column and a small JSON header
+with the format version, the number of committed rows, the size of
+the text file the store was built from and the generation of the
+column files. Columns are opened with np.memmap, so loading is close to
+zero-copy no matter how long the history is. The header is rewritten
+(atomically) after the column data, so a crash mid-append never exposes
+partial rows.
+
+Column files are only ever appended to. A rebuild (create, convert)
+writes a new generation of them (<name>.<generation>.bin) and switches
+the header over, so other processes keep reading the files they mapped;
+generations older than the previous one are then removed.
+
+Usage: python colstore.py [db files]   (one-shot conversion from text)
+"""
+
+import json
+import os
+import numpy as np
+
+import binning
+import instrument
+
+#Bump when the on-disk layout changes. Stores with another version are rebuilt.
+STORE_VERSION = 2
+STORE_EXT = '.col'
+HEADER = 'header.json'
+
+def store_path(fname):
+    """Directory of the column store belonging to a text db file"""
+    return os.path.splitext(fname)[0] + STORE_EXT
+
+def infer_columns(fname):
+    """Default layout for a db file we have no schema for: date + floats"""
+    with open(fname) as f:
+        for line in f:
+            if line.strip():
+                ncols = len(line.split(','))
+                return [('date','<i4')] + [('c%d'%i,'<f8') for i in range(1,ncols)]
+    return [('date','<i4')]
+
+def last_line_offset(f,block = 4096):
+    """Offset where the last line of an open (binary) file starts.
+    Reads backwards from the end a block at a time."""
+    f.seek(0,2)
+    pos = f.tell()
+    tail = ''
+    while pos > 0:
+        step = min(block,pos)
+        pos -= step
+        f.seek(pos)
+        tail = f.read(step) + tail
+        #The newline ending the last line itself does not count
+        i = tail.rfind('\n',0,len(tail) - 1)
+        if i >= 0:
+            return pos + i + 1
+    return 0
+
+def parse_lines(lines,columns):
+    """Parse db text lines into a list of typed column arrays.
+    Lines with the wrong number of fields are skipped."""
+    ncols = len(columns)
+    rows = [l.strip().split(',') for l in lines]
+    rows = [r for r in rows if len(r) == ncols]
+    if rows:
+        fields = zip(*rows)
+    else:
+        fields = [()] * ncols
+    instrument.count('rows_parsed',len(rows))
+    cols = []
+    for (name,dtype),field in zip(columns,fields):
+        if name == 'date':
+            #Some rows carry a time as well, the first 10 chars are the date
+            days = np.array(field,dtype = 'S10').astype('M8[D]')
+            col = binning.to_ordinals(days)
+        else:
+            col = np.array(field,dtype = 'S32').astype(np.float64)
+        cols.append(col.astype(dtype))
+    return cols
+
+class ColumnStore(object):
+    """One raw file per column plus a JSON header"""
+    def __init__(self,path,columns):
+        self.path = path
+        self.columns = [(name,np.dtype(dtype)) for name,dtype in columns]
+        self._header = None
+
+    def _colfile(self,name,generation = None):
+        if generation == None:
+            generation = self.generation
+        return os.path.join(self.path,'%s.%d.bin'%(name,generation))
+
+    @property
+    def header(self):
+        """Cached header dict (None if there is no valid store)"""
+        if self._header == None:
+            self._header = self.read_header()
+        return self._header
+
+    def read_header(self):
+        """Read the header from disk"""
+        fname = os.path.join(self.path,HEADER)
+        if not os.path.isfile(fname):
+            return None
+        try:
+            with open(fname) as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def write_header(self,rows,src_size,generation = None):
+        """Atomically replace the header"""
+        if generation == None:
+            generation = self.generation
+        header = {'version':STORE_VERSION,'rows':int(rows),'src_size':int(src_size),
+                  'generation':int(generation),
+                  'columns':[[name,dtype.str] for name,dtype in self.columns]}
+        fname = os.path.join(self.path,HEADER)
+        with open(fname + '.tmp','w') as f:
+            json.dump(header,f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(fname + '.tmp',fname)
+        self._header = header
+
+    def is_current(self):
+        """True if the store exists and has the layout we expect"""
+        header = self.header
+        if not header or header.get('version') != STORE_VERSION:
+            return False
+        expected = [[name,dtype.str] for name,dtype in self.columns]
+        if header.get('columns') != expected:
+            return False
+        for name,dtype in self.columns:
+            fname = self._colfile(name)
+            if not os.path.isfile(fname) or os.path.getsize(fname) < header['rows'] * dtype.itemsize:
+                return False
+        return True
+
+    @property
+    def nrows(self):
+        return self.header['rows'] if self.header else 0
+
+    @property
+    def src_size(self):
+        return self.header['src_size'] if self.header else -1
+
+    @property
+    def generation(self):
+        return self.header.get('generation',0) if self.header else 0
+
+    def create(self,src_size = 0):
+        """(Re)create an empty store"""
+        return self.rebuild([np.zeros(0,dtype = dtype) for name,dtype in self.columns],src_size)
+
+    def rebuild(self,cols,src_size):
+        """Replace the whole store by 'cols' (one array per column). The
+        columns go to new files, then the header switches to them: a
+        reader that mapped the old files keeps them, they are never
+        truncated."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        header = self.read_header()
+        generation = header.get('generation',-1) + 1 if header else 0
+        nrows = len(cols[0]) if cols else 0
+        for (name,dtype),col in zip(self.columns,cols):
+            data = np.asarray(col,dtype = dtype).tostring()
+            with open(self._colfile(name,generation),'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            instrument.count('bytes_written',len(data))
+        self.write_header(nrows,src_size,generation)
+        self._remove_old(generation - 1)
+        return nrows
+
+    def _remove_old(self,keep):
+        """Remove the column files of generations before 'keep' (and of
+        older layouts). Maps of them stay valid."""
+        for entry in os.listdir(self.path):
+            split = entry.split('.')
+            if split[-1] != 'bin':
+                continue
+            if len(split) == 3 and split[1].isdigit() and int(split[1]) >= keep:
+                continue
+            try:
+                os.remove(os.path.join(self.path,entry))
+            except OSError:
+                pass
+
+    def load(self):
+        """Map the committed rows of every column (read only)"""
+        rows = self.nrows
+        cols = []
+        for name,dtype in self.columns:
+            if rows:
+                col = np.memmap(self._colfile(name),dtype = dtype,mode = 'r',shape = (rows,))
+            else:
+                col = np.zeros(0,dtype = dtype)
+            cols.append(col)
+        return cols
+
+    def append(self,cols,src_size):
+        """Append columns (list of arrays, one per column) and commit them.
+        Data is written past the committed rows, then the header is updated."""
+        rows = self.nrows
+        nnew = len(cols[0]) if cols else 0
+        for (name,dtype),col in zip(self.columns,cols):
+            data = np.asarray(col,dtype = dtype).tostring()
+            with open(self._colfile(name),'r+b') as f:
+                f.seek(rows * dtype.itemsize)
+                f.write(data)
+            instrument.count('bytes_written',len(data))
+        self.write_header(rows + nnew,src_size)
+        return nnew
+
+    def truncate(self,rows,src_size):
+        """Drop rows past 'rows'. Files never shrink, so maps stay valid."""
+        self.write_header(min(rows,self.nrows),src_size)
+
+    @instrument.timed('ColumnStore.sync')
+    def sync(self,fname):
+        """Bring the store up to date with its text file. Only the bytes
+        past src_size are parsed; anything unexpected means a rebuild.
+        Returns the number of rows added."""
+        size = os.path.getsize(fname)
+        if not self.is_current() or self.src_size > size:
+            return self.convert(fname)
+        if self.src_size == size:
+            return 0
+        with open(fname,'rb') as f:
+            f.seek(max(self.src_size - 1,0))
+            tail = f.read()
+        instrument.count('bytes_read',len(tail))
+        if self.src_size and not tail.startswith('\n'):
+            #The text was rewritten under us
+            return self.convert(fname)
+        if self.src_size:
+            tail = tail[1:]
+        #Only whole lines, a line still being written is picked up next time
+        end = tail.rfind('\n') + 1
+        if not end:
+            return 0
+        cols = parse_lines(tail[:end].splitlines(),self.columns)
+        return self.append(cols,self.src_size + end)
+
+    @instrument.timed('ColumnStore.convert')
+    def convert(self,fname):
+        """One-shot conversion of a whole text db file"""
+        with open(fname) as f:
+            text = f.read()
+        instrument.count('bytes_read',len(text))
+        return self.rebuild(parse_lines(text.splitlines(),self.columns),len(text))
+
+class DBWriter(object):
+    """Write rows to a text db file and its column store together.
+    Rows are committed to the store when the writer is closed."""
+    def __init__(self,fname,store,mode = 'a'):
+        self.fname = fname
+        self.store = store
+        if mode == 'w':
+            store.create()
+        self._lines = []
+        self._file = open(fname,mode)
+
+    def write(self,line):
+        """Write one text line ("date,value,...\\n")"""
+        self._file.write(line)
+        self._lines.append(line)
+        instrument.count('bytes_written',len(line))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        size = os.path.getsize(self.fname)
+        #Only append if the store was in sync with the text before we wrote
+        if self.store.is_current() and self.store.src_size == size - sum(len(l) for l in self._lines):
+            self.store.append(parse_lines(self._lines,self.store.columns),size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+if __name__ == '__main__':
+    import sys
+    from fitnessdata import DB_CAL,DB_WGT,DB_RUN,DB_COLUMNS
+    for fname in sys.argv[1:] or [DB_CAL,DB_WGT,DB_RUN]:
+        if os.path.isfile(fname):
+            columns = DB_COLUMNS.get(fname) or infer_columns(fname)
+            rows = ColumnStore(store_path(fname),columns).convert(fname)
+            print "%s: %d rows -> %s"%(fname,rows,store_path(fname))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Calories, weight and runs aligned on one daily calendar axis.
+
+Each dataset is scattered onto a shared day-ordinal axis in one
+vectorized step (row i of every column is day first + i), so cross
+dataset questions are plain array arithmetic instead of matching dates
+in Python. Missing values are NaN. Weights are sparse and can be
+forward filled or interpolated; days with several runs are summed.
+
+The energy-balance helpers work on a DailyFrame with cumulative sums,
+so every rolling window is O(days) whatever its width.
+"""
+
+import numpy as np
+
+import binning
+
+#Fills for the sparse weight column
+FILLS = (None,'ffill','interpolate')
+
+#Energy in a pound of body weight (kcal)
+KCAL_PER_LB = 3500.
+
+def scatter(ords,values,first,ndays,how = 'last'):
+    """Place values on the axis first .. first + ndays - 1.
+
+    how = 'sum' adds the values falling on the same day (days without
+    any are 0), 'last' keeps the last one in row order (days without
+    any are NaN). Masked values and days off the axis are dropped."""
+    idx = np.asarray(ords,dtype = np.int64) - first
+    keep = (idx >= 0) & (idx < ndays) & ~np.ma.getmaskarray(values)
+    idx = idx[keep]
+    data = np.ma.getdata(values).astype(np.float64)[keep]
+    if how == 'sum':
+        return np.bincount(idx,weights = data,minlength = ndays)
+    out = np.full(ndays,np.nan)
+    #Fancy assignment keeps the last value written to a repeated index
+    out[idx] = data
+    return out
+
+def ffill(values):
+    """Carry the last non-NaN value forward (leading NaNs stay)"""
+    valid = ~np.isnan(values)
+    last = np.where(valid,np.arange(values.size),-1)
+    np.maximum.accumulate(last,out = last)
+    out = values[np.maximum(last,0)]
+    out[last < 0] = np.nan
+    return out
+
+def interpolate(values):
+    """Linear interpolation between non-NaN values (ends are held)"""
+    valid = np.flatnonzero(~np.isnan(values))
+    if not valid.size:
+        return values.copy()
+    return np.interp(np.arange(values.size),valid,values[valid])
+
+def rolling_sum(values,window):
+    """Sum of the non-NaN values in the trailing 'window' days, and how
+    many there were. Both arrays are aligned with values."""
+    valid = ~np.isnan(values)
+    csum = np.r_[0.,np.cumsum(np.where(valid,values,0.))]
+    ccount = np.r_[0,np.cumsum(valid)]
+    lo = np.maximum(np.arange(1,values.size + 1) - window,0)
+    return csum[1:] - csum[lo],ccount[1:] - ccount[lo]
+
+def rolling_mean(values,window,min_count = 1):
+    """Mean of the non-NaN values in the trailing 'window' days (NaN
+    where there are fewer than min_count of them)"""
+    total,count = rolling_sum(values,window)
+    out = np.full(values.size,np.nan)
+    enough = count >= max(min_count,1)
+    out[enough] = total[enough] / count[enough]
+    return out
+
+def lagged_diff(values,lag):
+    """values[t] - values[t - lag] (NaN for the first 'lag' days)"""
+    out = np.full(values.size,np.nan)
+    if lag < values.size:
+        out[lag:] = values[lag:] - values[:-lag]
+    return out
+
+class DailyFrame(object):
+    """Daily columns from day ordinal 'first' on, one row per day:
+    cals, goal (NaN if not logged), weight (NaN if not weighed, unless
+    filled), run_dist, run_time (summed, 0 on rest days), runs (count)."""
+    def __init__(self,first,ndays):
+        self.first = int(first)
+        self.ords = self.first + np.arange(ndays,dtype = np.int64)
+        self.weighed = np.zeros(ndays,dtype = bool)
+        for name in ('cals','goal','weight'):
+            setattr(self,name,np.full(ndays,np.nan))
+        for name in ('run_dist','run_time','runs'):
+            setattr(self,name,np.zeros(ndays))
+
+    def __len__(self):
+        return self.ords.size
+
+    @property
+    def dates(self):
+        return binning.to_dates(self.ords)
+
+    @classmethod
+    def from_columns(cls,cal,wt,run,first = None,last = None,fill = 'interpolate'):
+        """Build a frame from the (dates, values...) columns of the three
+        datasets (cal: dates, cals, goal; wt: dates, weight; run: dates,
+        dist, time). The axis covers first .. last, by default the span
+        of all the data."""
+        if fill not in FILLS:
+            raise ValueError("Unknown fill '%s'."%fill)
+        spans = [np.asarray(c[0]) for c in (cal,wt,run) if len(c[0])]
+        if first == None:
+            first = min(s.min() for s in spans) if spans else 0
+        if last == None:
+            last = max(s.max() for s in spans) if spans else first - 1
+        frame = cls(first,max(int(last) - int(first) + 1,0))
+        n = len(frame)
+        frame.cals = scatter(cal[0],cal[1],first,n)
+        frame.goal = scatter(cal[0],cal[2],first,n)
+        weight = np.ma.masked_less_equal(np.ma.asarray(wt[1],dtype = np.float64),0)
+        frame.weight = scatter(wt[0],weight,first,n)
+        frame.weighed = ~np.isnan(frame.weight)
+        if fill == 'ffill':
+            frame.weight = ffill(frame.weight)
+        elif fill == 'interpolate':
+            frame.weight = interpolate(frame.weight)
+        frame.run_dist = scatter(run[0],run[1],first,n,'sum')
+        frame.run_time = scatter(run[0],run[2],first,n,'sum')
+        frame.runs = scatter(run[0],np.ones(len(run[0])),first,n,'sum')
+        return frame
+
+    def calorie_deficit(self,window = 7):
+        """Calories under goal summed over the trailing 'window' days
+        (logged days only), and the number of logged days in it"""
+        return rolling_sum(self.goal - self.cals,window)
+
+    def weight_change(self,window = 7,smooth = 7):
+        """Change of the 'smooth'-day mean weight over 'window' days (lbs)"""
+        return lagged_diff(rolling_mean(self.weight,smooth),window)
+
+    def implied_tdee(self,window = 28,smooth = 7,min_logged = None):
+        """Daily energy expenditure implied by intake and the weight trend
+        over the trailing 'window' days: mean intake plus the energy of
+        the weight lost per day. NaN where fewer than min_logged days
+        (default half the window) were logged."""
+        if min_logged == None:
+            min_logged = window // 2
+        intake = rolling_mean(self.cals,window,min_logged)
+        lost_per_day = -self.weight_change(window,smooth) / window
+        return intake + lost_per_day * KCAL_PER_LB
+
+    def balance(self,binsize = 'week',smooth = 7):
+        """Calorie deficit, weight change and distance run per bin.
+        Returns (label ordinals, deficit, weight change, distance); bins
+        without logged calories or without weights are masked."""
+        if not len(self):
+            empty = np.zeros(0)
+            return np.zeros(0,dtype = np.int64),empty,empty,empty
+        idx,labels = binning.bin_index(self.ords,binsize)
+        nbins = labels.size
+        deficit = binning.reduce_bins(idx,np.ma.masked_invalid(self.goal - self.cals),nbins,'sum')
+        logged = binning.reduce_bins(idx,np.ma.masked_invalid(self.cals),nbins,'count')
+        deficit = np.ma.masked_where(logged == 0,deficit)
+        #Smoothed weight at the end of each bin minus at the end of the previous one
+        trend = np.ma.masked_invalid(rolling_mean(self.weight,smooth))
+        end = binning.reduce_bins(idx,np.ma.masked_array(np.arange(len(self)),np.ma.getmaskarray(trend)),
+                                 nbins,'max')
+        at_end = np.ma.masked_array(trend.data[np.ma.getdata(end).astype(np.int64)],np.ma.getmaskarray(end))
+        change = np.ma.masked_all(nbins)
+        change[1:] = at_end[1:] - at_end[:-1]
+        dist = binning.reduce_bins(idx,self.run_dist,nbins,'sum')
+        return labels,deficit,change,dist
+
+    def run_weight_correlation(self,binsize = 'week',smooth = 7):
+        """Pearson correlation of distance run with weight change per bin
+        (NaN with fewer than 3 comparable bins), and the bin count"""
+        labels,deficit,change,dist = self.balance(binsize,smooth)
+        ok = ~np.ma.getmaskarray(change)
+        if ok.sum() < 3:
+            return np.nan,int(ok.sum())
+        return float(np.corrcoef(np.asarray(dist)[ok],np.ma.getdata(change)[ok])[0,1]),int(ok.sum())
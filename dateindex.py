@@ -0,0 +1,39 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Sorted day-ordinal index for "latest value on or before date" lookups.
+
+The index keeps the day ordinals of a dataset's valid rows in sorted
+order, so a lookup is a binary search (np.searchsorted) instead of a
+mask over the whole date array, and a batch of query dates is answered
+by one vectorized call.
+"""
+
+import numpy as np
+
+import binning
+
+class DateIndex(object):
+    """Sorted ordinals of the valid rows of a dataset"""
+    def __init__(self,dates,valid = None):
+        ords = binning.to_ordinals(dates)
+        if valid is None:
+            rows = np.arange(ords.size)
+        else:
+            rows = np.flatnonzero(valid)
+        #Stable, so rows on the same day keep their file order
+        order = np.argsort(ords[rows],kind = 'mergesort')
+        self.rows = rows[order]
+        self.ords = ords[self.rows]
+
+    def __len__(self):
+        return self.rows.size
+
+    def latest(self,query):
+        """Row of the latest valid entry on or before each query ordinal
+        (-1 where there is none). Works on scalars and arrays."""
+        query = np.asarray(query,dtype = np.int64)
+        pos = np.searchsorted(self.ords,query,side = 'right') - 1
+        if not self.rows.size:
+            return np.full(query.shape,-1,dtype = np.int64)
+        return np.where(pos >= 0,self.rows[np.maximum(pos,0)],-1)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Concurrent, rate-limited fetching of MyFitnessPal days.
+
+DayFetcher runs client.get_date over a bounded pool of threads, keeps
+the request rate under a limit shared by every thread, retries
+transient failures with exponential backoff and hands the results back
+in date order, so they can be written straight to DB_CAL.
+"""
+
+import random
+import threading
+import time
+import Queue
+
+import instrument
+
+class RateLimiter(object):
+    """Token bucket allowing 'rate' calls per second (bursts up to 'burst')"""
+    def __init__(self,rate,burst = 1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until a call is allowed"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst,self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+class DayFetcher(object):
+    """Fetch many days from a myfitnesspal client concurrently.
+
+    workers  - number of threads
+    rate     - max requests per second over all threads (0 = no limit)
+    retries  - attempts after the first failure
+    backoff  - first retry delay in seconds, doubled every attempt
+    retry_on - exception types that count as transient"""
+    def __init__(self,client,workers = 4,rate = 4.,retries = 3,backoff = 1.,retry_on = (IOError,)):
+        self.client = client
+        self.workers = max(1,int(workers))
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_on = retry_on
+
+    def fetch_day(self,date):
+        """Fetch a single day, retrying transient errors"""
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            try:
+                return self.client.get_date(date)
+            except self.retry_on:
+                if attempt >= self.retries:
+                    raise
+                instrument.count('api.retries')
+                delay = self.backoff * 2**attempt
+                time.sleep(delay * (1 + random.random() * 0.1))
+                attempt += 1
+
+    def fetch(self,dates,failures = None):
+        """Generator of (date, day) for every date, in the order given.
+        At most a few results per worker are held ahead of the consumer.
+        A day that still fails after all retries raises here, after all
+        the days before it were yielded, unless a 'failures' list is
+        given: the (date, error) is then appended to it and the day
+        skipped."""
+        dates = list(dates)
+        tasks = Queue.Queue()
+        for item in enumerate(dates):
+            tasks.put(item)
+        done = Queue.Queue()
+        slots = threading.Semaphore(self.workers * 4)
+        stop = threading.Event()
+
+        def work():
+            while not stop.is_set():
+                slots.acquire()
+                try:
+                    i,date = tasks.get_nowait()
+                except Queue.Empty:
+                    slots.release()
+                    return
+                try:
+                    done.put((i,True,self.fetch_day(date)))
+                except BaseException as e:
+                    #Hand every failure to the consumer, never die silently
+                    done.put((i,False,e))
+
+        threads = [threading.Thread(target = work) for n in range(min(self.workers,len(dates)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        results = {}
+        try:
+            for i,date in enumerate(dates):
+                while i not in results:
+                    try:
+                        j,ok,value = done.get(timeout = 0.5)
+                    except Queue.Empty:
+                        continue
+                    results[j] = (ok,value)
+                ok,value = results.pop(i)
+                if ok:
+                    yield date,value
+                elif failures == None:
+                    raise value
+                else:
+                    failures.append((date,value))
+                    instrument.count('api.failed_days')
+                slots.release()
+        finally:
+            stop.set()
+            #Unblock any worker still waiting for a slot
+            for t in threads:
+                slots.release()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Long-running query daemon keeping the db hot in memory.
+
+The daemon loads the db once and answers JSON queries over loopback
+HTTP, so report scripts and cron jobs skip the startup cost of building
+their own FitnessData. Readers are served from an immutable snapshot;
+a single writer syncs (or just refreshes) and then swaps in a new one.
+
+    python fitnessd.py --port 8765 --sync-every 3600
+
+    from fitnessd import FitnessClient
+    client = FitnessClient(port = 8765)
+    dates,wt = client.get_weight_data(binsize = 'week',how = 'mean')
+    print client.projected_date(client.weight_from_BMI(25.))
+
+Endpoints (GET unless noted, dates as YYYY-MM-DD):
+    /calorie /weight /run   date, binsize, how, start, stop
+    /weight_slope           model, window, start, stop
+    /projected_weight       date, model, window, start, stop
+    /projected_date         weight, model, window, start, stop
+    /bmi                    wt (default: latest weigh-in)
+    /weight_from_bmi        bmi
+    /stats                  request counts, snapshot rows, cache info
+    POST /sync              sync with the services, then swap snapshots
+    POST /refresh           reread rows other processes appended
+"""
+
+import argparse
+import BaseHTTPServer
+import copy
+import datetime
+import httplib
+import json
+import socket
+import SocketServer
+import threading
+import time
+#strptime imports this lazily, which is not thread safe in python 2
+import _strptime
+import urllib
+import urlparse
+
+import numpy as np
+
+import binning
+import fitnessdata
+import instrument
+import storage
+
+HOST = '127.0.0.1'
+PORT = 8765
+DATE_FMT = '%Y-%m-%d'
+
+def _default(value):
+    """json.dumps fallback for numpy values and dates"""
+    if isinstance(value,np.ma.MaskedArray):
+        data = np.ma.getdata(value).tolist()
+        mask = np.ma.getmaskarray(value).tolist()
+        return [None if m else v for v,m in zip(data,mask)]
+    if isinstance(value,np.ndarray):
+        return value.tolist()
+    if isinstance(value,np.generic):
+        return value.item()
+    if isinstance(value,(datetime.date,datetime.datetime)):
+        return value.strftime(DATE_FMT)
+    if value is np.ma.masked:
+        return None
+    raise TypeError("%r is not JSON serializable"%(value,))
+
+def encode(value):
+    """JSON text of a query result"""
+    return json.dumps({'result':value},default = _default)
+
+class FitnessServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server over a FitnessData. Only the writer touches
+    self.fitness; request threads read self.snapshot, which is replaced
+    in one assignment after every sync or refresh."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,address,fitness,verbose = False):
+        BaseHTTPServer.HTTPServer.__init__(self,address,Handler)
+        self.fitness = fitness
+        self.verbose = verbose
+        self.snapshot = fitness.snapshot()
+        self.generation = 1
+        self.started = time.time()
+        self.served = 0
+        self.errors = 0
+        #Request threads count concurrently, += is not atomic
+        self._counts = threading.Lock()
+        self._writer = threading.Lock()
+        self._stop = threading.Event()
+
+    def _swap(self,update):
+        """Run update() on the writer and publish a new snapshot.
+        Returns the rows read, or None if another update is running."""
+        if not self._writer.acquire(False):
+            return None
+        try:
+            rows = update() or 0
+            if rows:
+                self.snapshot = self.fitness.snapshot()
+                self.generation += 1
+            return rows
+        finally:
+            self._writer.release()
+
+    def count(self,error = False):
+        """Count a served request, and an error if 'error'"""
+        with self._counts:
+            self.served += 1
+            if error:
+                self.errors += 1
+
+    def sync(self):
+        """Sync the db with the services and swap in the new rows"""
+        return self._swap(self.fitness.sync)
+
+    def refresh(self):
+        """Swap in rows appended to the db files by someone else"""
+        return self._swap(self.fitness.refresh)
+
+    def sync_every(self,seconds):
+        """Sync in a background thread every 'seconds'"""
+        def loop():
+            while not self._stop.wait(seconds):
+                try:
+                    self.sync()
+                except Exception as e:
+                    print "Sync failed: %s"%e
+        thread = threading.Thread(target = loop)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self._stop.set()
+        BaseHTTPServer.HTTPServer.shutdown(self)
+
+    def stats(self):
+        snap = self.snapshot
+        return {'uptime':time.time() - self.started,'served':self.served,
+                'errors':self.errors,'generation':self.generation,
+                'rows':dict((fname,len(getattr(snap,attrs[0])))
+                            for fname,attrs in fitnessdata.DB_ATTRS.items()),
+                'cache':snap.cache_info(),'instrument':instrument.stats()}
+
+def _binsize(text):
+    return int(text) if text.isdigit() else text
+
+def _trend(params):
+    """Trend model and window of a request (None: the daemon's own)"""
+    window = params.get('window')
+    return params.get('model') or None,int(window) if window else None
+
+def _view(snap,params):
+    """The snapshot, or a copy of it with the query window of the request"""
+    if 'start' not in params and 'stop' not in params:
+        return snap
+    view = copy.copy(snap)
+    if 'start' in params:
+        view.start_date = params['start'] or None
+    if 'stop' in params:
+        view.stop_date = params['stop'] or None
+    return view
+
+def query(snap,path,params):
+    """Answer one GET request from a snapshot. Raises KeyError for an
+    unknown path and ValueError for bad parameters."""
+    view = _view(snap,params)
+    if path in ('/calorie','/weight','/run'):
+        getter = getattr(view,'get_%s_data'%path[1:])
+        return getter(params.get('date'),_binsize(params.get('binsize','1')),params.get('how','sum'))
+    elif path == '/weight_slope':
+        return view.weight_slope(*_trend(params))
+    elif path == '/projected_weight':
+        return view.projected_weight(params['date'],*_trend(params))
+    elif path == '/projected_date':
+        return view.projected_date(float(params['weight']),*_trend(params))
+    elif path == '/bmi':
+        wt = params.get('wt')
+        return view.BMI(float(wt) if wt else None)
+    elif path == '/weight_from_bmi':
+        return view.weight_from_BMI(float(params['bmi']))
+    raise KeyError(path)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """JSON request handler, keeps connections alive"""
+    protocol_version = 'HTTP/1.1'
+    #Buffer the reply and send it in one go (flushed after each request)
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        #Small replies on a kept-alive connection, do not wait for acks
+        self.connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+    def _reply(self,code,body):
+        self.send_response(code)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self,answer):
+        url = urlparse.urlparse(self.path)
+        params = dict((k,v[-1]) for k,v in urlparse.parse_qs(url.query,True).items())
+        try:
+            with instrument.timer('fitnessd%s'%url.path):
+                body = encode(answer(url.path,params))
+            code = 200
+        except KeyError as e:
+            code,body = 404,json.dumps({'error':'unknown endpoint or missing parameter %s'%e})
+        except (ValueError,TypeError) as e:
+            code,body = 400,json.dumps({'error':str(e)})
+        except Exception as e:
+            code,body = 500,json.dumps({'error':'%s: %s'%(type(e).__name__,e)})
+        self.server.count(code != 200)
+        self._reply(code,body)
+
+    def do_GET(self):
+        def answer(path,params):
+            if path == '/stats':
+                return self.server.stats()
+            return query(self.server.snapshot,path,params)
+        self._handle(answer)
+
+    def do_POST(self):
+        if int(self.headers.get('Content-Length') or 0):
+            self.rfile.read(int(self.headers['Content-Length']))
+        def answer(path,params):
+            if path == '/sync':
+                return self.server.sync()
+            elif path == '/refresh':
+                return self.server.refresh()
+            raise KeyError(path)
+        self._handle(answer)
+
+    def log_message(self,fmt,*args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self,fmt,*args)
+
+def serve(fitness,host = HOST,port = PORT,verbose = False):
+    """FitnessServer over 'fitness' serving from a background thread
+    (port 0 picks a free port, see server.server_address)"""
+    server = FitnessServer((host,port),fitness,verbose)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+class ServerError(Exception):
+    """Error reply from the daemon"""
+    def __init__(self,status,message):
+        Exception.__init__(self,'%s: %s'%(status,message))
+        self.status = status
+
+def _to_dates(values):
+    """Object array of dates from a list of YYYY-MM-DD strings"""
+    return binning.to_dates(binning.to_ordinals(np.array(values,dtype = 'M8[D]')))
+
+def _to_date(value):
+    if value == None:
+        return None
+    return datetime.datetime.strptime(value,DATE_FMT).date()
+
+def _to_masked(values):
+    """Masked float array, None entries masked"""
+    return np.ma.masked_invalid(np.array(values,dtype = float))
+
+class FitnessClient(object):
+    """Thin client for the daemon, mirroring the FitnessData query
+    methods. Keeps one connection open, so use one client per thread."""
+    def __init__(self,host = HOST,port = PORT,timeout = 30.):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._conn = None
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def request(self,path,method = 'GET',**params):
+        """Raw result of one request"""
+        params = dict((k,v) for k,v in params.items() if v is not None)
+        url = path
+        if params:
+            url += '?' + urllib.urlencode(params)
+        for attempt in (0,1):
+            if self._conn == None:
+                self._conn = httplib.HTTPConnection(self.host,self.port,timeout = self.timeout)
+                self._conn.connect()
+                self._conn.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            try:
+                self._conn.request(method,url,headers = {'Content-Length':'0'} if method == 'POST' else {})
+                response = self._conn.getresponse()
+                body = response.read()
+                break
+            except (httplib.HTTPException,socket.error):
+                #The server dropped the kept-alive connection, reconnect once
+                self.close()
+                if attempt:
+                    raise
+        reply = json.loads(body)
+        if response.status != 200:
+            raise ServerError(response.status,reply.get('error'))
+        return reply['result']
+
+    @staticmethod
+    def _window(kwargs,start_date,stop_date):
+        for key,date in (('start',start_date),('stop',stop_date)):
+            if date is not None:
+                kwargs[key] = str(date)
+        return kwargs
+
+    def _data(self,path,date,binsize,how,start_date,stop_date):
+        params = self._window({'binsize':binsize,'how':how},start_date,stop_date)
+        if date is not None:
+            params['date'] = str(date)
+        result = self.request(path,**params)
+        if result[0] == None:
+            return tuple(result)
+        if date is not None:
+            return (_to_date(result[0]),) + tuple(result[1:])
+        return (_to_dates(result[0]),) + tuple(_to_masked(col) for col in result[1:])
+
+    def get_calorie_data(self,date = None,binsize = 1,how = 'sum',start_date = None,stop_date = None):
+        """(dates, calories, goal) as FitnessData.get_calorie_data"""
+        return self._data('/calorie',date,binsize,how,start_date,stop_date)
+
+    def get_weight_data(self,date = None,binsize = 1,how = 'sum',start_date = None,stop_date = None):
+        """(dates, weight) as FitnessData.get_weight_data"""
+        return self._data('/weight',date,binsize,how,start_date,stop_date)
+
+    def get_run_data(self,date = None,binsize = 1,how = 'sum',start_date = None,stop_date = None):
+        """(dates, distance, time) as FitnessData.get_run_data"""
+        return self._data('/run',date,binsize,how,start_date,stop_date)
+
+    def weight_slope(self,model = None,window = None,start_date = None,stop_date = None):
+        params = self._window({'model':model,'window':window},start_date,stop_date)
+        return self.request('/weight_slope',**params)
+
+    def projected_weight(self,date,model = None,window = None,start_date = None,stop_date = None):
+        params = self._window({'date':str(date),'model':model,'window':window},start_date,stop_date)
+        return self.request('/projected_weight',**params)
+
+    def projected_date(self,weight,model = None,window = None,start_date = None,stop_date = None):
+        params = self._window({'weight':weight,'model':model,'window':window},start_date,stop_date)
+        return _to_date(self.request('/projected_date',**params))
+
+    def BMI(self,wt = None):
+        return self.request('/bmi',wt = wt)
+
+    def weight_from_BMI(self,bmi):
+        return self.request('/weight_from_bmi',bmi = bmi)
+
+    def stats(self):
+        return self.request('/stats')
+
+    def sync(self):
+        """Rows the daemon read (None if a sync was already running)"""
+        return self.request('/sync','POST')
+
+    def refresh(self):
+        return self.request('/refresh','POST')
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'FitnessData query daemon')
+    parser.add_argument('--host',default = HOST)
+    parser.add_argument('-p','--port',type = int,default = PORT)
+    parser.add_argument('-s','--sync-every',type = float,
+                        help = 'seconds between syncs with the services')
+    parser.add_argument('--no-sync',action = 'store_true',
+                        help = 'serve the db as it is, do not sync at startup')
+    parser.add_argument('-d','--datadir',default = '',
+                        help = 'profile directory holding db/ and credentials.txt')
+    parser.add_argument('--storage',choices = storage.KINDS,
+                        help = 'where the tables are kept (default FITNESS_STORAGE or text)')
+    parser.add_argument('-v','--verbose',action = 'store_true')
+    args = parser.parse_args(argv)
+
+    fitness = fitnessdata.FitnessData(lazy = True,datadir = args.datadir,storage = args.storage)
+    if not args.no_sync:
+        fitness.sync()
+    server = FitnessServer((args.host,args.port),fitness,args.verbose)
+    if args.sync_every:
+        server.sync_every(args.sync_every)
+    print "Serving on %s:%d"%server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
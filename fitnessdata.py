@@ -9,84 +9,297 @@ A class to interface with myfitnesspal and strava
 to track my fitness data
 """
 
-import myfitnesspal as mfp
-import stravalib as strava
+import copy
 import datetime
 import os
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
+import binning
+import bootstrap
+import cache
+import charts
+import colstore
+import dailyframe
+import dateindex
+import fetcher
+import instrument
+import pipeline
+import respcache
+import runs
+import storage
+import streams
+import trend
+#myfitnesspal and stravalib are imported where the clients are made,
+#read-only use of the db should not pay for them
 
 #Define file names
 CREDENTIALS = 'credentials.txt'
 DB_WGT = 'db/mfpwt.dat'
 DB_CAL = 'db/mfpcl.dat'
 DB_RUN = 'db/st_rn.dat'
+#Present while a calorie init is in progress, holds its start date
+INIT_CHECKPOINT = 'db/init.chk'
+#UTC start time of the newest synced strava activity, and the ids of
+#every run written to DB_RUN (one per line)
+RUN_CURSOR = 'db/st_rn.cursor'
+RUN_IDS = 'db/st_rn.ids'
+CURSOR_FMT = '%Y-%m-%dT%H:%M:%S'
+#Activities between cursor saves
+CURSOR_EVERY = 30
+
+#Number of derived results (binned series, slopes, projections) kept
+DERIVED_CACHE_SIZE = 128
+
+#Trend model used by weight_slope and the projections (see trend.MODELS)
+#and its window in days, None for the whole start/stop window
+TREND_MODEL = 'lsq'
+TREND_WINDOW = None
+
+#Monte Carlo projection bands: resamples and the default percentiles
+BOOTSTRAP_RESAMPLES = 10000
+BOOTSTRAP_PERCENTILES = (5,50,95)
+
+#Where the tables are kept: 'text' (db/*.dat) or 'sqlite' (see storage)
+STORAGE = os.environ.get('FITNESS_STORAGE','text')
+
+#Cache of myfitnesspal/strava responses (see respcache): directory, mode
+#(cache, record, replay or off) and size bound in bytes
+RESPONSE_CACHE = 'db/responses'
+RESPONSE_MODE = os.environ.get('FITNESS_RESPONSES','cache')
+RESPONSE_CACHE_BYTES = respcache.MAX_BYTES
+
+#MyFitnessPal fetch settings (threads, requests per second, retries)
+FETCH_WORKERS = 4
+FETCH_RATE = 4.
+FETCH_RETRIES = 3
+
+#Archive of per-second run streams (see streams), whether sync fetches
+#the streams of new runs, and stream requests per second (strava allows
+#600 per 15 minutes)
+STREAM_DIR = 'db/streams'
+SYNC_STREAMS = bool(os.environ.get('FITNESS_STREAMS'))
+STREAM_RATE = 0.5
+
+#Whether update_db fetches and writes calories, weights and runs
+#concurrently (see pipeline) or one after another
+SYNC_CONCURRENT = True
+
+#Binary column layout of each db file (see colstore)
+#Dates are day ordinals (datetime.date.toordinal), the same dtypes are
+#used for the in-memory arrays
+DB_COLUMNS = {DB_CAL:[('date','<i4'),('cals','<i4'),('goal','<i4'),('final','|b1')],
+              DB_WGT:[('date','<i4'),('wt','<f4')],
+              DB_RUN:[('date','<i4'),('dist','<f4'),('time','<i4')]}
+#In-memory arrays holding the columns of each db file
+DB_ATTRS = {DB_CAL:('_caldate','_calcons','_calgoal','_calfinal'),
+            DB_WGT:('_wtdate','_wt'),
+            DB_RUN:('_rundate','_rundist','_runtime')}
+#Dataset names used by lookup: db file and the value columns returned
+DATASETS = {'calorie':(DB_CAL,('_calcons','_calgoal')),
+            'weight':(DB_WGT,('_wt',)),
+            'run':(DB_RUN,('_rundist','_runtime'))}
+
+def _utc(dt):
+    """Naive UTC version of a (possibly timezone aware) datetime"""
+    if getattr(dt,'tzinfo',None) != None:
+        dt = dt.replace(tzinfo = None) - dt.utcoffset()
+    return dt
+
+def _days_since(date):
+    """Dates from 'date' through today"""
+    today = datetime.date.today()
+    dates = []
+    while date <= today:
+        dates.append(date)
+        date = date + datetime.timedelta(days = 1)
+    return dates
 
 class FitnessData(object):
     """This is a docstring"""
-    def __init__(self,start_date = None, stop_date = None, date_fmt = '%Y-%m-%d',height = 66.):
+    def __init__(self,start_date = None, stop_date = None, date_fmt = '%Y-%m-%d',height = 66.,lazy = False,
+                 datadir = '',credentials = None,storage = None):
+        """With lazy = True nothing is synced or read up front: each db
+        file is read on first use and syncing is left to sync().
+        
+        datadir is the profile directory the db files (and by default
+        the credentials file) live in, the working directory if empty.
+        credentials is a dict of MFP_USER/STRAVA_TOKEN or the path of a
+        credentials file. storage is where the tables are kept, 'text' or
+        'sqlite' (default STORAGE)."""
         #Read inputs and define variables
+        self.datadir = datadir
+        self.credentials = credentials
+        self.storage = self._open_storage(storage or STORAGE)
         self.date_fmt = date_fmt
         self._start_date = self._set_date_(start_date)
         self._stop_date = self._set_date_(stop_date)
         self._credentials = {'MFP_USER':None,'STRAVA_TOKEN':None}
         self.mfp_client = None
         self.stv_client = None
+        self.sync_stats = None
         self.height = height
+        self.lazy = lazy
+        self.trend_model = TREND_MODEL
+        self.trend_window = TREND_WINDOW
+        self._loaded = set()
+        self._index = {}
+        self._versions = {}
+        self.cache = cache.LRUCache(DERIVED_CACHE_SIZE,'cache.derived')
+        self._runs = None
+        self._responses = None
         
+        #Read data files into arrays
+        for fname in (DB_CAL,DB_WGT,DB_RUN):
+            for attr,(name,dtype) in zip(DB_ATTRS[fname],DB_COLUMNS[fname]):
+                setattr(self,attr,np.zeros(0,dtype = dtype))
+        
+        if not lazy:
+            self._sync()
+            for fname in (DB_CAL,DB_WGT,DB_RUN):
+                self._load(fname)
+    
+    def sync(self,background = False,start = None):
+        """Bring the db up to date with myfitnesspal and strava and read
+        the new rows. With background = True the sync runs in a thread,
+        which is returned; call refresh() after joining it. Otherwise
+        returns the number of rows read. 'start' is the first day to
+        fetch if the db has to be initialized (asked for if None)."""
+        if background:
+            thread = threading.Thread(target = self._sync,args = (start,))
+            thread.start()
+            return thread
+        self._sync(start)
+        return self.refresh()
+    
+    @instrument.timed()
+    def _sync(self,start = None):
+        """Initialize or update the db files if they are out of date"""
         #Do we need to update the database?
         today = datetime.datetime.today()
         last_update,final = self.get_last_entry()
-        #Initialize the db
-        if last_update == None:
+        resume = os.path.isfile(self._path(INIT_CHECKPOINT))
+        tables = [fname for fname in (DB_CAL,DB_WGT,DB_RUN) if self.storage.exists(fname)]
+        if resume:
+            #The resumed init fetches the calories through today
+            tables = [fname for fname in tables if fname != DB_CAL]
+        if DB_CAL not in tables:
+            last_update,final = self._last_date(tables),None
+        #Create the missing tables, or finish an interrupted init
+        if resume or len(tables) < 3:
             self._read_creds()
-            self.mfp_client = self._make_client('mfp')
-            self.stv_client = self._make_client('strava')
-            if not None in (self.mfp_client,self.stv_client):
-                self._init_db()
-        #Update the db
-        elif last_update < today.date():
+            #Log in to both services at once
+            logins = [pipeline.Login(self._connect,mode) for mode in ('mfp','strava')]
+            if None in [login.get() for login in logins]:
+                return
+            self._init_db(start)
+        #Update the tables that were there, update_db logs in
+        if last_update != None and last_update < today.date():
             self._read_creds()
-            self.mfp_client = self._make_client('mfp')
-            self.stv_client = self._make_client('strava')
             over_write = False
             if final == '0':
                 over_write = True
-            self.update_db(last_update,over_write = over_write)
-        
-        #Read data files into arrays
-        self._caldate = []
-        self._calcons = []
-        self._calgoal = []
-        
-        self._wtdate = []
-        self._wt = []
-        
-        self._rundate = []
-        self._rundist = []
-        self._runtime = []
-        
-        cal_list = self.readfile(DB_CAL)
-        wt_list = self.readfile(DB_WGT)
-        run_list = self.readfile(DB_RUN)
-        
-        if len(cal_list) == 4:
-            self._caldate,self._calcons,self._calgoal,final = cal_list
+            self.update_db(last_update,over_write = over_write,tables = tables)
+    
+    def _last_date(self,tables):
+        """Earliest date of the last rows of 'tables' (None if none)"""
+        dates = []
+        for fname in tables:
+            line = self.storage.last_line(fname)
+            try:
+                dates.append(datetime.datetime.strptime(line[:10],'%Y-%m-%d').date())
+            except ValueError:
+                continue
+        return min(dates) if dates else None
+    
+    def _ensure_loaded(self,fname):
+        """Read a db file the first time it is needed"""
+        if fname not in self._loaded:
+            self._load(fname)
+    
+    @instrument.timed()
+    def _load(self,fname,incremental = False):
+        """Read a db file into its in-memory arrays. If incremental, only
+        rows from the last loaded date on are read and appended, nothing
+        if the table has not been written since.
+        Returns the number of rows read."""
+        self._loaded.add(fname)
+        attrs = DB_ATTRS[fname]
+        start = 0
+        first = None
+        loaded = getattr(self,attrs[0])
+        if incremental and len(loaded) and self.storage.exists(fname):
+            read = self._versions.get(fname,(None,) * 3)[2]
+            if self.storage.version(fname) == read:
+                return 0
+            last = loaded[-1]
+            low = self.storage.written_since(fname,read)
+            if low != None:
+                #Only rows from the earliest day written since are reread
+                first = min(low,last)
+                start = int(np.searchsorted(loaded,first))
+            else:
+                stored = self.storage.load(fname)
+                dates = stored[0]
+                #Rows on the last loaded date may have been rewritten, reread them
+                start = int(np.searchsorted(dates,last))
+                if start > len(loaded):
+                    start = 0
+                #Rows before the tail were rewritten (backfill), reread them all
+                if start and not all(np.array_equal(np.ma.getdata(getattr(self,attr))[:start],col[:start])
+                                     for attr,col in zip(attrs,stored)):
+                    start = 0
+        self._index.pop(fname,None)
+        #Before the read, a write during it shows as a newer version
+        version = self.storage.version(fname) if self.storage.exists(fname) else None
+        cols = self.readfile(fname,start if first == None else 0,first)
+        if not cols or len(cols) != len(attrs):
+            return 0
+        if start:
+            old = [np.ma.getdata(getattr(self,attr))[:start] for attr in attrs]
+            cols = [np.concatenate((o,c)) for o,c in zip(old,cols)]
+        for attr,col in zip(attrs,cols):
+            setattr(self,attr,col)
+        #Part of every derived-result cache key, changes on every (re)load
+        generation = self._versions.get(fname,(0,))[0] + 1
+        self._versions[fname] = (generation,colstore.STORE_VERSION,version,len(cols[0]))
+        if fname == DB_CAL:
             #Mask these guys
             self._calcons = np.ma.masked_where(self._calcons < 0,self._calcons)
             self._calgoal = np.ma.masked_where(self._calgoal < 0,self._calgoal)
-        if len(wt_list) == 2:
-            self._wtdate,self._wt = wt_list
-        if len(run_list) == 3:
-            self._rundate,self._rundist,self._runtime = run_list
-        
-        
-        
-        
-        
-        
+        return len(cols[0]) - start
+    
+    def _open_storage(self,kind):
+        """Storage backend of the tables in the data directory"""
+        return storage.open_storage(kind,self.datadir,DB_COLUMNS,{DB_RUN:RUN_IDS})
+    
+    @instrument.timed()
+    def refresh(self):
+        """Pick up rows added to the db files since they were read,
+        parsing only the new rows. Returns the number of rows read."""
+        return sum(self._load(fname,incremental = True) for fname in (DB_CAL,DB_WGT,DB_RUN)
+                   if fname in self._loaded)
         
+    def snapshot(self):
+        """Read-only copy of the loaded data for concurrent readers.
+        _load replaces the arrays instead of writing into them, so the
+        copy shares them and stays valid while this object syncs and
+        refreshes. The derived-result cache is shared as well."""
+        for fname in (DB_CAL,DB_WGT,DB_RUN):
+            self._ensure_loaded(fname)
+        snap = copy.copy(self)
+        snap._loaded = set(self._loaded)
+        snap._index = dict(self._index)
+        snap._versions = dict(self._versions)
+        snap.mfp_client = None
+        snap.stv_client = None
+        #Extended in place by run_analytics, the snapshot builds its own
+        snap._runs = None
+        for attrs in DB_ATTRS.values():
+            for attr in attrs:
+                getattr(snap,attr).setflags(write = False)
+        return snap
     
+    @instrument.timed()
     def _set_date_(self,date):
         """Make sure date is a valid object"""
         #If it is already a datetime object, or None
@@ -107,12 +320,21 @@ class FitnessData(object):
             print "Cannot make type %s into date object."%type(date)
             return None
     
+    def _path(self,fname):
+        """Path of a db (or other profile) file in the data directory"""
+        return os.path.join(self.datadir,fname)
+    
     def _read_creds(self):
         """Read login credentials"""
-        if not os.path.isfile(CREDENTIALS):
+        if isinstance(self.credentials,dict):
+            for key in self._credentials:
+                self._credentials[key] = self.credentials.get(key)
+            return
+        fname = self.credentials or self._path(CREDENTIALS)
+        if not os.path.isfile(fname):
             return {'MFPUSER':None,'STRAVATOKEN':None}
         else:
-            with open(CREDENTIALS) as f:
+            with open(fname) as f:
                 for line in f:
                     split = [l.strip() for l in line.split(':')]
                     if len(split) == 2:
@@ -121,52 +343,91 @@ class FitnessData(object):
                             self._credentials[key] = attribute
     def _make_client(self,mode):
         """Make a client of type 'mode'"""
+        if RESPONSE_MODE == 'replay':
+            #Recorded responses only, no login
+            return self._wrap_client(None,mode)
         if mode == 'mfp':
+            import myfitnesspal as mfp
             try:
                 client = mfp.Client(self._credentials['MFP_USER'])
-                return client
+                return self._wrap_client(instrument.CountingClient(client,'mfp'),'mfp')
             except:
                 print "Invalid credentials supplied for myfitnesspal."
                 return None
         if mode == 'strava':
+            import stravalib as strava
             try:
                 client = strava.Client(access_token = self._credentials['STRAVA_TOKEN'])
-                return client
+                return self._wrap_client(instrument.CountingClient(client,'strava'),'strava')
             except:
                 print "Invalid credentials supplied for strava."
                 return None
+    
+    def _connect(self,mode):
+        """Client of 'mode', made if there is none yet"""
+        attr = 'mfp_client' if mode == 'mfp' else 'stv_client'
+        if getattr(self,attr) == None:
+            setattr(self,attr,self._make_client(mode))
+        return getattr(self,attr)
+    
+    def _wrap_client(self,client,mode):
+        """Put the response cache in front of a client"""
+        if RESPONSE_MODE == 'off':
+            return client
+        path = self._path(RESPONSE_CACHE)
+        if self._responses == None or self._responses.path != path:
+            self._responses = respcache.ResponseStore(path,RESPONSE_CACHE_BYTES)
+        return respcache.CachingClient(client,self._responses,mode,RESPONSE_MODE)
+    
+    def response_stats(self):
+        """Response cache statistics of the current clients"""
+        stats = {}
+        for mode,client in (('mfp',self.mfp_client),('strava',self.stv_client)):
+            if isinstance(client,respcache.CachingClient):
+                stats[mode] = client.stats()
+        return stats
             
-    def _init_db(self):
-        """Initialize the db if no files are found"""
+    @instrument.timed()
+    def _init_db(self,start = None):
+        """Initialize the db if no files are found. The start date is
+        asked for unless 'start' is given."""
         print "Initializing the database..."
+        dbdir = os.path.dirname(self._path(DB_CAL))
+        if dbdir and not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        if start:
+            datestr = str(self._set_date_(start))
         #Calorie file
         #If we found the file don't remake it
-        today  = datetime.date.today()
-        if os.path.isfile(DB_CAL):
+        checkpoint = self._path(INIT_CHECKPOINT)
+        if self.storage.exists(DB_CAL) and not os.path.isfile(checkpoint):
             print "\tFound calorie info. Skipping."
+        elif os.path.isfile(checkpoint):
+            #A previous init was interrupted, carry on after its last row
+            with open(checkpoint) as f:
+                datestr = f.read().strip()
+            print "\tResuming db calorie file from %s"%datestr
+            last_update,final = self.get_last_entry()
+            if last_update:
+                with self._writer(DB_CAL) as calfile:
+                    self._fetch_calories(calfile,last_update + datetime.timedelta(days = 1))
+            else:
+                with self._writer(DB_CAL,'w') as calfile:
+                    self._fetch_calories(calfile,self._set_date_(datestr))
+            os.remove(checkpoint)
         else:
             print "\tUpdating db calorie file"
-            datestr = raw_input("\tDate you began logging calories (%s): "%self.date_fmt)
+            if not start:
+                datestr = raw_input("\tDate you began logging calories (%s): "%self.date_fmt)
             date = self._set_date_(datestr)
             if date:
-                with open(DB_CAL, 'w') as calfile:
-                    while date <= datetime.date.today():
-                        print date
-                        mfpdate = self.mfp_client.get_date(date)
-                        if mfpdate.totals:
-                            cals = mfpdate.totals['calories']
-                            goal = mfpdate.goals['calories']
-                        else:
-                            cals = -1
-                            goal = -1
-                        final = 0
-                        if date < today:
-                            final = 1
-                        line = "%s,%s,%s,%s\n"%(date,cals,goal,final)
-                        calfile.write(line)
-                        date = date + datetime.timedelta(days = 1)
+                with open(checkpoint,'w') as f:
+                    f.write(datestr)
+                with self._writer(DB_CAL,'w') as calfile:
+                    self._fetch_calories(calfile,date)
+                os.remove(checkpoint)
         #Weight file
-        if os.path.isfile(DB_WGT):
+        if self.storage.exists(DB_WGT):
             print "\tFound weight info. Skipping."
         else:
             print "\tUpdating db weight file."
@@ -175,273 +436,560 @@ class FitnessData(object):
             except NameError:
                 datestr = raw_input("\tDate you began tracking weight (%s): "%self.date_fmt)
             date = self._set_date_(datestr)
-            wts = self.mfp_client.get_measurements(lower_bound = date.date())
-            with open(DB_WGT, 'w') as wtfile:
+            wts = self.mfp_client.get_measurements(lower_bound = date)
+            with self._writer(DB_WGT,'w') as wtfile:
                 for key in sorted(wts.keys()):
                     wt = wts[key]
                     line = "%s,%s\n"%(key,wt)
                     wtfile.write(line)
             
         #Workout file
-        if os.path.isfile(DB_RUN):
+        if self.storage.exists(DB_RUN):
             print "\tFound run info. Skipping."
         else:
             print "\tUpdating db running file."
             athlete = self.stv_client.get_athlete()
-            date = athlete.created_at
-            acts = self.stv_client.get_activities(after = date)
-            with open(DB_RUN,'w') as runfile:
-                for act in acts:
-                    if act.type == 'Run':
-                        date = act.start_date_local
-                        dist = act.distance.num
-                        time = act.elapsed_time.seconds
-                        line = "%s,%s,%s\n"%(date.date(),dist,time)
-                        runfile.write(line)
+            #A fresh table starts a fresh cursor (and id index, the writer empties it)
+            if os.path.isfile(self._path(RUN_CURSOR)):
+                os.remove(self._path(RUN_CURSOR))
+            self._sync_runs(athlete.created_at,mode = 'w')
                         
+    @instrument.timed()
+    def _fetch_calories(self,calfile,date):
+        """Fetch calories from 'date' through today and write them in order"""
+        self._write_calories(calfile,self._calorie_lines(_days_since(date)))
+    
+    def _write_calories(self,calfile,lines):
+        """Write (date, DB_CAL line) in the order given"""
+        for date,line in lines:
+            print line
+            calfile.write(line)
+            #Rows on disk are the resume point if we get interrupted
+            calfile.flush()
+    
+    def _calorie_lines(self,dates,client = None,failures = None):
+        """Fetch 'dates' concurrently (with 'client', default mfp_client),
+        yielding (date, DB_CAL line) in order. Days that fail are added to
+        'failures' if given (see fetcher.DayFetcher.fetch)."""
+        today = datetime.date.today()
+        pool = fetcher.DayFetcher(client or self.mfp_client,workers = FETCH_WORKERS,
+                                  rate = FETCH_RATE,retries = FETCH_RETRIES)
+        for date,mfpdate in pool.fetch(dates,failures):
+            if mfpdate.totals:
+                cals = mfpdate.totals['calories']
+                goal = mfpdate.goals['calories']
+            else:
+                cals = -1
+                goal = -1
+            final = 0
+            if date < today:
+                final = 1
+            yield date,"%s,%s,%s,%s\n"%(date,cals,goal,final)
+    
+    def find_calorie_gaps(self,start = None):
+        """Days of DB_CAL worth fetching again, from 'start' (default the
+        first row) through today, in one vectorized pass. Returns day
+        ordinal arrays (missing, unlogged, not final): days without a
+        row, -1 rows and past rows not marked final."""
+        self._ensure_loaded(DB_CAL)
+        dates = self._caldate
+        if not dates.size:
+            empty = np.zeros(0,dtype = np.int64)
+            return empty,empty,empty
+        today = datetime.date.today().toordinal()
+        first = dates.min() if start == None else self._set_date_(start).toordinal()
+        recent = dates >= first
+        present = np.zeros(max(today - first + 1,0),dtype = bool)
+        inside = recent & (dates <= today)
+        present[dates[inside] - first] = True
+        missing = first + np.flatnonzero(~present)
+        unlogged = np.unique(dates[recent & np.ma.getmaskarray(self._calcons)])
+        unfinal = np.unique(dates[recent & ~self._calfinal & (dates < today)])
+        return missing.astype(np.int64),unlogged.astype(np.int64),unfinal.astype(np.int64)
+    
+    @instrument.timed()
+    def backfill(self,start = None,unlogged = True):
+        """Fetch again only the days find_calorie_gaps reports (-1 rows
+        only if 'unlogged') and patch them into DB_CAL, replacing the rows
+        of those days. Days that cannot be fetched are reported and left
+        as they are. Returns the number of days patched."""
+        if not self.storage.exists(DB_CAL):
+            print "DB info not found."
+            return 0
+        missing,blank,unfinal = self.find_calorie_gaps(start)
+        days = np.union1d(missing,unfinal)
+        if unlogged:
+            days = np.union1d(days,blank)
+        if not days.size:
+            return 0
+        print "Backfilling %d days (%d missing, %d unlogged, %d not final)"%(
+            days.size,missing.size,blank.size,unfinal.size)
+        if self.mfp_client == None:
+            self._read_creds()
+            self.mfp_client = self._make_client('mfp')
+            if self.mfp_client == None:
+                return 0
+        #These days are refetched because a cached answer may be stale
+        client = self.mfp_client
+        if isinstance(client,respcache.CachingClient):
+            client = client.refreshing()
+        failures = []
+        fetched = dict(self._calorie_lines(list(binning.to_dates(days)),client,failures))
+        for date,e in failures:
+            print "Could not fetch %s: %s"%(date,e)
+        if failures:
+            print "%d of %d days could not be fetched."%(len(failures),days.size)
+        if not fetched:
+            return 0
+        self._patch_calories(fetched)
+        if DB_CAL in self._loaded:
+            self._load(DB_CAL)
+        return len(fetched)
+    
+    def _patch_calories(self,lines):
+        """Replace the DB_CAL rows of the days in 'lines' (date -> line)
+        and insert the days that had none, keeping every other row as it
+        is (see storage)."""
+        self.storage.replace_days(DB_CAL,lines)
+            
     def remove_last_line(self,fname):
         """Remove the last line of a file"""
-        if os.path.isfile(fname):
-            lines = []
-            with open(fname) as f:
-                lines = f.readlines()
-            with open(fname,'w') as f:
-                wlines = lines[:-1]
-                f.writelines(wlines)
-            return lines[-1]
-        else:
-            return None
+        return self.storage.remove_last(fname)
+    
+    def _writer(self,fname,mode = 'a'):
+        """Writer that appends lines to a db table"""
+        return self.storage.writer(fname,mode)
                         
-    def update_db(self,date,over_write = False):
-        """Get new data from and add to db"""
+    @instrument.timed()
+    def update_db(self,date,over_write = False,tables = (DB_CAL,DB_WGT,DB_RUN)):
+        """Get new data from and add to db. Calories, weights and runs are
+        fetched and written concurrently, logging in to myfitnesspal and
+        strava as well (see pipeline). Only the existing 'tables' are
+        updated. Returns the wall time and per-stage timings, also kept
+        as self.sync_stats."""
         date = self._set_date_(date)
-        if date:
-            date = date + datetime.timedelta(days = 1) #Dont repeat the last line
-            
-        if os.path.isfile(DB_CAL) and date: 
+        if not date:
+            return None
+        date = date + datetime.timedelta(days = 1) #Dont repeat the last line
+        if type(date) == datetime.datetime:
+            date = date.date()
+        stages = []
+        tables = [fname for fname in tables if self.storage.exists(fname)]
+        if DB_CAL in tables:
             cdate = date
             last = "any string"
             if over_write:
                 cdate = cdate - datetime.timedelta(days = 1)
                 last = self.remove_last_line(DB_CAL)
             if last:
-                with open(DB_CAL,'a') as calfile:
-                    iter_date = cdate
-                    while iter_date <= datetime.date.today():
-                        mfpdate = self.mfp_client.get_date(iter_date)
-                        if mfpdate.totals:
-                            cals = mfpdate.totals['calories']
-                            goal = mfpdate.goals['calories']
-                        else:
-                            cals = -1
-                            goal = -1
-                        final = 0
-                        if iter_date < datetime.date.today():
-                            final = 1
-                        line = "%s,%s,%s,%s\n"%(iter_date,cals,goal,final)
-                        print line
-                        calfile.write(line)
-                        iter_date = iter_date + datetime.timedelta(days = 1)
+                stages.append(pipeline.Stage('calories',lambda: self._calorie_lines(_days_since(cdate)),
+                                             lambda lines: self._write_table(DB_CAL,self._write_calories,lines),'mfp'))
         
-        if os.path.isfile(DB_WGT) and date:
-            wdate = date
-            if type(date) == datetime.datetime:
-                wdate = date.date()
-            wts = self.mfp_client.get_measurements(lower_bound = wdate)
-            with open(DB_WGT, 'a') as wtfile:
-                for key in sorted(wts.keys()):
-                    wt = wts[key]
-                    line = "%s,%s\n"%(key,wt)
-                    wtfile.write(line)
-                    
-        if os.path.isfile(DB_RUN) and date:
-            if type(date) == datetime.date:
-                time = datetime.time(0,0,0)
-                date = datetime.datetime.combine(date,time)
-            acts = self.stv_client.get_activities(after = date)
-            with open(DB_RUN,'a') as runfile:
-                for act in acts:
-                    if act.type == 'Run':
-                        date = act.start_date_local
-                        dist = act.distance.num
-                        time = act.elapsed_time.seconds
-                        line = "%s,%s,%s\n"%(date,dist,time)
-                        runfile.write(line)
+        if DB_WGT in tables:
+            stages.append(pipeline.Stage('weights',lambda: self._weight_lines(date),
+                                         lambda lines: self._write_table(DB_WGT,self._write_lines,lines),'mfp'))
+        
+        if DB_RUN in tables:
+            stages.append(pipeline.Stage('runs',lambda: self._activities(date),
+                                         lambda acts: self._write_runs(acts,date),'strava'))
+        
+        self.sync_stats = pipeline.run(stages,self._connect,concurrent = SYNC_CONCURRENT)
+        print pipeline.summary(self.sync_stats)
+        return self.sync_stats
+    
+    def _write_table(self,fname,write,items):
+        """write(dbfile, items) into an appending writer of 'fname'"""
+        with self._writer(fname) as dbfile:
+            write(dbfile,items)
+    
+    def _write_lines(self,dbfile,lines):
+        for line in lines:
+            dbfile.write(line)
+    
+    def _weight_lines(self,date):
+        """DB_WGT lines of the weigh-ins from 'date' on, in date order"""
+        wts = self.mfp_client.get_measurements(lower_bound = date)
+        for key in sorted(wts.keys()):
+            yield "%s,%s\n"%(key,wts[key])
             
-                        
+    def _run_cursor(self):
+        """UTC start time of the newest synced activity (None if unknown)"""
+        if not os.path.isfile(self._path(RUN_CURSOR)):
+            return None
+        with open(self._path(RUN_CURSOR)) as f:
+            try:
+                return datetime.datetime.strptime(f.read().strip(),CURSOR_FMT)
+            except ValueError:
+                return None
+    
+    def _save_run_cursor(self,cursor):
+        """Atomically replace the cursor"""
+        fname = self._path(RUN_CURSOR)
+        with open(fname + '.tmp','w') as f:
+            f.write(cursor.strftime(CURSOR_FMT))
+        os.rename(fname + '.tmp',fname)
+    
+    def _run_ids(self):
+        """Set of strava activity ids already in DB_RUN"""
+        return self.storage.keys(DB_RUN)
+    
+    @instrument.timed()
+    def _sync_runs(self,after,mode = 'a'):
+        """Stream strava activities newer than the saved cursor (or 'after'
+        if there is none) into DB_RUN as they arrive"""
+        self._write_runs(self._activities(after),after,mode)
+    
+    def _start_cursor(self,after):
+        """The saved cursor, or 'after' (UTC) if there is none"""
+        cursor = self._run_cursor()
+        if cursor == None:
+            cursor = _utc(after)
+            if type(cursor) == datetime.date:
+                cursor = datetime.datetime.combine(cursor,datetime.time(0,0,0))
+        return cursor
+    
+    def _activities(self,after):
+        """Strava activities newer than the saved cursor (or 'after')"""
+        return self.stv_client.get_activities(after = self._start_cursor(after))
+    
+    def _write_runs(self,acts,after,mode = 'a'):
+        """Write the runs of 'acts' to DB_RUN, skipping activity ids that
+        are already there. The cursor is saved as we go, so an interrupted
+        sync carries on where it stopped. With SYNC_STREAMS the streams of
+        the new runs are archived too."""
+        cursor = self._start_cursor(after)
+        known = self._run_ids()
+        seen = 0
+        new = []
+        with self._writer(DB_RUN,mode) as runfile:
+            for act in acts:
+                if act.type == 'Run' and act.id not in known:
+                    date = act.start_date_local
+                    dist = act.distance.num
+                    time = act.elapsed_time.seconds
+                    line = "%s,%s,%s\n"%(date.date(),dist,time)
+                    runfile.write(line,key = act.id)
+                    runfile.flush()
+                    known.add(act.id)
+                    new.append((act.id,date.date()))
+                    instrument.count('runs_written')
+                elif act.type == 'Run':
+                    instrument.count('runs_skipped')
+                cursor = max(cursor,_utc(act.start_date))
+                seen += 1
+                if seen % CURSOR_EVERY == 0:
+                    self._save_run_cursor(cursor)
+        self._save_run_cursor(cursor)
+        if SYNC_STREAMS and new:
+            streams.ingest(self.stv_client,new,self.stream_archive(),rate = STREAM_RATE)
+    
+    def stream_archive(self):
+        """Archive of the per-second run streams"""
+        return streams.StreamArchive(self._path(STREAM_DIR))
+    
+    @instrument.timed()
+    def sync_streams(self,after = None):
+        """Archive the streams of every strava run since 'after' (all of
+        them if None) that is not archived yet. Returns the number
+        fetched."""
+        if self.stv_client == None:
+            self._read_creds()
+            self.stv_client = self._make_client('strava')
+            if self.stv_client == None:
+                return None
+        acts = ((act.id,act.start_date_local.date()) for act in self.stv_client.get_activities(after = after)
+                if act.type == 'Run')
+        return streams.ingest(self.stv_client,acts,self.stream_archive(),rate = STREAM_RATE)
+    
+    def stream_analysis(self,every = streams.SPLIT,zones = streams.ZONES):
+        """Splits, best efforts and time in zone of the archived runs in
+        the start/stop window, read one run at a time (see streams.analyze)"""
+        first = self.start_date.toordinal() if self.start_date else None
+        last = self.stop_date.toordinal() if self.stop_date else None
+        return streams.analyze(self.stream_archive().iter_streams(first,last),every,zones = zones)
+        
     def get_last_entry(self):
         """Retrieve the date of the most recent entry"""
-        if not os.path.isfile(DB_CAL):
+        if not self.storage.exists(DB_CAL):
             return None,None
         else:
-            lastline = ""
-            with open(DB_CAL) as calfile:
-                for line in calfile:
-                    lastline = line
+            lastline = self.storage.last_line(DB_CAL)
             split = lastline.split(',')
             datestr = split[0]
             final = (split[-1]).strip()
             date = self._set_date_(datestr)
             return date,final
         
-    def readfile(self,fname):
-        """Read file into np array. Returns list of columns."""
-        if os.path.isfile(fname):
+    @instrument.timed()
+    def readfile(self,fname,start = 0,first = None):
+        """Read file into np array. Returns list of columns
+        (from row 'start' on, of the rows from date ordinal 'first' on
+        if given). Dates are day ordinals."""
+        if self.storage.exists(fname):
             try:
-                data = np.genfromtxt(fname,dtype = str, delimiter = ',')
-            except:
+                cols = self.storage.load(fname,first)
+            except self.storage.errors as e:
+                print "Could not read %s: %s"%(fname,e)
                 return []
-            numcols = data.shape[-1]
-            try:
-                date = np.array([self._set_date_(d) for d in data[:,0]])
-            except:
-                date = None
-            
-            return_list = []
-            return_list.append(date)
-            for i in range(1,numcols):
-                col = data[:,i]
-                col = np.array([float(num) for num in col])
-                return_list.append(col)
             
-            return return_list
+            #Copy out of the maps, the store may be rewritten later
+            return [np.array(col[start:]) for col in cols]
         
         else:
             print "DB info not found."
             return None
     
-    def get_calorie_data(self,date = None,binsize = 1):
+    @instrument.timed()
+    def get_calorie_data(self,date = None,binsize = 1,how = 'sum'):
         """Get calorie info for a given date. If no date is provided,
-        self.start and self.stop are used as bounds, and arrays are returned."""
+        self.start and self.stop are used as bounds, and arrays are returned.
+        binsize is a width in days or 'week'/'month', how is the reduction
+        applied to each bin (sum, mean, min, max or count)."""
         if date:
+            self._ensure_loaded(DB_CAL)
             date = self._set_date_(date)
             if date:
-                date = datetime.datetime.combine(date,time)
-                mask = [self._caldate <= date]
-                cals = self._calcons[mask]
-                goal = self._calgoal[mask]
-                
-                if cals.size and goal.size:
-                    return_cals = cals[-1]
-                    return_goal = goal[-1]
-                    return date,return_cals,return_goal
+                found = self._lookup_one('calorie',date)
+                if found:
+                    return found
                 else:
                     return None,None,None
             else:
                 return None,None,None
         
         else:
-            if self.start_date == None:
-                start = datetime.date(1,1,1)
-            else:
-                start = self.start_date
-            
-            if self.stop_date == None:
-                stop = datetime.date(2100,1,1)
-            else:
-                stop = self.stop_date
-            
-            mask = [(self._caldate >= start) & (self._caldate <= stop)]
-            dates = self._caldate[mask]
-            cals = self._calcons[mask]
-            goal = self._calgoal[mask]
-            
-            #Now bin the data
-            if binsize>=1 and cals.size:
-                bindates,cals = self.binned(dates,cals,binsize)
-                bindates,goal = self.binned(dates,goal,binsize)
-                return bindates,cals,goal
-            else:
-                print "Binsize must be >= 1."
-                return None,None,None
+            key = ('calorie',self._range_version(DB_CAL),self.start_date,self.stop_date,binsize,how)
+            return self._cached(key,self._calorie_range,binsize,how)
+    
+    def _calorie_range(self,binsize,how):
+        """get_calorie_data over the start/stop window (not cached)"""
+        if self.start_date == None:
+            start = datetime.date(1,1,1)
+        else:
+            start = self.start_date
+        
+        if self.stop_date == None:
+            stop = datetime.date(2100,1,1)
+        else:
+            stop = self.stop_date
+        
+        dates,cals,goal = self._window(DB_CAL,start,stop)[:3]
+        
+        #Now bin the data
+        if binning.valid_binsize(binsize) and cals.size:
+            bindates,cals = self.binned(dates,cals,binsize,how = how)
+            bindates,goal = self.binned(dates,goal,binsize,how = how)
+            return bindates,cals,goal
+        else:
+            print "Binsize must be >= 1."
+            return None,None,None
     
-    def get_weight_data(self,date = None,binsize = 1):
+    @instrument.timed()
+    def get_weight_data(self,date = None,binsize = 1,how = 'sum'):
         """Get weight info for a given date (see get_calorie_info)"""
         if date:
+            self._ensure_loaded(DB_WGT)
             date = self._set_date_(date)
             if date:
-                mask = [self._wtdate <= date]
-                wt = self._wt[mask]
-                
-                if wt.size:
-                    return_wt = wt[wt>0][-1]
-                    dt = self._wtdate[mask][-1]
-                    return dt,return_wt
+                found = self._lookup_one('weight',date)
+                if found:
+                    return found
                 else:
                     return None,None
             else:
                 return None,None
         
         else:
-            if self.start_date == None:
-                start = datetime.date(1,1,1)
-            else:
-                start = self.start_date
-            
-            if self.stop_date == None:
-                stop = datetime.date(2100,1,1)
-            else:
-                stop = self.stop_date
-            
-            mask = [(self._wtdate >= start) & (self._wtdate <= stop)]
-            dates = self._wtdate[mask]
-            wt = self._wt[mask]
-            
-            #Now bin the data
-            if binsize>=1:
-                if wt.size:
-                    bindates,wt = self.binned(dates,wt,binsize)
-                    return bindates,wt
-                else:
-                    print "No weight data within selected dates."
-                    return None,None
+            key = ('weight',self._range_version(DB_WGT),self.start_date,self.stop_date,binsize,how)
+            return self._cached(key,self._weight_range,binsize,how)
+    
+    def _weight_range(self,binsize,how):
+        """get_weight_data over the start/stop window (not cached)"""
+        if self.start_date == None:
+            start = datetime.date(1,1,1)
+        else:
+            start = self.start_date
+        
+        if self.stop_date == None:
+            stop = datetime.date(2100,1,1)
+        else:
+            stop = self.stop_date
+        
+        dates,wt = self._window(DB_WGT,start,stop)
+        
+        #Now bin the data
+        if binning.valid_binsize(binsize):
+            if wt.size:
+                bindates,wt = self.binned(dates,wt,binsize,how = how)
+                return bindates,wt
             else:
-                print "Binsize must be >= 1."
+                print "No weight data within selected dates."
                 return None,None
+        else:
+            print "Binsize must be >= 1."
+            return None,None
             
-    def get_run_data(self,date = None,binsize = 1):
+    @instrument.timed()
+    def get_run_data(self,date = None,binsize = 1,how = 'sum'):
         """Get data from runs"""
         if date:
+            self._ensure_loaded(DB_RUN)
             date = self._set_date_(date)
             if date:
-                mask = [self._rundate <= date]
-                dist = self._rundist[mask]
-                time = self._runtime[mask]
-                
-                if dist.size and time.size:
-                    return_dist = dist[dist>0][-1]
-                    return_time = time[dist>0][-1]
-                    return date,return_dist,return_time
+                found = self._lookup_one('run',date)
+                if found:
+                    return found
                 else:
                     return None,None,None
             else:
                 return None,None,None
         
         else:
-            if self.start_date == None:
-                start = datetime.date(1,1,1)
-            else:
-                start = self.start_date
-            
-            if self.stop_date == None:
-                stop = datetime.date(2100,1,1)
-            else:
-                stop = self.stop_date
-            
-            mask = [(self._rundate >= start) & (self._rundate <= stop)]
-            dates = self._rundate[mask]
-            dist = self._rundist[mask]
-            time = self._runtime[mask]
+            key = ('run',self._range_version(DB_RUN),self.start_date,self.stop_date,binsize,how)
+            return self._cached(key,self._run_range,binsize,how)
+    
+    def _run_range(self,binsize,how):
+        """get_run_data over the start/stop window (not cached)"""
+        if self.start_date == None:
+            start = datetime.date(1,1,1)
+        else:
+            start = self.start_date
+        
+        if self.stop_date == None:
+            stop = datetime.date(2100,1,1)
+        else:
+            stop = self.stop_date
+        
+        dates,dist,time = self._window(DB_RUN,start,stop)
+        
+        #Now bin the data
+        if binning.valid_binsize(binsize) and dist.size:
+            bindates,dist = self.binned(dates,dist,binsize,how = how)
+            bindates,time = self.binned(dates,time,binsize,how = how)
+            return bindates,dist,time
+        else:
+            print "Binsize must be >=1."
+            return None,None,None
             
-            #Now bin the data
-            if binsize>=1 and dist.size:
-                bindates,dist = self.binned(dates,dist,binsize)
-                bindates,time = self.binned(dates,time,binsize)
-                return bindates,dist,time
+    def _window(self,fname,start,stop):
+        """Columns of a db file from start to stop (dates). An indexed
+        storage reads just those rows if the file is not loaded yet."""
+        if fname not in self._loaded and self.storage.indexed and self.storage.exists(fname):
+            cols = self.storage.load(fname,start.toordinal(),stop.toordinal())
+            if fname == DB_CAL:
+                #Mask these guys, as _load does
+                cols[1:3] = [np.ma.masked_where(col < 0,col) for col in cols[1:3]]
+            return cols
+        self._ensure_loaded(fname)
+        cols = [getattr(self,attr) for attr in DB_ATTRS[fname]]
+        mask = (cols[0] >= start.toordinal()) & (cols[0] <= stop.toordinal())
+        return [col[mask] for col in cols]
+    
+    def _range_version(self,fname):
+        """Version of the rows _window reads"""
+        if fname not in self._loaded and self.storage.indexed:
+            return ('storage',self.storage.version(fname))
+        self._ensure_loaded(fname)
+        return self._versions.get(fname)
+    
+    def _date_index(self,fname):
+        """Sorted date index over the valid rows of a db file"""
+        if fname in self._index:
+            instrument.count('cache.date_index.hit')
+        else:
+            instrument.count('cache.date_index.miss')
+            if fname == DB_CAL:
+                valid = ~np.ma.getmaskarray(self._calcons)
+            elif fname == DB_WGT:
+                valid = np.asarray(self._wt) > 0
             else:
-                print "Binsize must be >=1."
-                return None,None,None
+                valid = np.asarray(self._rundist) > 0
+            self._index[fname] = dateindex.DateIndex(getattr(self,DB_ATTRS[fname][0]),valid)
+        return self._index[fname]
+    
+    def _lookup_one(self,dataset,date):
+        """lookup for a single date: (date, values...) or None"""
+        fname,attrs = DATASETS[dataset]
+        row = self._date_index(fname).latest(date.toordinal())
+        if row < 0:
+            return None
+        return_list = [datetime.date.fromordinal(int(getattr(self,DB_ATTRS[fname][0])[row]))]
+        for attr in attrs:
+            return_list.append(np.ma.getdata(getattr(self,attr))[row])
+        return tuple(return_list)
+    
+    @instrument.timed()
+    def lookup(self,dataset,dates):
+        """Latest valid entry on or before each of 'dates' ('calorie',
+        'weight' or 'run'), found by binary search in one vectorized call.
+        Returns aligned arrays: the date of each entry found (None if
+        there is none) followed by its values (masked if there is none)."""
+        fname,attrs = DATASETS[dataset]
+        self._ensure_loaded(fname)
+        query = np.asarray(dates)
+        if query.dtype.kind in 'SU':
+            query = np.array([self._set_date_(d) for d in query.ravel()])
+        rows = self._date_index(fname).latest(binning.to_ordinals(query))
+        found = rows >= 0
+        
+        return_dates = np.empty(rows.shape,dtype = object)
+        return_dates[found] = binning.to_dates(getattr(self,DB_ATTRS[fname][0])[rows[found]])
+        return_list = [return_dates]
+        for attr in attrs:
+            col = np.ma.getdata(getattr(self,attr))
+            values = np.ma.masked_all(rows.shape)
+            values[found] = col[rows[found]]
+            return_list.append(values)
+        return tuple(return_list)
             
+    @instrument.timed()
+    def daily_frame(self,fill = 'interpolate'):
+        """Calories, weight and runs on one daily axis covering the
+        start/stop window (see dailyframe). fill is how days without a
+        weigh-in get a weight: 'interpolate', 'ffill' or None (NaN)."""
+        for fname in (DB_CAL,DB_WGT,DB_RUN):
+            self._ensure_loaded(fname)
+        key = ('frame',self._versions.get(DB_CAL),self._versions.get(DB_WGT),
+               self._versions.get(DB_RUN),self.start_date,self.stop_date,fill)
+        return self._cached(key,self._daily_frame,fill)
+    
+    def _daily_frame(self,fill):
+        """daily_frame (not cached)"""
+        first = last = None
+        if self.start_date != None:
+            first = self.start_date.toordinal()
+        if self.stop_date != None:
+            last = self.stop_date.toordinal()
+        return dailyframe.DailyFrame.from_columns((self._caldate,self._calcons,self._calgoal),
+                                                  (self._wtdate,self._wt),
+                                                  (self._rundate,self._rundist,self._runtime),
+                                                  first,last,fill)
+    
+    @instrument.timed()
+    def run_analytics(self):
+        """RunAnalytics over every run in DB_RUN (see runs). It is kept
+        between calls and only extended with the runs a refresh added."""
+        self._ensure_loaded(DB_RUN)
+        state = self._runs
+        nrows = len(self._rundate)
+        n = len(state) if state != None else 0
+        #Rebuild unless the rows it was built from are still in place
+        if state == None or n > nrows or (n and (state.ords[-1] != self._rundate[n - 1] or
+                                                 state.dist[-1] != self._rundist[n - 1])):
+            instrument.count('runs.rebuild')
+            state = runs.RunAnalytics(self._rundate,self._rundist,self._runtime)
+        elif n < nrows:
+            instrument.count('runs.extend')
+            state.extend(self._rundate[n:],self._rundist[n:],self._runtime[n:])
+        self._runs = state
+        return state
+    
+    def plot_dashboard(self,directory = 'charts',names = charts.CHARTS,processes = None,**size):
+        """Render the weight, calorie and mileage charts of the start/stop
+        window into 'directory', downsampled to the figure width and drawn
+        in worker processes (see charts). Returns {name: path}."""
+        return charts.dashboard(self,directory,names,processes = processes,**size)
+    
     def BMI(self,wt = None):
         if wt == None:
             dt,wt = self.get_weight_data(datetime.date.today())
@@ -457,52 +1005,93 @@ class FitnessData(object):
         return wt
             
         
-    def binned(self,x,y,binsize,xdates = True,avg = False):
-        """Take x and y data and bin them into 'binsize' size bins."""
-        #If x axis are date objects
-        binsize = float(binsize)
+    @instrument.timed()
+    def binned(self,x,y,binsize,xdates = True,avg = False,how = None):
+        """Take x and y data and bin them into 'binsize' size bins.
+        binsize is a width in days or 'week'/'month' for calendar bins.
+        how is one of binning.AGGREGATIONS (default sum, or mean if avg)."""
+        if how == None:
+            how = 'mean' if avg else 'sum'
+        #If x axis are date objects work on day ordinals
         if xdates:
-            #Define the x axis bins
-            dayspan = (x[-1] - x[0]).days + binsize
-            bincenters = np.arange(0., dayspan, binsize)
-            bincenters_dates = np.array([x[0] + datetime.timedelta(days = b) for b in bincenters])
-            data = np.zeros_like(bincenters)
-            
-            for i in range(data.size):
-                left = bincenters_dates[i] - datetime.timedelta(days = binsize / 2)
-                right = bincenters_dates[i] + datetime.timedelta(days = binsize /2)
-                
-                mask = [(x>=left) & (x<=right)]
-                datamsk = y[mask]
-                
-                if avg:
-                    data[i] = datamsk.mean()
-                else:
-                    data[i] = datamsk.sum()
-                
-            return bincenters_dates,data
+            ords = binning.to_ordinals(x)
+        else:
+            ords = np.asarray(x).astype(np.int64)
+        labels,data = binning.bin_ordinals(ords,y,binsize,how)
+        instrument.count('bins_computed',len(labels))
+        if xdates:
+            labels = binning.to_dates(labels)
+        return labels,data
                 
-    def weight_slope(self):
-        """Linear fit to weight"""
-        date,wt = self.get_weight_data()
-        
-        if type(date)!=type(None) and type(wt)!=type(None):
-            mask = [wt > 0]
-            date = date[mask]
-            wt = wt[mask]
+    def _cached(self,key,compute,*args):
+        """Derived result for key from the cache, computed on a miss.
+        Keys hold the db version and the window, so a reload or a new
+        start/stop window never sees an old result. Cached arrays are
+        shared, treat them as read only. Failures are not cached."""
+        value = self.cache.get(key)
+        if value is cache.MISSING:
+            value = compute(*args)
+            if value is not None and not (isinstance(value,tuple) and value[0] is None):
+                self.cache.put(key,value)
+        return value
+    
+    def cache_info(self):
+        """Hit/miss counters of the derived-result cache"""
+        return self.cache.info()
+    
+    def _trend_args(self,model,window):
+        """Model and window to use, the instance defaults if None"""
+        if model == None:
+            model = self.trend_model
+        if window == None:
+            window = self.trend_window
+        return model,window
+    
+    @instrument.timed()
+    def weight_trend(self,model = None,window = None):
+        """Weight trend over the start/stop window by 'model' (see trend),
+        one row per day from the first to the last weigh-in. Returns
+        (dates, level, slope in lbs/day)."""
+        model,window = self._trend_args(model,window)
+        self._ensure_loaded(DB_WGT)
+        key = ('weight',self._versions.get(DB_WGT),self.start_date,self.stop_date,'trend',model,window)
+        return self._cached(key,self._weight_trend,model,window)
+    
+    def _weight_trend(self,model,window):
+        """weight_trend (not cached)"""
+        if self.start_date == None:
+            start = datetime.date(1,1,1)
         else:
-            return None
+            start = self.start_date
         
-        if wt.size > 1:
-            days = (date[-1] - date[0]).days
-            wt_diff = wt[-1] - wt[0]
-            slope = wt_diff / days
-            return slope
+        if self.stop_date == None:
+            stop = datetime.date(2100,1,1)
         else:
+            stop = self.stop_date
+        
+        mask = (self._wtdate >= start.toordinal()) & (self._wtdate <= stop.toordinal())
+        days,level,slope = trend.fit(self._wtdate[mask],self._wt[mask],model,window)
+        if not days.size:
+            return None,None,None
+        return binning.to_dates(days),level,slope
+    
+    def _trend_now(self,model,window):
+        """(date, level, slope) of the trend at the last weigh-in, or None"""
+        dates,level,slope = self.weight_trend(model,window)
+        if dates is None or np.isnan(slope[-1]):
             return None
+        return dates[-1],float(level[-1]),float(slope[-1])
+    
+    def weight_slope(self,model = None,window = None):
+        """Slope of the weight trend (lbs/day) as of the last weigh-in"""
+        now = self._trend_now(model,window)
+        if now:
+            return now[2]
+        return None
     
-    def projected_weight(self,date):
-        """At current pace what will my weight be by 'date'"""
+    def projected_weight(self,date,model = None,window = None):
+        """At current pace what will my weight be by 'date'. The pace and
+        the starting weight come from the trend 'model'."""
         date = self._set_date_(date)
         if date:
             if type(date) == datetime.datetime:
@@ -510,25 +1099,42 @@ class FitnessData(object):
             if type(date) == datetime.date:
                 today = datetime.date.today()
             
-            dt,cur_wt = self.get_weight_data(today)
+            model,window = self._trend_args(model,window)
+            self._ensure_loaded(DB_WGT)
+            key = ('weight',self._versions.get(DB_WGT),self.start_date,self.stop_date,
+                   'projected_weight',date,today,model,window)
+            return self._cached(key,self._projected_weight,date,model,window)
+        else:
+            return None
+    
+    def _projected_weight(self,date,model,window):
+        """projected_weight (not cached)"""
+        now = self._trend_now(model,window)
+        if now and now[2]:
+            dt,cur_wt,slope = now
             days = (date - dt).days
-            slope = self.weight_slope()
-            if slope:
-                proj_wt = cur_wt + slope * days
-                return proj_wt
-            else:
-                print "Not enough data."
-                return None
+            proj_wt = cur_wt + slope * days
+            return proj_wt
         else:
+            print "Not enough data."
             return None
     
-    def projected_date(self,weight):
+    def projected_date(self,weight,model = None,window = None):
         """At current pace what day will my weight be 'weight'"""
+        today = datetime.date.today()
+        model,window = self._trend_args(model,window)
+        self._ensure_loaded(DB_WGT)
+        key = ('weight',self._versions.get(DB_WGT),self.start_date,self.stop_date,
+               'projected_date',weight,today,model,window)
+        return self._cached(key,self._projected_date,weight,model,window)
+    
+    def _projected_date(self,weight,model,window):
+        """projected_date (not cached)"""
         #current wt + slope * ? = weight
         #? = (weight - current wt ) / slope
-        dt,cur_wt = self.get_weight_data(datetime.date.today())
-        slope = self.weight_slope()
-        if slope:
+        now = self._trend_now(model,window)
+        if now and now[2]:
+            dt,cur_wt,slope = now
             days = (weight - cur_wt) / slope
             date = dt + datetime.timedelta(days = days)
             return date
@@ -536,32 +1142,111 @@ class FitnessData(object):
             print "Not enough data."
             return None
         
-    def print_weight_summary(self):
-        """Print a summary"""
+    def _trend_samples(self,window,resamples,method,block,seed):
+        """Bootstrapped (last weigh-in date, levels, slopes) of the least
+        squares trend over the start/stop window and the last 'window'
+        days. Cached when the seed is fixed."""
+        window = self._trend_args(None,window)[1]
+        self._ensure_loaded(DB_WGT)
+        args = (window,resamples,method,block,seed)
+        if seed == None:
+            return self._trend_samples_(*args)
+        key = ('weight',self._versions.get(DB_WGT),self.start_date,self.stop_date,'bootstrap') + args
+        return self._cached(key,self._trend_samples_,*args)
+    
+    def _trend_samples_(self,window,resamples,method,block,seed):
+        """_trend_samples (not cached)"""
+        first = datetime.date(1,1,1) if self.start_date == None else self.start_date
+        last = datetime.date(2100,1,1) if self.stop_date == None else self.stop_date
+        mask = (self._wtdate >= first.toordinal()) & (self._wtdate <= last.toordinal()) & (self._wt > 0)
+        days = self._wtdate[mask]
+        wt = self._wt[mask]
+        if window != None and days.size:
+            recent = days > days.max() - window
+            days,wt = days[recent],wt[recent]
+        if days.size < 3:
+            print "Not enough data."
+            return None,None,None
+        #x = 0 on the last weigh-in, the levels are the trend weight there
+        levels,slopes = bootstrap.resample_fits(days - days.max(),wt,resamples,method,block,seed)
+        return datetime.date.fromordinal(int(days.max())),levels,slopes
+    
+    def projected_weight_interval(self,dates,percentiles = BOOTSTRAP_PERCENTILES,window = None,
+                                  resamples = BOOTSTRAP_RESAMPLES,method = 'wild',block = 1,seed = None):
+        """Monte Carlo bands of the weight on each of 'dates' at the
+        current least-squares pace (see bootstrap). Returns (dates,
+        bands) where bands[i] holds the percentiles[i] weights."""
+        dates = np.array([self._set_date_(d) for d in np.atleast_1d(dates)],dtype = object)
+        last,levels,slopes = self._trend_samples(window,resamples,method,block,seed)
+        if last == None or None in dates:
+            return None,None
+        days = binning.to_ordinals(dates) - last.toordinal()
+        return dates,bootstrap.weight_bands(levels,slopes,days,percentiles)
+    
+    def projected_date_interval(self,weights,percentiles = BOOTSTRAP_PERCENTILES,window = None,
+                                resamples = BOOTSTRAP_RESAMPLES,method = 'wild',block = 1,seed = None):
+        """Monte Carlo bands of the day each of 'weights' is reached at
+        the current least-squares pace. Returns (weights, bands, reached):
+        bands[i] holds the percentiles[i] dates (None if that percentile
+        never gets there), reached the fraction of resamples that do."""
+        weights = np.atleast_1d(np.asarray(weights,dtype = np.float64))
+        last,levels,slopes = self._trend_samples(window,resamples,method,block,seed)
+        if last == None:
+            return None,None,None
+        days,reached = bootstrap.date_bands(levels,slopes,weights,percentiles)
+        bands = np.empty(days.shape,dtype = object)
+        finite = np.isfinite(days)
+        bands[finite] = binning.to_dates(last.toordinal() + np.round(days[finite]).astype(np.int64))
+        return weights,bands,reached
+    
+    def weight_summary(self,percentiles = (5,95)):
+        """What print_weight_summary reports, as a dict (None without a
+        weigh-in): date, weight, bmi, status (obese, overweight or
+        healthy), slope (lbs/day) and for each BMI goal still ahead its
+        weight, projected date and the 'percentiles' dates of
+        projected_date_interval (None if one is never reached)."""
         BMI_DICT = {"Overweight":self.weight_from_BMI(30.),"Healthy":self.weight_from_BMI(25.)}
         today = datetime.date.today()
         last_meas,current_wt = self.get_weight_data(today)
-        if current_wt:
-            current_bmi = self.BMI(current_wt)
-            slope = self.weight_slope()
-            
-            print "As of %s, you weigh %.1f lbs (BMI = %.1f)."%(last_meas,current_wt,current_bmi)
+        if not current_wt:
+            return None
+        if current_wt >= BMI_DICT['Overweight']:
+            status = 'obese'
+        elif current_wt >= BMI_DICT['Healthy']:
+            status = 'overweight'
+        else:
+            status = 'healthy'
+        goals = []
+        for key in sorted(BMI_DICT.keys(),reverse = True):
+            wt = BMI_DICT[key]
+            if current_wt > wt:
+                wts,bands,reached = self.projected_date_interval(wt,percentiles)
+                interval = None
+                if bands is not None and None not in bands[:,0]:
+                    interval = tuple(bands[:,0])
+                goals.append({'goal':key.lower(),'weight':wt,'date':self.projected_date(wt),
+                              'interval':interval})
+        return {'date':last_meas,'weight':float(current_wt),'bmi':self.BMI(current_wt),
+                'status':status,'slope':self.weight_slope(),'goals':goals}
+    
+    def print_weight_summary(self):
+        """Print a summary"""
+        summary = self.weight_summary()
+        if summary:
+            print "As of %s, you weigh %.1f lbs (BMI = %.1f)."%(summary['date'],summary['weight'],summary['bmi'])
             
-            if current_wt >= BMI_DICT['Overweight']:
-                print "You are currently obese."
-            elif current_wt < BMI_DICT['Overweight'] and current_wt >= BMI_DICT['Healthy']:
-                print "You are currently overweight."
-            else:
+            if summary['status'] == 'healthy':
                 print "You are currently at a healthy weight."
+            else:
+                print "You are currently %s."%summary['status']
             
-            if slope:
-                print "You are losing %.1f lbs per week."%(slope * -7)
+            if summary['slope']:
+                print "You are losing %.1f lbs per week."%(summary['slope'] * -7)
                 
-            for key in sorted(BMI_DICT.keys(),reverse = True):
-                wt = BMI_DICT[key]
-                if current_wt > wt:
-                    wtdate = self.projected_date(wt)
-                    print "You will weigh %.1f (%s) by %s."%(wt,key.lower(),wtdate)
+            for goal in summary['goals']:
+                print "You will weigh %.1f (%s) by %s."%(goal['weight'],goal['goal'],goal['date'])
+                if goal['interval']:
+                    print "\t90%% likely between %s and %s."%goal['interval']
             
         
             
@@ -0,0 +1,154 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Timers and counters for the hot paths of FitnessData.
+
+Instrumentation is off by default; every hook then returns after one
+flag check. Turn it on with enable() (or FITNESS_INSTRUMENT=1 in the
+environment), run the slow sync or query and look at stats(), or write
+it out with dump_json(). profile() wraps a block in cProfile.
+
+    import instrument
+    instrument.enable()
+    fd = FitnessData()
+    print instrument.stats()
+"""
+
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+
+_enabled = bool(os.environ.get('FITNESS_INSTRUMENT'))
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+
+def enable(on = True):
+    """Switch instrumentation on (or off)"""
+    global _enabled
+    _enabled = bool(on)
+
+def disable():
+    enable(False)
+
+def enabled():
+    return _enabled
+
+def reset():
+    """Forget everything recorded so far"""
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+def count(name,n = 1):
+    """Add n to the counter 'name'"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name,0) + n
+
+def add_time(name,seconds):
+    """Record one call of 'name' that took 'seconds'"""
+    with _lock:
+        calls,total,worst = _timers.get(name,(0,0.,0.))
+        _timers[name] = (calls + 1,total + seconds,max(worst,seconds))
+
+class _Timer(object):
+    """Context manager timing a block"""
+    __slots__ = ('name','start')
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self,*exc):
+        add_time(self.name,time.time() - self.start)
+
+class _Null(object):
+    """Context manager doing nothing, used while disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        pass
+
+_NULL = _Null()
+
+def timer(name):
+    """with timer('name'): ... times the block"""
+    if not _enabled:
+        return _NULL
+    return _Timer(name)
+
+def timed(name = None):
+    """Decorator timing every call of a function"""
+    def decorate(func):
+        label = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            if not _enabled:
+                return func(*args,**kwargs)
+            start = time.time()
+            try:
+                return func(*args,**kwargs)
+            finally:
+                add_time(label,time.time() - start)
+        return wrapper
+    return decorate
+
+def stats():
+    """Snapshot of the timers and counters"""
+    with _lock:
+        timers = {}
+        for name,(calls,total,worst) in _timers.items():
+            timers[name] = {'calls':calls,'total':total,'mean':total / calls,'max':worst}
+        return {'enabled':_enabled,'timers':timers,'counters':dict(_counters)}
+
+def dump_json(fname):
+    """Write stats() to a JSON file"""
+    with open(fname,'w') as f:
+        json.dump(stats(),f,indent = 1,sort_keys = True)
+
+class profile(object):
+    """with profile('out.prof'): ... runs the block under cProfile and
+    dumps the stats (readable with pstats) when it ends"""
+    def __init__(self,fname):
+        self.fname = fname
+        self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        self.profiler.enable()
+        return self.profiler
+
+    def __exit__(self,*exc):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.fname)
+
+class CountingClient(object):
+    """Wrap an API client so every method call is counted and timed
+    as 'api.<name>.<method>'"""
+    def __init__(self,client,name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self,attr):
+        value = getattr(self._client,attr)
+        if not callable(value):
+            return value
+        label = 'api.%s.%s'%(self._name,attr)
+        @functools.wraps(value)
+        def call(*args,**kwargs):
+            if not _enabled:
+                return value(*args,**kwargs)
+            count(label)
+            start = time.time()
+            try:
+                return value(*args,**kwargs)
+            finally:
+                add_time(label,time.time() - start)
+        return call
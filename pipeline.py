@@ -0,0 +1,197 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Pipelined sync: logins, fetches and writes of every dataset at once.
+
+A Stage is one dataset: 'fetch' returns an iterable of items (lines,
+activities, ...) and 'write' consumes an iterable of them into its db
+file. run() gives every stage two threads, a fetcher feeding a bounded
+queue and a writer draining it, so rows are written while the rest is
+still being fetched and a slow writer holds the fetcher back instead of
+piling up items. Stages log in to their service first; each service is
+logged in to once, in its own thread, as soon as the run starts. A sync
+then takes about as long as its slowest stage instead of the sum.
+
+A stage that fails (login, fetch or write) stops on its own and is
+reported with its error; the others carry on. run() returns the wall
+time and, per stage, when its login, first item, fetch and write were
+done (seconds from the start), the items passed and how long the
+fetcher waited on a full queue.
+"""
+
+import threading
+import timeit
+import Queue
+
+import instrument
+
+#Items a stage may fetch ahead of its writer
+QUEUE_SIZE = 64
+
+#Queue put/get timeout (s) while watching for a failed partner thread
+POLL = 0.1
+
+class _End(object):
+    """Marks the end of a stage's items, with the fetch error if any"""
+    def __init__(self,error = None):
+        self.error = error
+
+class Login(object):
+    """Client made by make(*args) in a thread; get() waits for it. An
+    exception in make is raised by get()."""
+    def __init__(self,make,*args):
+        self.client = None
+        self.error = None
+        self.seconds = None
+        self._thread = threading.Thread(target = self._run,args = (make,args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self,make,args):
+        start = timeit.default_timer()
+        try:
+            self.client = make(*args)
+        except BaseException as e:
+            self.error = e
+        self.seconds = timeit.default_timer() - start
+
+    def get(self):
+        self._thread.join()
+        if self.error != None:
+            raise self.error
+        return self.client
+
+class Stage(object):
+    """One dataset of a sync. fetch() returns the items, write(items)
+    stores them; 'service' names the login the stage waits for (None
+    for none)."""
+    def __init__(self,name,fetch,write,service = None):
+        self.name = name
+        self.fetch = fetch
+        self.write = write
+        self.service = service
+
+class _Run(object):
+    """State and timings of one stage while it runs"""
+    def __init__(self,stage,login,start,queue_size):
+        self.stage = stage
+        self.login = login
+        self.start = start
+        self.queue = Queue.Queue(queue_size)
+        self.failed = threading.Event()
+        self.stats = {'items':0,'login':None,'first_item':None,'fetched':None,'written':None,
+                      'blocked':0.,'error':None}
+
+    def _now(self):
+        return timeit.default_timer() - self.start
+
+    def _fail(self,e):
+        if self.stats['error'] == None:
+            self.stats['error'] = '%s: %s'%(type(e).__name__,e)
+        self.failed.set()
+
+    def _put(self,item):
+        """Queue an item, False if the writer gave up"""
+        start = timeit.default_timer()
+        while not self.failed.is_set():
+            try:
+                self.queue.put(item,timeout = POLL)
+                self.stats['blocked'] += timeit.default_timer() - start
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def fetch(self):
+        error = None
+        try:
+            if self.login != None:
+                client = self.login.get()
+                self.stats['login'] = self._now()
+                if client == None:
+                    raise RuntimeError("No %s client."%self.stage.service)
+            for item in self.stage.fetch():
+                if self.stats['first_item'] == None:
+                    self.stats['first_item'] = self._now()
+                if not self._put(item):
+                    return
+                self.stats['items'] += 1
+        except BaseException as e:
+            error = e
+        self.stats['fetched'] = self._now()
+        self._put(_End(error))
+
+    def items(self):
+        """Queued items, until the end mark (raising its error)"""
+        while True:
+            try:
+                item = self.queue.get(timeout = POLL)
+            except Queue.Empty:
+                continue
+            if isinstance(item,_End):
+                if item.error != None:
+                    raise item.error
+                return
+            yield item
+
+    def write(self):
+        try:
+            self.stage.write(self.items())
+        except BaseException as e:
+            self._fail(e)
+        self.stats['written'] = self._now()
+
+@instrument.timed('pipeline.run')
+def run(stages,login = None,concurrent = True,queue_size = QUEUE_SIZE):
+    """Run the stages, concurrently or (concurrent = False) one after
+    another in this thread. login(service) makes the client of a
+    service. Returns {'wall': seconds, 'concurrent', 'stages': {name:
+    stats}}."""
+    start = timeit.default_timer()
+    services = []
+    for stage in stages:
+        if stage.service != None and stage.service not in services:
+            services.append(stage.service)
+    logins = {}
+    runs = []
+    if concurrent:
+        #Every login at once, before any stage needs it
+        for service in services:
+            logins[service] = Login(login,service)
+        runs = [_Run(stage,logins.get(stage.service),start,queue_size) for stage in stages]
+        threads = []
+        for state in runs:
+            for target in (state.fetch,state.write):
+                thread = threading.Thread(target = target,name = '%s.%s'%(state.stage.name,target.__name__))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+    else:
+        for stage in stages:
+            if stage.service != None and stage.service not in logins:
+                logins[stage.service] = Login(login,stage.service)
+            #Unbounded: the writer only starts once everything is fetched
+            state = _Run(stage,logins.get(stage.service),start,0)
+            state.fetch()
+            state.write()
+            runs.append(state)
+    stats = {'wall':timeit.default_timer() - start,'concurrent':concurrent,'stages':{},'logins':{}}
+    for state in runs:
+        stats['stages'][state.stage.name] = state.stats
+        if state.stats['error']:
+            print "%s failed: %s"%(state.stage.name,state.stats['error'])
+        instrument.count('pipeline.items',state.stats['items'])
+    for service,login in logins.items():
+        stats['logins'][service] = login.seconds
+    return stats
+
+def summary(stats):
+    """One line: wall time and when each stage was done"""
+    parts = []
+    for name in sorted(stats['stages']):
+        stage = stats['stages'][name]
+        done = stage['written'] if stage['written'] != None else stage['fetched']
+        parts.append('%s %d rows %.2f s%s'%(name,stage['items'],done or 0,' FAILED' if stage['error'] else ''))
+    return 'Synced in %.2f s (%s)'%(stats['wall'],', '.join(parts))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of myfitnesspal/strava responses, with record/replay.
+
+CachingClient wraps a client and answers get_date, get_measurements,
+get_activities and get_athlete from a ResponseStore, a size-bounded
+directory of pickled responses keyed by the request. Responses are
+reduced to the fields FitnessData uses, so they pickle without the
+client behind them.
+
+How long an answer stays good:
+    get_date of a logged day  forever once the day is FINAL_DAYS old
+                              (a late log can still change a recent or
+                              empty day)
+    get_activities before=    forever if 'before' is in the past
+    get_activity_streams      forever, but only recorded and replayed:
+                              the stream archive keeps them (streams), in
+                              cache mode they would crowd out the rest
+    everything else           TTL seconds
+
+Modes:
+    cache    answer from the store while fresh, fetch and store otherwise
+    record   always fetch and store (capture a real sync)
+    replay   only answer from the store, ignoring ages; a request that
+             was never recorded raises ReplayMiss. No client is needed,
+             so syncs and benchmarks run offline.
+    off      pass every call through
+"""
+
+import cPickle as pickle
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+import instrument
+
+MODES = ('cache','record','replay','off')
+
+#Seconds an answer that may still change is kept
+TTL = 3600.
+
+#A logged day this many days old no longer changes
+FINAL_DAYS = 7
+
+#Store size bound
+MAX_BYTES = 64 << 20
+
+CACHED_METHODS = ('get_date','get_measurements','get_activities','get_athlete')
+
+#Methods only recorded and replayed, passed through in cache mode
+RECORDED_METHODS = ('get_activity_streams',)
+
+class ReplayMiss(LookupError):
+    """A replayed request that was never recorded"""
+
+class CachedDay(object):
+    """What FitnessData uses of a myfitnesspal Day"""
+    def __init__(self,date,totals,goals):
+        self.date = date
+        self.totals = totals
+        self.goals = goals
+
+class Quantity(object):
+    """Distance with the .num of a units quantity"""
+    def __init__(self,num):
+        self.num = num
+
+class CachedActivity(object):
+    """What FitnessData uses of a stravalib Activity (start_date in UTC)"""
+    def __init__(self,id,type,start_date,start_date_local,distance,elapsed_time):
+        self.id = id
+        self.type = type
+        self.start_date = start_date
+        self.start_date_local = start_date_local
+        self.distance = Quantity(distance)
+        self.elapsed_time = elapsed_time
+
+class CachedAthlete(object):
+    def __init__(self,id,created_at):
+        self.id = id
+        self.created_at = created_at
+
+def _naive_utc(dt):
+    if getattr(dt,'tzinfo',None) != None:
+        dt = dt.replace(tzinfo = None) - dt.utcoffset()
+    return dt
+
+def _num(quantity):
+    return float(getattr(quantity,'num',quantity))
+
+def reduce_activity(act):
+    return CachedActivity(act.id,act.type,_naive_utc(act.start_date),act.start_date_local,
+                          _num(act.distance),act.elapsed_time)
+
+def reduce_response(method,value):
+    """Picklable copy of the parts of a response FitnessData uses"""
+    if method == 'get_date':
+        return CachedDay(getattr(value,'date',None),dict(value.totals or {}),dict(value.goals or {}))
+    if method == 'get_measurements':
+        return value.copy() if hasattr(value,'copy') else dict(value)
+    if method == 'get_activities':
+        return [reduce_activity(act) for act in value]
+    if method == 'get_activity_streams':
+        #{type: samples}, streams.columns reads these like Stream objects
+        return dict((kind,list(getattr(stream,'data',stream))) for kind,stream in value.items())
+    return CachedAthlete(getattr(value,'id',None),_naive_utc(value.created_at))
+
+def _token(value):
+    """Stable text of a request argument"""
+    if isinstance(value,(datetime.date,datetime.datetime)):
+        return _naive_utc(value).isoformat()
+    return repr(value)
+
+def request_key(service,method,args,kwargs):
+    parts = [service,method] + [_token(a) for a in args]
+    parts += ['%s=%s'%(k,_token(kwargs[k])) for k in sorted(kwargs)]
+    return '|'.join(parts)
+
+def expiry(method,args,kwargs,now = None,value = None):
+    """Time after which an answer is stale (None: never)"""
+    now = now or time.time()
+    today = datetime.date.today()
+    if method == 'get_date':
+        date = args[0] if args else kwargs.get('date')
+        if isinstance(date,datetime.datetime):
+            date = date.date()
+        #Only a logged day past the finalization window is settled
+        if (isinstance(date,datetime.date) and date < today - datetime.timedelta(days = FINAL_DAYS) and
+                getattr(value,'totals',None)):
+            return None
+    if method == 'get_activity_streams':
+        return None
+    if method == 'get_activities':
+        before = kwargs.get('before')
+        if before != None and _naive_utc(before) < datetime.datetime.utcnow():
+            return None
+    return now + TTL
+
+class ResponseStore(object):
+    """Directory of pickled responses, least recently used ones removed
+    beyond max_bytes"""
+    def __init__(self,path,max_bytes = MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self,key):
+        return os.path.join(self.path,hashlib.sha1(key).hexdigest() + '.pkl')
+
+    def get(self,key):
+        """(expires, value) stored under key, or None"""
+        fname = self._file(key)
+        try:
+            with open(fname,'rb') as f:
+                stored_key,expires,value = pickle.load(f)
+        except (IOError,EOFError,pickle.UnpicklingError):
+            return None
+        if stored_key != key:
+            return None
+        #Mark as recently used
+        try:
+            os.utime(fname,None)
+        except OSError:
+            pass
+        return expires,value
+
+    def put(self,key,expires,value):
+        fname = self._file(key)
+        data = pickle.dumps((key,expires,value),pickle.HIGHEST_PROTOCOL)
+        tmp = '%s.%d.%d.tmp'%(fname,os.getpid(),threading.current_thread().ident)
+        with open(tmp,'wb') as f:
+            f.write(data)
+        os.rename(tmp,fname)
+        with self._lock:
+            sizes = self._index()
+            sizes[fname] = len(data)
+            if sum(sizes.values()) > self.max_bytes:
+                self._evict(sizes)
+
+    def _index(self):
+        if self._sizes == None:
+            self._sizes = {}
+            for name in os.listdir(self.path):
+                if name.endswith('.pkl'):
+                    fname = os.path.join(self.path,name)
+                    self._sizes[fname] = os.path.getsize(fname)
+        return self._sizes
+
+    def _evict(self,sizes):
+        """Remove least recently used files down to 3/4 of the bound"""
+        used = []
+        for fname in sizes:
+            try:
+                used.append((os.path.getmtime(fname),fname))
+            except OSError:
+                used.append((0,fname))
+        total = sum(sizes.values())
+        for mtime,fname in sorted(used):
+            if total <= self.max_bytes * 3 // 4:
+                break
+            total -= sizes.pop(fname)
+            instrument.count('respcache.evicted')
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+    def size(self):
+        with self._lock:
+            return sum(self._index().values())
+
+class CachingClient(object):
+    """Client wrapper answering the cached methods from a ResponseStore.
+    'client' may be None in replay mode."""
+    def __init__(self,client,store,service,mode = 'cache'):
+        if mode not in MODES:
+            raise ValueError("Unknown response cache mode '%s'."%mode)
+        self._client = client
+        self._store = store
+        self._service = service
+        self._mode = mode
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def __getattr__(self,attr):
+        if ((attr in CACHED_METHODS and self._mode != 'off') or
+                (attr in RECORDED_METHODS and self._mode in ('record','replay'))):
+            def call(*args,**kwargs):
+                return self._call(attr,args,kwargs)
+            return call
+        if self._client == None:
+            raise ReplayMiss("%s.%s is not recorded"%(self._service,attr))
+        return getattr(self._client,attr)
+
+    def _count(self,what):
+        with self._lock:
+            setattr(self,what,getattr(self,what) + 1)
+        instrument.count('respcache.%s.%s'%(self._service,what))
+
+    def _call(self,method,args,kwargs):
+        key = request_key(self._service,method,args,kwargs)
+        if self._mode != 'record':
+            found = self._store.get(key)
+            if found != None:
+                expires,value = found
+                if self._mode == 'replay' or expires == None or expires > time.time():
+                    self._count('hits')
+                    return value
+                self._count('expired')
+            if self._mode == 'replay':
+                self._count('misses')
+                raise ReplayMiss("%s was not recorded"%key)
+        self._count('misses')
+        value = getattr(self._client,method)(*args,**kwargs)
+        if method == 'get_activities':
+            return self._stream_activities(key,args,kwargs,value)
+        value = reduce_response(method,value)
+        self._store.put(key,expiry(method,args,kwargs,value = value),value)
+        return value
+
+    def _stream_activities(self,key,args,kwargs,acts):
+        """Yield the activities as the pages arrive, storing the list once
+        all of them came in (a partial list is never stored)"""
+        done = []
+        for act in acts:
+            act = reduce_activity(act)
+            done.append(act)
+            yield act
+        self._store.put(key,expiry('get_activities',args,kwargs),done)
+
+    def refreshing(self):
+        """Client on the same store that fetches every call again and
+        stores the answer (this one if replaying or off)"""
+        if self._mode in ('replay','off'):
+            return self
+        return CachingClient(self._client,self._store,self._service,'record')
+
+    def stats(self):
+        """Hits, misses, expired answers and the hit rate"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits':self.hits,'misses':self.misses,'expired':self.expired,
+                    'hit_rate':self.hits / float(total) if total else None}
@@ -0,0 +1,215 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Calendar-aligned run analytics over the rows of DB_RUN.
+
+RunAnalytics keeps weekly (ISO weeks, Monday to Sunday) and monthly
+totals, a daily distance series for training load, and the personal
+record progression for the standard distances. Everything is kept as
+arrays indexed from a fixed first period, so appending runs (extend)
+only touches the periods and days the new runs fall in. Per-run pace
+and pace percentiles per period are vectorized group-bys over the
+sorted day ordinals.
+
+Distances are in meters and times in seconds, as in DB_RUN. DB_RUN
+holds one total per run, so records are estimated from runs close to
+each distance at their average pace.
+"""
+
+import numpy as np
+
+import binning
+import dailyframe
+
+METERS_PER_MILE = 1609.344
+
+STANDARD_DISTANCES = (('1 mile',1609.344),('5k',5000.),('10k',10000.),
+                      ('half marathon',21097.5),('marathon',42195.))
+
+#A run counts toward a record distance when it is this close to it
+PR_RANGE = (0.98,1.05)
+
+#Acute and chronic training load windows (days)
+ACUTE_DAYS = 7
+CHRONIC_DAYS = 28
+
+def period(ords,binsize):
+    """Week (Mondays from 0001-01-01) or month number of day ordinals"""
+    ords = np.asarray(ords,dtype = np.int64)
+    if binsize == 'week':
+        return (ords - 1) // 7
+    if binsize == 'month':
+        return (ords - binning.EPOCH_ORD).astype('M8[D]').astype('M8[M]').astype(np.int64)
+    raise ValueError("Periods are 'week' or 'month'.")
+
+def period_start(periods,binsize):
+    """Day ordinal of the first day of each period"""
+    periods = np.asarray(periods,dtype = np.int64)
+    if binsize == 'week':
+        return periods * 7 + 1
+    return periods.astype('M8[M]').astype('M8[D]').astype(np.int64) + binning.EPOCH_ORD
+
+def iso_week(ords):
+    """ISO (year, week number) of day ordinals"""
+    ords = np.asarray(ords,dtype = np.int64)
+    #The ISO year is the year of the Thursday of the week
+    thursday = ords - (ords - 1) % 7 + 3
+    year = (thursday - binning.EPOCH_ORD).astype('M8[D]').astype('M8[Y]')
+    jan1 = year.astype('M8[D]').astype(np.int64) + binning.EPOCH_ORD
+    return year.astype(np.int64) + 1970,(thursday - jan1) // 7 + 1
+
+def _grow(values,n):
+    """values padded with zeros to length n"""
+    if values.size >= n:
+        return values
+    return np.r_[values,np.zeros(n - values.size,dtype = values.dtype)]
+
+class Totals(object):
+    """Distance, time and number of runs per week or month"""
+    def __init__(self,binsize):
+        self.binsize = binsize
+        self.first = None
+        self.dist = np.zeros(0)
+        self.time = np.zeros(0)
+        self.count = np.zeros(0,dtype = np.int64)
+
+    def add(self,ords,dist,time):
+        if not len(ords):
+            return
+        periods = period(ords,self.binsize)
+        if self.first == None:
+            self.first = int(periods.min())
+        idx = periods - self.first
+        n = max(self.count.size,int(idx.max()) + 1)
+        self.dist = _grow(self.dist,n) + np.bincount(idx,weights = dist,minlength = n)
+        self.time = _grow(self.time,n) + np.bincount(idx,weights = time,minlength = n)
+        self.count = _grow(self.count,n) + np.bincount(idx,minlength = n)
+
+    @property
+    def labels(self):
+        """Day ordinal of the first day of every period"""
+        if self.first == None:
+            return np.zeros(0,dtype = np.int64)
+        return period_start(self.first + np.arange(self.count.size),self.binsize)
+
+class RunAnalytics(object):
+    """Run analytics kept up to date as runs are appended"""
+    def __init__(self,ords = (),dist = (),time = ()):
+        self.ords = np.zeros(0,dtype = np.int64)
+        self.dist = np.zeros(0)
+        self.time = np.zeros(0)
+        self.weekly = Totals('week')
+        self.monthly = Totals('month')
+        self.first_day = None
+        self.daily = np.zeros(0)
+        #Best equivalent time so far and the rows that set a record
+        self._best = dict((name,np.inf) for name,meters in STANDARD_DISTANCES)
+        self._records = dict((name,np.zeros(0,dtype = np.int64)) for name,meters in STANDARD_DISTANCES)
+        self.extend(ords,dist,time)
+
+    def __len__(self):
+        return self.ords.size
+
+    def extend(self,ords,dist,time):
+        """Append runs, which must not be older than the last one"""
+        ords = np.asarray(ords,dtype = np.int64)
+        dist = np.asarray(dist,dtype = np.float64)
+        time = np.asarray(time,dtype = np.float64)
+        if not ords.size:
+            return
+        if np.any(ords[1:] < ords[:-1]) or (self.ords.size and ords[0] < self.ords[-1]):
+            raise ValueError("Runs must be appended in date order.")
+        offset = self.ords.size
+        self.ords = np.r_[self.ords,ords]
+        self.dist = np.r_[self.dist,dist]
+        self.time = np.r_[self.time,time]
+        self.weekly.add(ords,dist,time)
+        self.monthly.add(ords,dist,time)
+
+        if self.first_day == None:
+            self.first_day = int(ords[0])
+        idx = ords - self.first_day
+        n = max(self.daily.size,int(idx[-1]) + 1)
+        self.daily = _grow(self.daily,n) + np.bincount(idx,weights = dist,minlength = n)
+
+        for name,meters in STANDARD_DISTANCES:
+            equiv = self._equivalent(dist,time,meters)
+            best = np.minimum.accumulate(np.r_[self._best[name],equiv])
+            new = np.flatnonzero(equiv < best[:-1])
+            self._records[name] = np.r_[self._records[name],offset + new]
+            self._best[name] = best[-1]
+
+    @staticmethod
+    def _equivalent(dist,time,meters):
+        """Time each run implies for 'meters' (inf if it is not close)"""
+        close = (dist >= meters * PR_RANGE[0]) & (dist <= meters * PR_RANGE[1])
+        equiv = np.full(dist.size,np.inf)
+        equiv[close] = time[close] * meters / dist[close]
+        return equiv
+
+    def totals(self,binsize = 'week'):
+        """(first day of each ISO week or month, distance, time, runs)"""
+        if binsize not in ('week','month'):
+            raise ValueError("Totals are by 'week' or 'month'.")
+        totals = self.weekly if binsize == 'week' else self.monthly
+        return totals.labels,totals.dist,totals.time,totals.count
+
+    def pace(self,unit = 1000.):
+        """Seconds per 'unit' meters of each run (NaN without distance)"""
+        pace = np.full(self.dist.size,np.nan)
+        ok = self.dist > 0
+        pace[ok] = self.time[ok] / self.dist[ok] * unit
+        return pace
+
+    def pace_percentiles(self,binsize = 'month',q = (10,50,90),unit = 1000.):
+        """Nearest-rank percentiles of the pace of the runs in each
+        period. Returns (first day of each period with runs, array with
+        one row per percentile)."""
+        pace = self.pace(unit)
+        ok = ~np.isnan(pace)
+        periods = period(self.ords[ok],binsize)
+        pace = pace[ok]
+        if not pace.size:
+            return np.zeros(0,dtype = np.int64),np.zeros((len(q),0))
+        order = np.lexsort((pace,periods))
+        periods = periods[order]
+        pace = pace[order]
+        starts = np.flatnonzero(np.r_[True,periods[1:] != periods[:-1]])
+        counts = np.diff(np.r_[starts,periods.size])
+        ranks = np.round(np.asarray(q,dtype = np.float64)[:,None] / 100. * (counts - 1)).astype(np.int64)
+        return period_start(periods[starts],binsize),pace[starts + ranks]
+
+    def load(self,until = None):
+        """Daily training load: (day ordinals, acute = distance over the
+        last ACUTE_DAYS, chronic = weekly average over CHRONIC_DAYS,
+        acute:chronic ratio). The days run to 'until' if it is later
+        than the last run."""
+        if self.first_day == None:
+            empty = np.zeros(0)
+            return np.zeros(0,dtype = np.int64),empty,empty,empty
+        daily = self.daily
+        if until != None and until - self.first_day + 1 > daily.size:
+            daily = _grow(daily,until - self.first_day + 1)
+        acute = dailyframe.rolling_sum(daily,ACUTE_DAYS)[0]
+        chronic = dailyframe.rolling_sum(daily,CHRONIC_DAYS)[0] * ACUTE_DAYS / float(CHRONIC_DAYS)
+        ratio = np.full(daily.size,np.nan)
+        ok = chronic > 0
+        ratio[ok] = acute[ok] / chronic[ok]
+        return self.first_day + np.arange(daily.size),acute,chronic,ratio
+
+    def records(self,name):
+        """Record progression at a standard distance: (day ordinals,
+        estimated times, rows of the runs that set them)"""
+        rows = self._records[name]
+        meters = dict(STANDARD_DISTANCES)[name]
+        return self.ords[rows],self.time[rows] * meters / self.dist[rows],rows
+
+    def personal_records(self):
+        """Current record at each standard distance: name -> (day
+        ordinal, estimated seconds), only for distances with a run"""
+        best = {}
+        for name,meters in STANDARD_DISTANCES:
+            ords,times,rows = self.records(name)
+            if rows.size:
+                best[name] = (int(ords[-1]),float(times[-1]))
+        return best
@@ -0,0 +1,353 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+SQLite storage for the db tables (see storage).
+
+All tables live in one database, db/fitness.sqlite, in WAL mode:
+readers see the last committed rows and neither block the sync writer
+nor wait for it. Every thread gets its own connection.
+
+Calorie and weight rows are keyed by day ordinal, runs by strava
+activity id with an index on the day, so a date range read is an
+index range scan straight into numpy arrays. Writes are upserts
+(INSERT ... ON CONFLICT DO UPDATE): fetching a day again replaces its
+row instead of adding a duplicate, except that a final calorie row is
+never replaced by a non-final one. Each write transaction bumps a
+per-table version and logs the earliest day it touched, so a reader
+can tell which rows changed since the version it read (written_since).
+
+Usage: python sqlstore.py [datadir]   (migrate the text db files)
+"""
+
+import datetime
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+import colstore
+import instrument
+import storage
+
+#Database file, relative to the data directory
+SQLITE_DB = 'db/fitness.sqlite'
+
+#Connections wait this long (s) for another writer
+TIMEOUT = 30.
+
+#Write log entries kept per table
+WRITE_LOG = 1000
+
+def table_name(fname):
+    """SQL table of a db file (db/mfpcl.dat -> mfpcl)"""
+    return os.path.splitext(os.path.basename(fname))[0]
+
+def _sql_type(dtype):
+    return 'REAL' if np.dtype(dtype).kind == 'f' else 'INTEGER'
+
+def format_line(row,columns):
+    """db text line of a row of typed values"""
+    fields = []
+    for (name,dtype),value in zip(columns,row):
+        if name == 'date':
+            fields.append(str(datetime.date.fromordinal(int(value))))
+        elif np.dtype(dtype).kind == 'f':
+            fields.append(repr(float(value)))
+        else:
+            fields.append(str(int(value)))
+    return ','.join(fields) + '\n'
+
+class SQLiteStorage(object):
+    """The db tables in one SQLite database"""
+    kind = 'sqlite'
+    indexed = True
+    errors = (IOError,OSError,ValueError,sqlite3.Error)
+
+    def __init__(self,datadir,tables,keys):
+        self.datadir = datadir
+        self.tables = tables
+        self.keyfiles = keys
+        self.path = os.path.join(datadir,SQLITE_DB)
+        self._local = threading.local()
+
+    def connect(self):
+        """This thread's connection (autocommit, transactions are explicit)"""
+        conn = getattr(self._local,'conn',None)
+        if conn == None:
+            dbdir = os.path.dirname(self.path)
+            if dbdir and not os.path.isdir(dbdir):
+                os.makedirs(dbdir)
+            conn = sqlite3.connect(self.path,timeout = TIMEOUT,isolation_level = None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            #With WAL a commit does not wait for fsync, a checkpoint does
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS versions (tbl TEXT PRIMARY KEY,version INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS writes (tbl TEXT NOT NULL,version INTEGER NOT NULL,'
+                         'low INTEGER NOT NULL,PRIMARY KEY (tbl,version))')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local,'conn',None)
+        if conn != None:
+            conn.close()
+            self._local.conn = None
+
+    def keyed(self,fname):
+        """True if rows are keyed by activity id instead of date"""
+        return fname in self.keyfiles
+
+    def _names(self,fname):
+        return [name for name,dtype in self.tables[fname]]
+
+    def create(self,fname):
+        """Create the table (and its date index) if it does not exist"""
+        table = table_name(fname)
+        cols = ['%s %s NOT NULL'%(name,_sql_type(dtype)) for name,dtype in self.tables[fname]]
+        if self.keyed(fname):
+            cols.insert(0,'id INTEGER PRIMARY KEY')
+        else:
+            cols[0] = 'date INTEGER PRIMARY KEY'
+        conn = self.connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)'%(table,','.join(cols)))
+        if self.keyed(fname):
+            conn.execute('CREATE INDEX IF NOT EXISTS %s_date ON %s (date)'%(table,table))
+        conn.execute('INSERT OR IGNORE INTO versions VALUES (?,0)',(table,))
+
+    def upsert_sql(self,fname):
+        """INSERT ... ON CONFLICT DO UPDATE of one row (id first if keyed)"""
+        table = table_name(fname)
+        names = self._names(fname)
+        key = 'date'
+        if self.keyed(fname):
+            names = ['id'] + names
+            key = 'id'
+        sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT(%s) DO UPDATE SET %s'%(
+            table,','.join(names),','.join('?' * len(names)),key,
+            ','.join('%s = excluded.%s'%(n,n) for n in names if n != key))
+        if 'final' in names:
+            #A day that was final is not replaced by a partial one
+            sql += ' WHERE excluded.final OR NOT %s.final'%table
+        return sql
+
+    def bump(self,fname,low = 0):
+        """New version of a table whose rows from day 'low' on were
+        written (0: any row), inside the write transaction"""
+        table = table_name(fname)
+        conn = self.connect()
+        conn.execute('UPDATE versions SET version = version + 1 WHERE tbl = ?',(table,))
+        version = conn.execute('SELECT version FROM versions WHERE tbl = ?',(table,)).fetchone()[0]
+        conn.execute('INSERT OR REPLACE INTO writes VALUES (?,?,?)',(table,version,int(low)))
+        conn.execute('DELETE FROM writes WHERE tbl = ? AND version <= ?',(table,version - WRITE_LOG))
+
+    def exists(self,fname):
+        if fname not in self.tables:
+            return False
+        row = self.connect().execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                     (table_name(fname),)).fetchone()
+        return row != None
+
+    def version(self,fname):
+        row = self.connect().execute('SELECT version FROM versions WHERE tbl = ?',
+                                     (table_name(fname),)).fetchone()
+        return row[0] if row else None
+
+    def written_since(self,fname,version):
+        """Earliest day written after 'version', None if that is unknown
+        (the log does not reach back that far)"""
+        current = self.version(fname)
+        if version == None or current == None or current < version:
+            return None
+        count,low = self.connect().execute('SELECT count(*),min(low) FROM writes WHERE tbl = ? AND version > ?',
+                                           (table_name(fname),version)).fetchone()
+        if count != current - version:
+            return None
+        return low
+
+    def _select(self,fname):
+        order = 'date,id' if self.keyed(fname) else 'date'
+        return 'SELECT %s FROM %s'%(','.join(self._names(fname)),table_name(fname)),order
+
+    @instrument.timed('SQLiteStorage.load')
+    def load(self,fname,first = None,last = None):
+        """Columns of the rows in date order, only those with first <=
+        date <= last if given (an index range scan)"""
+        sql,order = self._select(fname)
+        where = []
+        args = []
+        if first != None:
+            where.append('date >= ?')
+            args.append(int(first))
+        if last != None:
+            where.append('date <= ?')
+            args.append(int(last))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        rows = self.connect().execute(sql + ' ORDER BY ' + order,args).fetchall()
+        instrument.count('rows_read',len(rows))
+        dtype = [(name,np.dtype(dt)) for name,dt in self.tables[fname]]
+        data = np.array(rows,dtype = dtype) if rows else np.zeros(0,dtype = dtype)
+        return [np.ascontiguousarray(data[name]) for name,dt in dtype]
+
+    def writer(self,fname,mode = 'a'):
+        return SQLiteWriter(self,fname,mode)
+
+    def _last_row(self,fname):
+        """(key, values...) of the last row in date order, or None"""
+        if self.keyed(fname):
+            key,order = 'id','date DESC,id DESC'
+        else:
+            key,order = 'date','date DESC'
+        return self.connect().execute('SELECT %s,%s FROM %s ORDER BY %s LIMIT 1'%(
+            key,','.join(self._names(fname)),table_name(fname),order)).fetchone()
+
+    def last_line(self,fname):
+        row = self._last_row(fname)
+        return format_line(row[1:],self.tables[fname]) if row else ''
+
+    def remove_last(self,fname):
+        if not self.exists(fname):
+            return None
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._last_row(fname)
+            if row:
+                key = 'id' if self.keyed(fname) else 'date'
+                conn.execute('DELETE FROM %s WHERE %s = ?'%(table_name(fname),key),(row[0],))
+                self.bump(fname,row[1])
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return format_line(row[1:],self.tables[fname]) if row else ''
+
+    def replace_days(self,fname,lines):
+        """Upsert the rows of the days in 'lines'"""
+        with self.writer(fname) as writer:
+            for date in sorted(lines):
+                writer.write(lines[date])
+
+    def keys(self,fname):
+        if not self.keyed(fname) or not self.exists(fname):
+            return set()
+        rows = self.connect().execute('SELECT id FROM %s WHERE id >= 0'%table_name(fname))
+        return set(row[0] for row in rows)
+
+class SQLiteWriter(object):
+    """Upserts db text lines into a table. Lines are buffered and
+    committed in one transaction on flush() and close()."""
+    def __init__(self,store,fname,mode = 'a'):
+        self.storage = store
+        self.fname = fname
+        self.columns = store.tables[fname]
+        self.sql = store.upsert_sql(fname)
+        self._rows = []
+        self._anon = None
+        conn = store.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            store.create(fname)
+            if mode == 'w':
+                conn.execute('DELETE FROM %s'%table_name(fname))
+                store.bump(fname)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def write(self,line,key = None):
+        """Add one db text line ("date,value,...\\n"), with the activity
+        id of a keyed table"""
+        if len(line.split(',')) == len(self.columns):
+            self._rows.append((line,key))
+        instrument.count('bytes_written',len(line))
+
+    def _anonymous_key(self):
+        """Negative id for a keyed row written without one"""
+        if self._anon == None:
+            row = self.storage.connect().execute('SELECT min(id) FROM %s'%table_name(self.fname)).fetchone()
+            self._anon = min(row[0] or 0,0)
+        self._anon -= 1
+        return self._anon
+
+    def flush(self):
+        if not self._rows:
+            return
+        lines = [line for line,key in self._rows]
+        cols = colstore.parse_lines(lines,self.columns)
+        rows = zip(*[col.tolist() for col in cols])
+        if self.storage.keyed(self.fname):
+            rows = [(key if key != None else self._anonymous_key(),) + row
+                    for (line,key),row in zip(self._rows,rows)]
+        conn = self.storage.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(self.sql,rows)
+            self.storage.bump(self.fname,cols[0].min())
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        instrument.count('rows_upserted',len(rows))
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+@instrument.timed('sqlstore.migrate')
+def migrate(datadir,tables,keys):
+    """Copy the text db files of 'datadir' into its SQLite database,
+    replacing the tables there. Rows of a keyed table take their ids
+    from its key file when it has one line per row. Returns {fname:
+    (text rows, rows stored)}; fewer stored rows means duplicate days
+    were merged."""
+    text = storage.TextStorage(datadir,tables,keys)
+    sql = SQLiteStorage(datadir,tables,keys)
+    conn = sql.connect()
+    counts = {}
+    for fname in tables:
+        if not text.exists(fname):
+            continue
+        cols = text.load(fname)
+        rows = zip(*[col.tolist() for col in cols])
+        if sql.keyed(fname):
+            ids = [-(i + 1) for i in range(len(rows))][::-1]
+            keyfile = os.path.join(datadir,keys[fname])
+            if os.path.isfile(keyfile):
+                with open(keyfile) as f:
+                    written = [int(line) for line in f if line.strip()]
+                if len(written) == len(rows):
+                    ids = written
+            rows = [(key,) + row for key,row in zip(ids,rows)]
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DROP TABLE IF EXISTS %s'%table_name(fname))
+            sql.create(fname)
+            conn.executemany(sql.upsert_sql(fname),rows)
+            sql.bump(fname)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        stored = conn.execute('SELECT count(*) FROM %s'%table_name(fname)).fetchone()[0]
+        counts[fname] = (len(rows),stored)
+    sql.close()
+    return counts
+
+if __name__ == '__main__':
+    import sys
+    from fitnessdata import DB_COLUMNS,DB_RUN,RUN_IDS
+    datadir = sys.argv[1] if len(sys.argv) > 1 else ''
+    counts = migrate(datadir,DB_COLUMNS,{DB_RUN:RUN_IDS})
+    for fname in sorted(counts):
+        rows,stored = counts[fname]
+        print "%s: %d rows -> %d in %s (%d duplicates merged)"%(
+            fname,rows,stored,os.path.join(datadir,SQLITE_DB),rows - stored)
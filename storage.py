@@ -0,0 +1,189 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Storage backends for the db tables.
+
+FitnessData reads and writes the calorie, weight and run tables only
+through a storage object, so where the rows live is pluggable:
+
+    text    the db/*.dat text files, read through their column stores
+            (colstore). The default.
+    sqlite  one SQLite database with keys, upserts and indexed range
+            reads (sqlstore)
+
+Tables are named by their text file (DB_CAL, ...). A storage has:
+
+    exists(fname)             True once the table has been created
+    load(fname,first,last)    list of column arrays, rows whose date
+                              ordinal is within [first, last] if given
+    version(fname)            changes whenever the table is written
+    written_since(fname,v)    earliest date ordinal written since version
+                              v, or None if not known
+    writer(fname,mode)        writer of db text lines ("date,value,...");
+                              write(line,key) takes the activity id of a
+                              keyed table (runs), mode 'w' empties the table
+    last_line(fname)          last row as a db line ('' if none)
+    remove_last(fname)        remove the last row, returns it (or None)
+    replace_days(fname,lines) replace/insert the rows of the days in
+                              'lines' (date -> line)
+    keys(fname)               set of the keys (activity ids) written
+
+'indexed' is True if ranged loads read only the rows they return, and
+'errors' the exceptions a failed read raises.
+"""
+
+import os
+
+import numpy as np
+
+import binning
+import colstore
+
+KINDS = ('text','sqlite')
+
+def open_storage(kind,datadir,tables,keys):
+    """Storage of type 'kind' for the tables in 'datadir'. tables maps
+    each table to its columns, keys the keyed tables to their key file."""
+    if kind == 'text':
+        return TextStorage(datadir,tables,keys)
+    if kind == 'sqlite':
+        import sqlstore
+        return sqlstore.SQLiteStorage(datadir,tables,keys)
+    raise ValueError("Unknown storage '%s'."%kind)
+
+def in_range(cols,first,last):
+    """Rows of columns whose date (column 0) is within [first, last]"""
+    if first == None and last == None:
+        return cols
+    dates = cols[0]
+    mask = np.ones(len(dates),dtype = bool)
+    if first != None:
+        mask &= dates >= first
+    if last != None:
+        mask &= dates <= last
+    return [np.asarray(col)[mask] for col in cols]
+
+class TextWriter(colstore.DBWriter):
+    """DBWriter that also appends the key of each row to a key file"""
+    def __init__(self,fname,store,mode = 'a',keyfile = None):
+        colstore.DBWriter.__init__(self,fname,store,mode)
+        self._keys = open(keyfile,mode) if keyfile else None
+
+    def write(self,line,key = None):
+        colstore.DBWriter.write(self,line)
+        if key != None and self._keys:
+            self._keys.write("%s\n"%key)
+
+    def flush(self):
+        colstore.DBWriter.flush(self)
+        if self._keys:
+            self._keys.flush()
+
+    def close(self):
+        colstore.DBWriter.close(self)
+        if self._keys:
+            self._keys.close()
+
+class TextStorage(object):
+    """The text db files and their column stores"""
+    kind = 'text'
+    indexed = False
+    errors = (IOError,OSError,ValueError)
+
+    def __init__(self,datadir,tables,keys):
+        self.datadir = datadir
+        self.tables = tables
+        self.keyfiles = keys
+
+    def path(self,fname):
+        return os.path.join(self.datadir,fname)
+
+    def exists(self,fname):
+        return os.path.isfile(self.path(fname))
+
+    def version(self,fname):
+        st = os.stat(self.path(fname))
+        #Size and inode as well, two writes can share an mtime tick
+        return (st.st_mtime,st.st_size,st.st_ino)
+
+    def written_since(self,fname,version):
+        return None
+
+    def store(self,fname):
+        """Column store of a db file"""
+        columns = self.tables.get(fname)
+        if columns == None:
+            columns = colstore.infer_columns(self.path(fname))
+        return colstore.ColumnStore(colstore.store_path(self.path(fname)),columns)
+
+    def sync_store(self,fname):
+        """Make sure the column store reflects the text file"""
+        store = self.store(fname)
+        store.sync(self.path(fname))
+        return store
+
+    def load(self,fname,first = None,last = None):
+        """Columns of the store (read-only maps if the whole table)"""
+        return in_range(self.sync_store(fname).load(),first,last)
+
+    def writer(self,fname,mode = 'a'):
+        keyfile = self.keyfiles.get(fname)
+        return TextWriter(self.path(fname),self.store(fname),mode,keyfile and self.path(keyfile))
+
+    def last_line(self,fname):
+        #Seek back from the end instead of reading every line
+        with open(self.path(fname),'rb') as f:
+            f.seek(colstore.last_line_offset(f))
+            return f.read()
+
+    def remove_last(self,fname):
+        path = self.path(fname)
+        if not os.path.isfile(path):
+            return None
+        store = self.store(fname)
+        in_sync = store.is_current() and store.src_size == os.path.getsize(path)
+        #Truncate at the start of the last line, nothing else is touched
+        with open(path,'r+b') as f:
+            start = colstore.last_line_offset(f)
+            f.seek(start)
+            last = f.read()
+            f.truncate(start)
+        #Keep the column store in step with the text file
+        if in_sync and last:
+            store.truncate(store.nrows - 1,start)
+        return last
+
+    def replace_days(self,fname,lines):
+        """Rewrite the file with the rows of the days in 'lines' replaced
+        (or inserted in date order), keeping every other line as it is.
+        The file is replaced atomically, then its store rebuilt into new
+        column files (see colstore), so readers keep what they mapped."""
+        path = self.path(fname)
+        with open(path) as f:
+            old = f.readlines()
+        #Day of each line, a malformed line stays after the one before it
+        ords = np.full(len(old),-1,dtype = np.int64)
+        valid = np.array([len(l.split(',')) == len(self.tables[fname]) for l in old],dtype = bool)
+        if valid.any():
+            heads = np.array([l[:10] for l in np.array(old,dtype = object)[valid]],dtype = 'S10')
+            ords[valid] = binning.to_ordinals(heads.astype('M8[D]'))
+        np.maximum.accumulate(ords,out = ords)
+        patched = binning.to_ordinals(np.array(sorted(lines),dtype = object))
+        keep = ~(np.in1d(ords,patched) & valid)
+        merged = [l for l,k in zip(old,keep) if k] + [lines[d] for d in sorted(lines)]
+        order = np.argsort(np.r_[ords[keep],patched],kind = 'mergesort')
+        merged = [merged[i] for i in order]
+        with open(path + '.tmp','w') as f:
+            f.writelines(merged)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp',path)
+        store = self.store(fname)
+        store.rebuild(colstore.parse_lines(merged,store.columns),sum(len(l) for l in merged))
+
+    def keys(self,fname):
+        keyfile = self.keyfiles.get(fname)
+        if not keyfile or not os.path.isfile(self.path(keyfile)):
+            return set()
+        with open(self.path(keyfile)) as f:
+            return set(int(line) for line in f if line.strip())
@@ -0,0 +1,302 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Per-second strava activity streams: archive and streaming analysis.
+
+DB_RUN keeps one total per run. The streams of a run (time, distance,
+heart rate, altitude: a sample every second or so, thousands per run)
+are fetched with client.get_activity_streams and archived one
+compressed chunk per activity:
+
+    <archive>/<id>.chunk  a header line "FSTREAM1 <samples> <type>:<dtype>
+                          ..." and the typed columns (time u4 s stored as
+                          steps, distance f4 m, heartrate u1 bpm with 0
+                          for none, altitude f4 m) in one zlib block
+    <archive>/index.dat   id,date,samples,distance,seconds per activity
+
+Analysis walks the archive one activity at a time (iter_streams is a
+generator), so memory holds a single run whatever the archive size:
+
+    splits          time of every whole 'every' meters (per-km splits)
+    best_efforts    fastest time over each standard distance within a run
+    time_in_zone    seconds spent in each heart rate zone
+
+analyze() folds them over any iterable of streams. Responses of
+get_activity_streams are recorded and replayed by the response cache
+(see respcache), so recorded streams replay offline; bench/fixtures
+checks analyze() against a recorded set.
+"""
+
+import datetime
+import os
+import zlib
+
+import numpy as np
+
+import fetcher
+import instrument
+import runs
+
+STREAM_TYPES = ('time','distance','heartrate','altitude')
+
+#Column types of an archived stream
+DTYPES = {'time':np.uint32,'distance':np.float32,'heartrate':np.uint8,'altitude':np.float32}
+
+#Heart rate zone edges (bpm), the last zone is open ended
+ZONES = (0,120,140,155,170,185)
+
+#Split length (m)
+SPLIT = 1000.
+
+#A gap between samples longer than this (s) is a pause, not time in a zone
+PAUSE = 30
+
+INDEX = 'index.dat'
+MAGIC = 'FSTREAM1'
+
+class Stream(object):
+    """The streams of one activity, heartrate and altitude None if it
+    has none"""
+    def __init__(self,id,date,time,distance,heartrate = None,altitude = None):
+        self.id = id
+        self.date = date
+        self.time = time
+        self.distance = distance
+        self.heartrate = heartrate
+        self.altitude = altitude
+
+    def __len__(self):
+        return len(self.time)
+
+def _data(raw,kind):
+    """Samples of one stream type of a response (stravalib Stream
+    objects, or plain lists as the response cache keeps them)"""
+    stream = raw.get(kind)
+    if stream == None:
+        return None
+    return getattr(stream,'data',stream)
+
+def columns(raw):
+    """Typed columns of a get_activity_streams response ({type: stream}).
+    Missing heart rate samples are 0, distance never goes down."""
+    time = _data(raw,'time')
+    if not time:
+        raise ValueError("Activity has no time stream.")
+    cols = {'time':np.asarray(time,dtype = DTYPES['time'])}
+    for kind in STREAM_TYPES[1:]:
+        data = _data(raw,kind)
+        if data == None or len(data) != len(time):
+            continue
+        if kind == 'heartrate':
+            data = [value or 0 for value in data]
+        cols[kind] = np.asarray(data,dtype = DTYPES[kind])
+    if 'distance' not in cols:
+        raise ValueError("Activity has no distance stream.")
+    np.maximum.accumulate(cols['distance'],out = cols['distance'])
+    return cols
+
+class StreamArchive(object):
+    """Directory of compressed per-activity streams and their index"""
+    def __init__(self,path):
+        self.path = path
+        self._ids = None
+
+    def _file(self,id):
+        return os.path.join(self.path,'%d.chunk'%id)
+
+    def entries(self,first = None,last = None):
+        """(id, day ordinal, samples, distance, seconds) of the archived
+        activities in date order, within [first, last] if given"""
+        index = os.path.join(self.path,INDEX)
+        rows = []
+        if os.path.isfile(index):
+            with open(index) as f:
+                for line in f:
+                    split = line.split(',')
+                    if len(split) != 5:
+                        continue
+                    ordinal = datetime.datetime.strptime(split[1],'%Y-%m-%d').toordinal()
+                    if (first == None or ordinal >= first) and (last == None or ordinal <= last):
+                        rows.append((int(split[0]),ordinal,int(split[2]),float(split[3]),int(split[4])))
+        rows.sort(key = lambda row: (row[1],row[0]))
+        return rows
+
+    def ids(self):
+        if self._ids == None:
+            self._ids = set(row[0] for row in self.entries())
+        return self._ids
+
+    def __contains__(self,id):
+        return id in self.ids()
+
+    def __len__(self):
+        return len(self.ids())
+
+    def write(self,id,date,cols):
+        """Archive the columns of an activity (see columns) done on 'date'"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fname = self._file(id)
+        kinds = [kind for kind in STREAM_TYPES if kind in cols]
+        data = [np.asarray(cols[kind],dtype = DTYPES[kind]) for kind in kinds]
+        #Steps of a second or so compress far better than the times
+        data[0] = np.r_[data[0][:1],np.diff(data[0])]
+        header = '%s %d %s\n'%(MAGIC,len(data[0]),' '.join('%s:%s'%(kind,col.dtype.str) for kind,col in zip(kinds,data)))
+        #Complete chunk or none, then its index line
+        with open(fname + '.tmp','wb') as f:
+            f.write(header)
+            f.write(zlib.compress(''.join(col.tostring() for col in data)))
+        os.rename(fname + '.tmp',fname)
+        time,dist = cols['time'],cols['distance']
+        with open(os.path.join(self.path,INDEX),'a') as f:
+            f.write("%d,%s,%d,%r,%d\n"%(id,date,len(time),float(dist[-1]),int(time[-1]) - int(time[0])))
+        self.ids().add(id)
+        instrument.count('streams.bytes_written',os.path.getsize(fname))
+
+    def read(self,id,date = None):
+        """Stream of an archived activity"""
+        with open(self._file(id),'rb') as f:
+            header = f.readline().split()
+            raw = zlib.decompress(f.read())
+        if header[0] != MAGIC:
+            raise ValueError("%s is not a stream chunk."%self._file(id))
+        n = int(header[1])
+        cols = {}
+        offset = 0
+        for field in header[2:]:
+            kind,dtype = field.split(':')
+            dtype = np.dtype(dtype)
+            cols[kind] = np.frombuffer(raw,dtype,n,offset)
+            offset += n * dtype.itemsize
+        cols['time'] = np.cumsum(cols['time'],dtype = DTYPES['time'])
+        instrument.count('streams.samples_read',len(cols['time']))
+        return Stream(id,date,cols['time'],cols['distance'],cols.get('heartrate'),cols.get('altitude'))
+
+    def iter_streams(self,first = None,last = None):
+        """Streams of the activities within [first, last] (day ordinals)
+        in date order, read one at a time"""
+        for id,ordinal,samples,dist,seconds in self.entries(first,last):
+            yield self.read(id,datetime.date.fromordinal(ordinal))
+
+    def nbytes(self):
+        """Size of the archived chunks"""
+        return sum(os.path.getsize(self._file(id)) for id in self.ids())
+
+def ingest(client,activities,archive,types = STREAM_TYPES,rate = 0.):
+    """Fetch and archive the streams of (id, date) activities that are
+    not archived yet, at most 'rate' requests per second (0 = no limit).
+    An activity that fails is reported and skipped. Returns the number
+    archived."""
+    limiter = fetcher.RateLimiter(rate)
+    written = 0
+    for id,date in activities:
+        if id in archive:
+            instrument.count('streams.skipped')
+            continue
+        limiter.wait()
+        try:
+            raw = client.get_activity_streams(id,types = list(types),series_type = 'time')
+            cols = columns(raw)
+        except Exception as e:
+            print "Could not fetch the streams of activity %s: %s"%(id,e)
+            instrument.count('streams.failed')
+            continue
+        archive.write(id,date,cols)
+        written += 1
+        instrument.count('streams.ingested')
+    return written
+
+def _first_arrival(stream):
+    """Distance and time samples where the distance goes up (the time
+    each distance was first reached), for interpolation"""
+    dist = np.asarray(stream.distance,dtype = np.float64)
+    time = np.asarray(stream.time,dtype = np.float64)
+    keep = np.r_[True,dist[1:] > dist[:-1]]
+    return dist[keep],time[keep]
+
+def splits(stream,every = SPLIT):
+    """Whole 'every' meters of a run: (distance marks, seconds of each
+    split, mean heart rate of each split or None)"""
+    dist,time = _first_arrival(stream)
+    marks = np.arange(every,dist[-1] + 1e-6,every)
+    seconds = np.diff(np.r_[time[0],np.interp(marks,dist,time)])
+    hr = None
+    if stream.heartrate is not None and marks.size:
+        #Heart rate of each sample weighted by the time to the next one
+        heart = np.asarray(stream.heartrate,dtype = np.float64)[:-1]
+        dt = np.diff(np.asarray(stream.time,dtype = np.float64))
+        split = np.searchsorted(marks,np.asarray(stream.distance)[:-1],'right')
+        ok = (heart > 0) & (split < marks.size) & (dt <= PAUSE)
+        total = np.bincount(split[ok],dt[ok] * heart[ok],minlength = marks.size)
+        weight = np.bincount(split[ok],dt[ok],minlength = marks.size)
+        with np.errstate(invalid = 'ignore',divide = 'ignore'):
+            hr = np.where(weight > 0,total / weight,np.nan)
+    return marks,seconds,hr
+
+def best_efforts(stream,distances = runs.STANDARD_DISTANCES):
+    """Fastest seconds over each (name, meters) distance anywhere in the
+    run, NaN for distances longer than the run"""
+    dist,time = _first_arrival(stream)
+    starts = np.asarray(stream.distance,dtype = np.float64)
+    start_times = np.asarray(stream.time,dtype = np.float64)
+    best = np.full(len(distances),np.nan)
+    for i,(name,meters) in enumerate(distances):
+        ends = starts + meters
+        ok = ends <= dist[-1]
+        if ok.any():
+            best[i] = (np.interp(ends[ok],dist,time) - start_times[ok]).min()
+    return best
+
+def time_in_zone(stream,zones = ZONES):
+    """Seconds spent in each heart rate zone (edges in bpm, the last one
+    open ended), pauses and samples without heart rate left out"""
+    seconds = np.zeros(len(zones))
+    if stream.heartrate is None or len(stream) < 2:
+        return seconds
+    heart = np.asarray(stream.heartrate)[:-1]
+    dt = np.diff(np.asarray(stream.time,dtype = np.float64))
+    ok = (heart > 0) & (dt <= PAUSE)
+    zone = np.digitize(heart[ok],zones) - 1
+    seconds += np.bincount(np.maximum(zone,0),dt[ok],minlength = len(zones))[:len(zones)]
+    return seconds
+
+@instrument.timed('streams.analyze')
+def analyze(streams,every = SPLIT,distances = runs.STANDARD_DISTANCES,zones = ZONES):
+    """Fold splits, best efforts and time in zone over an iterable of
+    streams (iter_streams reads them lazily). Returns a dict:
+
+        activities, samples  counts
+        splits       {'id', 'split' (1, 2, ...), 'seconds', 'heartrate'}
+                     arrays, one entry per split of every run
+        best_efforts {name: (seconds, activity id, date)} or None each
+        zones        seconds per zone over every run"""
+    count = samples = 0
+    ids,numbers,seconds,hrs = [],[],[],[]
+    best = np.full(len(distances),np.inf)
+    best_at = [None] * len(distances)
+    zone_seconds = np.zeros(len(zones))
+    for stream in streams:
+        count += 1
+        samples += len(stream)
+        marks,secs,hr = splits(stream,every)
+        ids.append(np.full(marks.size,stream.id,dtype = np.int64))
+        numbers.append(np.arange(1,marks.size + 1))
+        seconds.append(secs)
+        hrs.append(hr if hr is not None else np.full(marks.size,np.nan))
+        efforts = best_efforts(stream,distances)
+        #NaN (run shorter than the distance) is never better
+        with np.errstate(invalid = 'ignore'):
+            better = np.flatnonzero(efforts < best)
+        best[better] = efforts[better]
+        for i in better:
+            best_at[i] = (stream.id,stream.date)
+        zone_seconds += time_in_zone(stream,zones)
+    instrument.count('streams.analyzed',count)
+    join = lambda parts,dtype: np.concatenate(parts) if parts else np.zeros(0,dtype = dtype)
+    records = {}
+    for i,(name,meters) in enumerate(distances):
+        records[name] = (float(best[i]),) + best_at[i] if best_at[i] else None
+    return {'activities':count,'samples':samples,
+            'splits':{'id':join(ids,np.int64),'split':join(numbers,np.int64),
+                      'seconds':join(seconds,np.float64),'heartrate':join(hrs,np.float64)},
+            'best_efforts':records,'zones':zone_seconds}
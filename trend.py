@@ -0,0 +1,252 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Weight trend models computed over the whole series in one pass.
+
+Every model works on a daily axis from the first to the last weigh-in
+and returns, for each day, the trend level and its slope (lbs/day):
+
+    endpoints  line through the first and last weight of the window
+               (what weight_slope used to do)
+    lsq        least-squares line through the weigh-ins of the window
+    ewma       exponentially weighted average of the weigh-ins, the
+               weight of an old value decaying per day, not per sample
+    hackers    The Hacker's Diet trend: 10% exponential smoothing of
+               the daily weight with missing days interpolated
+
+The slope of ewma/hackers is the least-squares slope of the trend line
+over the window. Windows are trailing, in days; None means everything
+up to that day. Rolling sums come from cumulative sums, so any window
+costs O(days). TrendState gives the same numbers one weigh-in at a
+time, at O(1) per day.
+"""
+
+from collections import deque
+
+import numpy as np
+
+import dailyframe
+
+MODELS = ('endpoints','lsq','ewma','hackers')
+
+#Smoothing per day of the ewma and hackers models
+EWMA_ALPHA = 0.25
+HACKERS_ALPHA = 0.1
+
+#linear_filter keeps the running decay above exp(-LOG_LIMIT) in a block
+LOG_LIMIT = 300.
+MAX_BLOCK = 4096
+
+def _window_starts(n,window):
+    """Index of the first day in the trailing window ending on each day"""
+    if window == None:
+        return np.zeros(n,dtype = np.int64)
+    if window < 1:
+        raise ValueError("Window must be >= 1 day.")
+    return np.maximum(np.arange(1,n + 1) - int(window),0)
+
+def rolling_lsq(y,window = None):
+    """Least-squares line through the non-NaN values of y in each
+    trailing window. Returns (slope, level), level being the line at
+    that day; NaN where the window holds fewer than 2 values."""
+    n = y.size
+    valid = ~np.isnan(y)
+    x = np.arange(n,dtype = np.float64)
+    xv = np.where(valid,x,0.)
+    yv = np.where(valid,y,0.)
+    lo = _window_starts(n,window)
+    sums = []
+    for col in (valid.astype(np.float64),xv,yv,xv * xv,xv * yv):
+        csum = np.r_[0.,np.cumsum(col)]
+        sums.append(csum[1:] - csum[lo])
+    count,sx,sy,sxx,sxy = sums
+    slope = np.full(n,np.nan)
+    level = np.full(n,np.nan)
+    ok = count >= 2
+    mx = sx[ok] / count[ok]
+    my = sy[ok] / count[ok]
+    var = sxx[ok] - sx[ok] * mx
+    fit = var > 1e-9
+    slope[np.flatnonzero(ok)[fit]] = (sxy[ok] - sx[ok] * my)[fit] / var[fit]
+    slope[np.flatnonzero(ok)[~fit]] = 0.
+    level[ok] = my + slope[ok] * (x[ok] - mx)
+    return slope,level
+
+def endpoints(y,window = None):
+    """Slope of the line through the (interpolated) weight at the start
+    and end of each trailing window, and the weight itself"""
+    level = dailyframe.interpolate(y)
+    lo = _window_starts(y.size,window)
+    days = np.arange(y.size) - lo
+    slope = np.full(y.size,np.nan)
+    some = days > 0
+    slope[some] = (level[some] - level[lo[some]]) / days[some]
+    return slope,level
+
+def linear_filter(y,decay):
+    """s[k] = decay[k] * s[k-1] + (1 - decay[k]) * y[k], from s[-1] = y[0].
+
+    Vectorized in blocks: within a block s is the running product of
+    the decays times a cumulative sum, and each block is cut short
+    before that product underflows."""
+    y = np.asarray(y,dtype = np.float64)
+    n = y.size
+    out = np.empty(n)
+    if not n:
+        return out
+    decay = np.clip(np.broadcast_to(np.asarray(decay,dtype = np.float64),(n,)),1e-100,1.)
+    logd = np.log(decay)
+    state = y[0]
+    start = 0
+    while start < n:
+        clog = np.cumsum(logd[start:start + MAX_BLOCK])
+        stop = start + max(1,int(np.searchsorted(-clog,LOG_LIMIT,side = 'right')))
+        prod = np.exp(clog[:stop - start])
+        terms = (1. - decay[start:stop]) * y[start:stop] / prod
+        out[start:stop] = prod * (state + np.cumsum(terms))
+        state = out[stop - 1]
+        start = stop
+    return out
+
+def ewma(days,weights,alpha = EWMA_ALPHA):
+    """Exponentially weighted average at each weigh-in, a value 'g' days
+    old weighing (1 - alpha)**g"""
+    gaps = np.diff(np.asarray(days,dtype = np.float64))
+    decay = np.r_[1.,(1. - alpha) ** gaps]
+    return linear_filter(weights,decay)
+
+def hackers_diet(y,alpha = HACKERS_ALPHA):
+    """Hacker's Diet trend of daily weights (NaN days interpolated)"""
+    return linear_filter(dailyframe.interpolate(y),1. - alpha)
+
+def daily_weights(ords,weights):
+    """Weigh-ins on a daily axis: (first day ordinal, weights with NaN
+    on days without one). Zero and masked weights are dropped."""
+    weights = np.ma.masked_less_equal(np.ma.asarray(weights,dtype = np.float64),0)
+    ords = np.asarray(ords,dtype = np.int64)[~np.ma.getmaskarray(weights)]
+    if not ords.size:
+        return 0,np.zeros(0)
+    first = int(ords.min())
+    n = int(ords.max()) - first + 1
+    return first,dailyframe.scatter(ords,weights.compressed(),first,n)
+
+def fit(ords,weights,model = 'lsq',window = None,alpha = None):
+    """Trend of weigh-ins (day ordinals, weights) by 'model', one row
+    per day from the first to the last weigh-in. Returns (day
+    ordinals, level, slope)."""
+    if model not in MODELS:
+        raise ValueError("Unknown trend model '%s'."%model)
+    first,y = daily_weights(ords,weights)
+    days = first + np.arange(y.size,dtype = np.int64)
+    if model == 'endpoints':
+        slope,level = endpoints(y,window)
+    elif model == 'lsq':
+        slope,level = rolling_lsq(y,window)
+    else:
+        if model == 'ewma':
+            weighed = np.flatnonzero(~np.isnan(y))
+            level = np.full(y.size,np.nan)
+            level[weighed] = ewma(weighed,y[weighed],alpha or EWMA_ALPHA)
+            level = dailyframe.ffill(level)
+        else:
+            level = hackers_diet(y,alpha or HACKERS_ALPHA)
+        slope = rolling_lsq(level,window)[0]
+    return days,level,slope
+
+class TrendState(object):
+    """One model of fit() updated a weigh-in at a time. Each update
+    costs O(1) per day since the previous weigh-in."""
+    def __init__(self,model = 'lsq',window = None,alpha = None):
+        if model not in MODELS:
+            raise ValueError("Unknown trend model '%s'."%model)
+        self.model = model
+        self.window = window
+        self.alpha = alpha or (EWMA_ALPHA if model == 'ewma' else HACKERS_ALPHA)
+        self.origin = None
+        self.day = None
+        self.weight = None
+        self.smoothed = None
+        #Points in the window and their sums: n, x, y, xx, xy
+        self._points = deque()
+        self._sums = [0.,0.,0.,0.,0.]
+
+    def _add(self,day,value):
+        x = float(day - self.origin)
+        self._points.append((x,value))
+        for i,term in enumerate((1.,x,value,x * x,x * value)):
+            self._sums[i] += term
+        if self.window != None:
+            while self._points[0][0] <= x - self.window:
+                old_x,old_y = self._points.popleft()
+                for i,term in enumerate((1.,old_x,old_y,old_x * old_x,old_x * old_y)):
+                    self._sums[i] -= term
+
+    def update(self,day,weight):
+        """Add the weigh-in of day ordinal 'day' (days must increase)"""
+        day = int(day)
+        weight = float(weight)
+        if weight <= 0:
+            return
+        if self.day != None and day <= self.day:
+            raise ValueError("Weigh-ins must be added in date order.")
+        if self.origin == None:
+            self.origin = day
+            self.smoothed = weight
+            self._add(day,weight)
+        elif self.model == 'lsq':
+            self._add(day,weight)
+        elif self.model == 'ewma':
+            gap = day - self.day
+            for d in range(self.day + 1,day):
+                self._add(d,self.smoothed)
+            decay = (1. - self.alpha) ** gap
+            self.smoothed = decay * self.smoothed + (1. - decay) * weight
+            self._add(day,self.smoothed)
+        else:
+            #Endpoints and hackers see the interpolated daily weights
+            gap = day - self.day
+            for k in range(1,gap + 1):
+                value = self.weight + (weight - self.weight) * k / float(gap)
+                if self.model == 'hackers':
+                    self.smoothed += self.alpha * (value - self.smoothed)
+                    value = self.smoothed
+                self._add(self.day + k,value)
+        self.day = day
+        self.weight = weight
+
+    @property
+    def slope(self):
+        """Trend slope (lbs/day) as of the last weigh-in, NaN if unknown"""
+        if self.model == 'endpoints':
+            x0,y0 = self._points[0] if self._points else (0.,0.)
+            x1,y1 = self._points[-1] if self._points else (0.,0.)
+            return (y1 - y0) / (x1 - x0) if x1 > x0 else float('nan')
+        n,sx,sy,sxx,sxy = self._sums
+        if n < 2:
+            return float('nan')
+        var = sxx - sx * sx / n
+        if var <= 1e-9:
+            return 0.
+        return (sxy - sx * sy / n) / var
+
+    @property
+    def level(self):
+        """Trend weight as of the last weigh-in"""
+        if self.day == None:
+            return float('nan')
+        if self.model == 'endpoints':
+            return self.weight
+        if self.model == 'lsq':
+            n,sx,sy = self._sums[:3]
+            if n < 2:
+                return self.weight
+            return sy / n + self.slope * (self.day - self.origin - sx / n)
+        return self.smoothed
+
+def state_from(ords,weights,model = 'lsq',window = None,alpha = None):
+    """TrendState fed with existing weigh-ins, ready for update()"""
+    state = TrendState(model,window,alpha)
+    first,y = daily_weights(ords,weights)
+    for i in np.flatnonzero(~np.isnan(y)):
+        state.update(first + i,y[i])
+    return state